@@ -107,13 +107,18 @@ def basic_setup(self):
             ep.load()(conf)
         log.info('Loaded tools')
 
-    def setup_globals(self):
+    def setup_globals(self, registry=None):
+        '''Register the request globals, in registry (for another thread) if
+        given'''
         import allura.lib.app_globals
-        self.registry.prepare()
-        self.registry.register(pylons.tmpl_context, EmptyClass())
-        self.registry.register(pylons.app_globals, self.globals)
-        self.registry.register(allura.credentials, allura.lib.security.Credentials())
+        if registry is None:
+            registry = self.registry
+        registry.prepare()
+        registry.register(pylons.tmpl_context, EmptyClass())
+        registry.register(pylons.app_globals, self.globals)
+        registry.register(allura.credentials, allura.lib.security.Credentials())
         pylons.tmpl_context.queued_messages = None
+        return registry
 
     def teardown_globals(self):
         self.registry.cleanup()
@@ -16,6 +16,9 @@
 #       under the License.
 
 import sys
+import time
+import traceback
+import multiprocessing
 from collections import defaultdict
 from contextlib import contextmanager
 from itertools import groupby
@@ -25,9 +28,12 @@
 
 from ming.orm import mapper, session, Mapper
 from ming.orm.declarative import MappedClass
+from ming.orm.ormsession import ThreadLocalORMSession
+from ming.utils import LazyProperty
 
 from allura.tasks.index_tasks import add_artifacts
 from allura.lib.exceptions import CompoundError
+from allura.lib.solr import make_solr_from_config
 from allura.lib import helpers as h
 from allura.lib import utils
 from . import base
@@ -65,7 +71,7 @@ class ReindexCommand(base.Command):
     parser.add_option('--solr', action='store_true', dest='solr',
                       help='Solr needs artifact references to already exist.')
     parser.add_option('--skip-solr-delete', action='store_true', dest='skip_solr_delete',
-                      help='Skip clearing solr index.')
+                      help='Skip removing the solr documents of artifacts that no longer exist.')
     parser.add_option('--refs', action='store_true', dest='refs',
                       help='Update artifact references and shortlinks')
     parser.add_option('--tasks', action='store_true', dest='tasks',
@@ -78,11 +84,26 @@ class ReindexCommand(base.Command):
                       help='Max number of artifacts to index in one Solr update command')
     parser.add_option('--ming-config', dest='ming_config', help='Path (absolute, or relative to '
                         'Allura root) to .ini file defining ming configuration.')
+    parser.add_option('--incremental', action='store_true', dest='incremental',
+                      help='Only reindex artifacts modified since the last reindex of their '
+                           'project and class.  Progress is checkpointed as a reindex runs, '
+                           'so this also resumes an interrupted reindex.')
+    parser.add_option('--remove-stale', action='store_true', dest='remove_stale',
+                      help='With --incremental, also remove the references, shortlinks and solr '
+                           'documents of artifacts that no longer exist.  This reads every one '
+                           'of them for each project, so a full reindex always does it but an '
+                           'incremental one only does it when asked to.')
+
+    parser.add_option('--workers', dest='workers', type=int, default=1,
+                      help='Number of processes to reindex projects in, in parallel.')
+
+    # artifacts are reindexed, and progress checkpointed, this many at a time
+    page_size = 1024
 
     def command(self):
         from allura import model as M
         self.basic_setup()
-        graph = build_model_inheritance_graph()
+        self.graph = build_model_inheritance_graph()
         if self.options.project:
             q_project = dict(shortname=self.options.project)
         elif self.options.project_regex:
@@ -98,44 +119,211 @@ def command(self):
         if not self.options.solr and not self.options.refs:
             self.options.solr = self.options.refs = True
 
-        for projects in utils.chunked_find(M.Project, q_project):
-            for p in projects:
-                c.project = p
-                base.log.info('Reindex project %s', p.shortname)
-                # Clear index for this project
-                if self.options.solr and not self.options.skip_solr_delete:
-                    g.solr.delete(q='project_id_s:%s' % p._id)
+        start = time.time()
+        projects = (p for chunk in utils.chunked_find(M.Project, q_project)
+                    for p in chunk)
+        if self.options.workers > 1:
+            results = self._reindex_in_pool([p._id for p in projects])
+        else:
+            results = (self._reindex_project(p) for p in projects)
+        self.results = []
+        for result in results:
+            base.log.info('Reindexed project %(project)s: %(artifacts)s artifacts, '
+                          '%(errors)s errors in %(seconds).1fs', result)
+            self.results.append(result)
+        self._log_summary(time.time() - start)
+        base.log.info('Reindex %s', 'queued' if self.options.tasks else 'done')
+
+    def _reindex_in_pool(self, project_ids):
+        """Reindex the projects in a pool of self.options.workers processes,
+        yielding the results as they complete.
+        """
+        pool = multiprocessing.Pool(
+            self.options.workers, _init_reindex_worker, (self,))
+        try:
+            for result in pool.imap_unordered(_reindex_worker, project_ids):
+                yield result
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    def _reindex_project(self, project):
+        """Reindex one project, returning a summary of how it went."""
+        from allura import model as M
+        result = dict(project=project.shortname, artifacts=0, errors=0,
+                      failure=None)
+        start = time.time()
+        c.project = project
+        base.log.info('Reindex project %s', project.shortname)
+        try:
+            if not self.options.incremental:
+                self.checkpoints.clear(project._id)
+            app_config_ids = [ ac._id for ac in project.app_configs ]
+            # Traverse the inheritance graph, finding all artifacts that
+            # belong to this project
+            for _, a_cls in dfs(M.Artifact, self.graph):
+                base.log.info('  %s', a_cls)
+                artifacts, errors = self._reindex_class(project, a_cls, app_config_ids)
+                result['artifacts'] += artifacts
+                result['errors'] += errors
+            # Only now that every artifact has been (re)written, remove
+            # what's left over from artifacts that no longer exist
+            if not self.options.incremental or self.options.remove_stale:
+                self._remove_stale(project)
+        except Exception:
+            base.log.exception('Error reindexing project %s', project.shortname)
+            result['failure'] = traceback.format_exc()
+        result['seconds'] = time.time() - start
+        return result
+
+    def _log_summary(self, seconds):
+        failed = [r for r in self.results if r['failure']]
+        base.log.info('Reindexed %s projects (%s failed), %s artifacts with %s errors in %.1fs',
+                      len(self.results), len(failed),
+                      sum(r['artifacts'] for r in self.results),
+                      sum(r['errors'] for r in self.results), seconds)
+        for r in sorted(self.results, key=lambda r: r['seconds'], reverse=True):
+            base.log.info('  %-30s %8.1fs %8s artifacts %6s errors%s',
+                          r['project'], r['seconds'], r['artifacts'], r['errors'],
+                          ' FAILED' if r['failure'] else '')
+        for r in failed:
+            base.log.error('Reindex of %s failed:\n%s', r['project'], r['failure'])
+
+    @LazyProperty
+    def checkpoints(self):
+        from allura import model as M
+        return ReindexCheckpoints(
+            M.main_doc_session.db[ReindexCheckpoints.collection_name],
+            solr=self.options.solr, refs=self.options.refs)
+
+    def _reindex_class(self, project, a_cls, app_config_ids):
+        """Reindex the artifacts of a_cls in project in order of mod_date, a
+        page at a time, checkpointing after each page.
+
+        Where each page ends is read from the raw documents, since loading
+        them fills in a missing mod_date with the current time.
+
+        Returns the number of artifacts reindexed and of errors.
+        """
+        from allura import model as M
+        query = dict(app_config_id={'$in': app_config_ids})
+        artifacts = errors = 0
+        checkpoint = None
+        if self.options.incremental:
+            checkpoint = self.checkpoints.get(project._id, a_cls)
+        while True:
+            q = dict(query)
+            if checkpoint:
+                q.update(ReindexCheckpoints.after(*checkpoint))
+            docs = list(a_cls.query.mapper.collection.m.find(
+                q, fields=['mod_date'], sort=[('mod_date', 1), ('_id', 1)],
+                limit=self.page_size, validate=False))
+            if not docs:
+                break
+            ref_ids = []
+            # Create artifact references and shortlinks
+            for a in a_cls.query.find(dict(_id={'$in': [d['_id'] for d in docs]})):
+                if self.options.verbose:
+                    base.log.info('      %s', a.shorthand_id())
                 if self.options.refs:
-                    M.ArtifactReference.query.remove({'artifact_reference.project_id':p._id})
-                    M.Shortlink.query.remove({'project_id':p._id})
-                app_config_ids = [ ac._id for ac in p.app_configs ]
-                # Traverse the inheritance graph, finding all artifacts that
-                # belong to this project
-                for _, a_cls in dfs(M.Artifact, graph):
-                    base.log.info('  %s', a_cls)
-                    ref_ids = []
-                    # Create artifact references and shortlinks
-                    for a in a_cls.query.find(dict(app_config_id={'$in': app_config_ids})):
-                        if self.options.verbose:
-                            base.log.info('      %s', a.shorthand_id())
-                        if self.options.refs:
-                            try:
-                                M.ArtifactReference.from_artifact(a)
-                                M.Shortlink.from_artifact(a)
-                            except:
-                                base.log.exception('Making ArtifactReference/Shortlink from %s', a)
-                                continue
-                        ref_ids.append(a.index_id())
-                    M.main_orm_session.flush()
-                    M.artifact_orm_session.clear()
                     try:
-                        self._chunked_add_artifacts(ref_ids)
-                    except CompoundError, err:
-                        base.log.exception('Error indexing artifacts:\n%r', err)
-                        base.log.error('%s', err.format_error())
-                    M.main_orm_session.flush()
-                    M.main_orm_session.clear()
-        base.log.info('Reindex %s', 'queued' if self.options.tasks else 'done')
+                        M.ArtifactReference.from_artifact(a)
+                        M.Shortlink.from_artifact(a)
+                    except:
+                        base.log.exception('Making ArtifactReference/Shortlink from %s', a)
+                        errors += 1
+                        continue
+                ref_ids.append(a.index_id())
+            M.main_orm_session.flush()
+            M.artifact_orm_session.clear()
+            try:
+                self._chunked_add_artifacts(ref_ids)
+            except CompoundError, err:
+                base.log.exception('Error indexing artifacts:\n%r', err)
+                base.log.error('%s', err.format_error())
+                errors += len(err.args)
+            M.main_orm_session.flush()
+            M.main_orm_session.clear()
+            artifacts += len(ref_ids)
+            checkpoint = (docs[-1].get('mod_date'), docs[-1]['_id'])
+            self.checkpoints.set(project._id, a_cls, *checkpoint)
+            if len(docs) < self.page_size:
+                break
+        return artifacts, errors
+
+    def _remove_stale(self, project):
+        """Remove the references, shortlinks and solr documents of project's
+        artifacts that no longer exist.
+        """
+        from allura import model as M
+        delete_solr = self.options.solr and not self.options.skip_solr_delete
+        live_ids = set()
+        refs = M.ArtifactReference.query.mapper.collection.m.find(
+            {'artifact_reference.project_id': project._id},
+            fields=['artifact_reference'], validate=False)
+        for chunk in utils.chunked_iter(refs, self.page_size):
+            by_cls = defaultdict(list)
+            for ref in chunk:
+                aref = ref['artifact_reference']
+                by_cls[aref['cls']].append((ref['_id'], aref['artifact_id']))
+            stale_ids = []
+            for pickled_cls, ids in by_cls.iteritems():
+                try:
+                    a_cls = M.ArtifactReference.artifact_class(pickled_cls)
+                except:
+                    base.log.exception('Loading artifact class for %s', ids[0][0])
+                    continue
+                found = set(a['_id'] for a in a_cls.query.mapper.collection.m.find(
+                    dict(_id={'$in': [aid for _, aid in ids]}),
+                    fields=['_id'], validate=False))
+                for ref_id, aid in ids:
+                    if aid in found:
+                        live_ids.add(ref_id)
+                    else:
+                        stale_ids.append(ref_id)
+            if stale_ids:
+                base.log.info('  removing %s stale references', len(stale_ids))
+                if delete_solr:
+                    self.solr.delete(q='id:(%s)' % ' || '.join(stale_ids))
+                if self.options.refs:
+                    M.ArtifactReference.query.remove(dict(_id={'$in': stale_ids}))
+                    M.Shortlink.query.remove(dict(ref_id={'$in': stale_ids}))
+        if self.options.refs:
+            # shortlinks without any reference
+            links = M.Shortlink.query.mapper.collection.m.find(
+                dict(project_id=project._id), fields=['ref_id'], validate=False)
+            orphan_ids = [l['_id'] for l in links if l.get('ref_id') not in live_ids]
+            for chunk in utils.chunked_list(orphan_ids, self.page_size):
+                base.log.info('  removing %s orphaned shortlinks', len(chunk))
+                M.Shortlink.query.remove(dict(_id={'$in': chunk}))
+        if delete_solr:
+            # solr documents without any reference
+            orphan_ids = [
+                id for id in self._solr_ids('project_id_s:%s' % project._id)
+                if id not in live_ids]
+            for chunk in utils.chunked_list(orphan_ids, self.page_size):
+                base.log.info('  removing %s orphaned solr documents', len(chunk))
+                self.solr.delete(q='id:(%s)' % ' || '.join(chunk))
+
+    def _solr_ids(self, q):
+        start = 0
+        while True:
+            result = self.solr.search(q, fl='id', sort='id asc',
+                                      start=start, rows=self.page_size)
+            for doc in result.docs:
+                yield doc['id']
+            start += self.page_size
+            if start >= result.hits:
+                break
+
+    @LazyProperty
+    def solr(self):
+        if self.options.solr_hosts:
+            return make_solr_from_config(self.options.solr_hosts.split(','))
+        return g.solr
 
     @property
     def add_artifact_kwargs(self):
@@ -191,6 +379,71 @@ def noop_cm(*args):
         return contextmanager(noop_cm)
 
 
+def _init_reindex_worker(command):
+    """Set up a ReindexCommand process pool worker with its own mongo and
+    solr connections, rather than those inherited from the parent process.
+    """
+    global _reindex_command
+    for name in ('registry', 'globals', 'solr', 'checkpoints'):
+        command.__dict__.pop(name, None)
+    command.basic_setup()
+    ThreadLocalORMSession.close_all()
+    _reindex_command = command
+
+
+def _reindex_worker(project_id):
+    from allura import model as M
+    project = M.Project.query.get(_id=project_id)
+    return _reindex_command._reindex_project(project)
+
+
+class ReindexCheckpoints(object):
+    """How far ReindexCommand has got, per project and artifact class: the
+    (mod_date, _id) of the last artifact reindexed, in that order.
+
+    Checkpoints are kept separately for each combination of solr and refs,
+    so e.g. a solr-only reindex doesn't skip artifacts that only had their
+    references updated.
+    """
+    collection_name = 'reindex_checkpoint'
+
+    def __init__(self, collection, solr=True, refs=True):
+        self.collection = collection
+        self.targets = ','.join(
+            name for name, on in (('refs', refs), ('solr', solr)) if on)
+
+    def _id(self, project_id, a_cls):
+        return '%s:%s.%s:%s' % (
+            project_id, a_cls.__module__, a_cls.__name__, self.targets)
+
+    def get(self, project_id, a_cls):
+        doc = self.collection.find_one(self._id(project_id, a_cls))
+        if doc:
+            return doc['mod_date'], doc['artifact_id']
+
+    def set(self, project_id, a_cls, mod_date, artifact_id):
+        self.collection.save(dict(
+            _id=self._id(project_id, a_cls),
+            project_id=project_id,
+            mod_date=mod_date,
+            artifact_id=artifact_id), safe=True)
+
+    def clear(self, project_id):
+        self.collection.remove(dict(project_id=project_id), safe=True)
+
+    @staticmethod
+    def after(mod_date, artifact_id):
+        """Query for the artifacts after the given checkpoint."""
+        if mod_date is None:
+            # artifacts with no mod_date come first; then all that have one
+            newer = {'mod_date': {'$ne': None}}
+        else:
+            newer = {'mod_date': {'$gt': mod_date}}
+        return {'$or': [
+            newer,
+            {'mod_date': mod_date, '_id': {'$gt': artifact_id}}]}
+
+
 class EnsureIndexCommand(base.Command):
     min_args=1
     max_args=1
@@ -15,12 +15,20 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+import time
+import signal
 import smtpd
 import asyncore
+import threading
+import Queue
+from collections import defaultdict
 
+import bson
 import faulthandler
 import tg
+from paste.registry import Registry
 from paste.script import command
+from ming.orm import ThreadLocalORMSession
 
 import allura.tasks
 from allura.command import base
@@ -40,16 +48,161 @@ class SMTPServerCommand(base.Command):
     def command(self):
         faulthandler.enable()
         self.basic_setup()
-        MailServer((tg.config.get('forgemail.host', '0.0.0.0'),
-                    asint(tg.config.get('forgemail.port', 8825))),
-                   None)
-        asyncore.loop()
+        server = MailServer((tg.config.get('forgemail.host', '0.0.0.0'),
+                             asint(tg.config.get('forgemail.port', 8825))),
+                            None,
+                            queue_size=asint(tg.config.get('forgemail.queue_size', 1000)),
+                            workers=asint(tg.config.get('forgemail.workers', 4)),
+                            max_connections=asint(tg.config.get('forgemail.max_connections', 100)),
+                            max_message_size=asint(tg.config.get('forgemail.max_message_size', 10 * 1024 * 1024)),
+                            setup_thread=lambda: self.setup_globals(Registry()))
+        signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+        server.serve_forever(
+            stats_interval=asint(tg.config.get('forgemail.stats_interval', 300)))
 
 class MailServer(smtpd.SMTPServer):
+    '''Receives mail and queues a route_email task for each message.
+
+    Messages go into an intake queue of queue_size, which worker threads
+    post the tasks from, so the server only has to receive them.  When the
+    queue is full, messages are refused with a temporary error for the
+    sender to retry later, and so are connections beyond max_connections.
+    stats counts connections, refused connections, and messages accepted,
+    rejected, posted and failed.
+
+    Messages in the queue have already been accepted, so on the way out
+    serve_forever() stops accepting and waits for the workers to post every
+    queued message.
+    '''
+
+    def __init__(self, localaddr, remoteaddr, queue_size=1000, workers=4,
+                 max_connections=100, max_message_size=10 * 1024 * 1024,
+                 setup_thread=None):
+        smtpd.SMTPServer.__init__(self, localaddr, remoteaddr)
+        self.queue = Queue.Queue(queue_size)
+        self.workers = workers
+        self.max_connections = max_connections
+        self.max_message_size = max_message_size
+        self.setup_thread = setup_thread
+        self.channels = set()
+        self.threads = []
+        self.keep_running = True
+        self.stats = defaultdict(int)
+
+    def serve_forever(self, stats_interval=300):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.work, name='route_email-%s' % i)
+            thread.start()
+            self.threads.append(thread)
+        next_stats = time.time() + stats_interval
+        try:
+            while self.keep_running and asyncore.socket_map:
+                asyncore.loop(timeout=1, count=1)
+                if stats_interval and time.time() >= next_stats:
+                    self.log_stats()
+                    next_stats = time.time() + stats_interval
+        finally:
+            self.shutdown()
+
+    def stop(self):
+        '''Make serve_forever() shut down, e.g. from a signal handler'''
+        self.keep_running = False
+
+    def shutdown(self):
+        '''Stop accepting connections and messages, and wait until all the
+        queued messages are posted'''
+        base.log.info('Mail server stopping, %d messages queued', self.queue.qsize())
+        self.close()
+        for channel in list(self.channels):
+            channel.close()
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        # anything left if there were no workers
+        while not self.queue.empty():
+            self.post(*self.queue.get_nowait())
+            self.queue.task_done()
+        self.log_stats()
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is None:
+            return
+        conn, addr = pair
+        if len(self.channels) >= self.max_connections:
+            self.stats['refused'] += 1
+            base.log.warning('Refusing connection from %s, %d are open', addr, len(self.channels))
+            try:
+                conn.sendall('421 Too many connections, try again later\r\n')
+            finally:
+                conn.close()
+            return
+        self.stats['connections'] += 1
+        MailChannel(self, conn, addr)
 
     def process_message(self, peer, mailfrom, rcpttos, data):
         base.log.info('Msg Received from %s for %s', mailfrom, rcpttos)
         base.log.info(' (%d bytes)', len(data))
-        allura.tasks.mail_tasks.route_email(
-            peer=peer, mailfrom=mailfrom, rcpttos=rcpttos, data=data)
-        base.log.info('Msg passed along')
+        if len(data) > self.max_message_size:
+            self.stats['rejected'] += 1
+            base.log.warning('Rejecting %d byte message from %s', len(data), mailfrom)
+            return '552 Message exceeds the maximum size'
+        try:
+            self.queue.put_nowait((peer, mailfrom, rcpttos, data))
+        except Queue.Full:
+            self.stats['rejected'] += 1
+            base.log.warning('Intake queue full, deferring message from %s', mailfrom)
+            return '451 Too busy, try again later'
+        self.stats['accepted'] += 1
+
+    def work(self):
+        # keep a reference to the thread's registry while it's running
+        registry = self.setup_thread() if self.setup_thread else None
+        while True:
+            message = self.queue.get()
+            try:
+                if message is None:
+                    return
+                self.post(*message)
+            finally:
+                self.queue.task_done()
+
+    def post(self, peer, mailfrom, rcpttos, data, attempts=3):
+        '''Queue a route_email task for a message, retrying a few times since
+        the sender has already been told it was accepted'''
+        for attempt in range(attempts):
+            try:
+                # data is whatever bytes were sent, which may not be utf-8
+                allura.tasks.mail_tasks.route_email.post(
+                    peer=peer, mailfrom=mailfrom, rcpttos=rcpttos, data=bson.Binary(data))
+                self.stats['posted'] += 1
+                base.log.info('Msg passed along')
+                return
+            except Exception:
+                base.log.exception('Error queuing message from %s for %s', mailfrom, rcpttos)
+                time.sleep(attempt)
+            finally:
+                ThreadLocalORMSession.close_all()
+        self.stats['failed'] += 1
+
+    def log_stats(self):
+        base.log.info(
+            'Mail server: %d connections (%d open, %d refused), '
+            '%d messages accepted, %d rejected, %d queued, %d posted, %d failed',
+            self.stats['connections'], len(self.channels), self.stats['refused'],
+            self.stats['accepted'], self.stats['rejected'], self.queue.qsize(),
+            self.stats['posted'], self.stats['failed'])
+
+class MailChannel(smtpd.SMTPChannel):
+    '''An SMTP connection, which the server keeps track of while it's open'''
+
+    def __init__(self, server, conn, addr):
+        self.mail_server = server
+        smtpd.SMTPChannel.__init__(self, server, conn, addr)
+        server.channels.add(self)
+
+    def close(self):
+        self.mail_server.channels.discard(self)
+        smtpd.SMTPChannel.close(self)
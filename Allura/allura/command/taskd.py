@@ -16,7 +16,10 @@
 #       under the License.
 
 import logging
+import math
+import multiprocessing
 import os
+import subprocess
 import time
 import Queue
 from contextlib import contextmanager
@@ -58,6 +61,21 @@ class TaskdCommand(base.Command):
     parser = base.Command.standard_parser(verbose=True)
     parser.add_option('--only', dest='only', type='string', default=None,
                       help='only handle tasks of the given name(s) (can be comma-separated list)')
+    parser.add_option('--batch-size', dest='batch_size', type='int', default=1,
+                      help='number of tasks to claim from the queue at once (default 1)')
+    parser.add_option('--batch-limit', dest='batch_limit', type='string', default=None,
+                      help='max number of tasks matching a task name pattern to claim in one batch, '
+                           'e.g. "allura.tasks.repo_tasks.*=1" (can be comma-separated list)')
+    parser.add_option('--supervisor', dest='supervisor', action='store_true', default=False,
+                      help='run as a supervisor that starts, restarts and scales taskd worker processes')
+    parser.add_option('--pool', dest='pools', action='append', default=[],
+                      help='supervisor worker pool as "patterns:min:max", e.g. '
+                           '"allura.tasks.repo_tasks.*:1:4" (patterns can be comma-separated, '
+                           'and may be omitted for a pool that handles any task).  Can be repeated.')
+    parser.add_option('--tasks-per-worker', dest='tasks_per_worker', type='int', default=50,
+                      help='supervisor adds a worker to a pool for every this many ready tasks (default 50)')
+    parser.add_option('--scale-interval', dest='scale_interval', type='int', default=30,
+                      help='seconds between supervisor queue depth checks (default 30)')
 
     def command(self):
         setproctitle('taskd')
@@ -74,11 +92,16 @@ def command(self):
         signal.siginterrupt(signal.SIGHUP, False)
         signal.siginterrupt(signal.SIGTERM, False)
         signal.siginterrupt(signal.SIGUSR1, False)
-        self.worker()
+        if self.options.supervisor:
+            self.supervisor()
+        else:
+            self.worker()
 
     def graceful_restart(self, signum, frame):
         base.log.info('taskd pid %s recieved signal %s preparing to do a graceful restart' % (os.getpid(), signum))
-        self.keep_running = False
+        if not self.options.supervisor:
+            # the supervisor keeps running and restarts its workers instead
+            self.keep_running = False
         self.restart_when_done = True
 
     def graceful_stop(self, signum, frame):
@@ -98,6 +121,9 @@ def worker(self):
         only = self.options.only
         if only:
             only = only.split(',')
+        batch_size = max(self.options.batch_size, 1)
+        batch_limits = parse_batch_limits(self.options.batch_limit)
+        lease_time = asint(pylons.config.get('monq.lease_time', 600))
 
         def start_response(status, headers, exc_info=None):
             if status != '200 OK':
@@ -131,33 +157,213 @@ def waitfunc_checks_running():
                 pylons.app_globals.amq_conn.reset()
             try:
                 while self.keep_running:
-                    self.task = M.MonQTask.get(
-                            process=name,
-                            waitfunc=waitfunc,
-                            only=only)
-                    if self.task:
-                        with(proctitle("taskd:{0}:{1}".format(
-                                self.task.task_name, self.task._id))):
-                            # Build the (fake) request
-                            request_path = '/--%s--/%s/' % (self.task.task_name, self.task._id)
-                            r = Request.blank(request_path,
-                                              base_url=tg.config['base_url'].rstrip('/') + request_path,
-                                              environ={'task': self.task,
-                                               })
-                            list(wsgi_app(r.environ, start_response))
+                    if batch_size > 1:
+                        tasks = M.MonQTask.get_batch(
+                                process=name,
+                                waitfunc=waitfunc,
+                                only=only,
+                                batch_size=batch_size,
+                                limits=batch_limits,
+                                lease_time=lease_time)
+                    else:
+                        task = M.MonQTask.get(
+                                process=name,
+                                waitfunc=waitfunc,
+                                only=only)
+                        tasks = [task] if task else []
+                    while tasks:
+                        if not self.keep_running:
+                            # hand unstarted tasks back to the other workers
+                            M.MonQTask.release(tasks)
+                            break
+                        self.task = tasks.pop(0)
+                        if batch_size > 1 and not M.MonQTask.start_leased(self.task):
+                            base.log.warning('lease on task %s expired, skipping it',
+                                             self.task._id)
                             self.task = None
+                            continue
+                        try:
+                            self.run_task(wsgi_app, start_response)
+                        except:
+                            M.MonQTask.release(tasks)
+                            raise
+                        self.task = None
+                        M.MonQTask.renew_leases(tasks, lease_time)
             except Exception as e:
                 if self.keep_running:
                     base.log.exception('taskd error %s; pausing for 10s before taking more tasks' % e)
                     time.sleep(10)
                 else:
                     base.log.exception('taskd error %s' % e)
+        if M.TaskContextCache._instance:
+            M.TaskContextCache._instance.log_stats()
         base.log.info('taskd pid %s stopping gracefully.' % os.getpid())
 
         if self.restart_when_done:
             base.log.info('taskd pid %s restarting itself' % os.getpid())
             os.execv(sys.argv[0], sys.argv)
 
+    def supervisor(self):
+        from allura import model as M
+        setproctitle('taskd:supervisor')
+        pools = [WorkerPool.from_option(p) for p in self.options.pools]
+        if not pools:
+            pools = [WorkerPool(None, 1, multiprocessing.cpu_count())]
+        next_scale = 0
+        while self.keep_running:
+            if self.restart_when_done:
+                # workers restart themselves gracefully, we keep supervising
+                base.log.info('taskd supervisor pid %s restarting workers' % os.getpid())
+                for pool in pools:
+                    pool.signal(signal.SIGHUP)
+                self.restart_when_done = False
+            for pool in pools:
+                pool.reap()
+            if time.time() >= next_scale:
+                for pool in pools:
+                    try:
+                        depth = M.MonQTask.queue_depth(pool.only)
+                    except Exception:
+                        base.log.exception('taskd supervisor could not check queue depth')
+                        depth = 0
+                    pool.scale(depth, self.options.tasks_per_worker, self.worker_args)
+                next_scale = time.time() + self.options.scale_interval
+            for pool in pools:
+                # restart crashed workers and keep every pool at its minimum
+                pool.scale(None, self.options.tasks_per_worker, self.worker_args)
+            time.sleep(1)
+        base.log.info('taskd supervisor pid %s stopping workers' % os.getpid())
+        for pool in pools:
+            pool.signal(signal.SIGTERM)
+        for pool in pools:
+            pool.wait()
+        base.log.info('taskd supervisor pid %s stopped gracefully.' % os.getpid())
+
+    def worker_args(self, only):
+        '''Command line for a worker process started by the supervisor'''
+        args = [sys.argv[0], self.command_name, self.args[0]]
+        if only:
+            args += ['--only', ','.join(only)]
+        if self.options.batch_size > 1:
+            args += ['--batch-size', str(self.options.batch_size)]
+        if self.options.batch_limit:
+            args += ['--batch-limit', self.options.batch_limit]
+        return args
+
+    def run_task(self, wsgi_app, start_response):
+        with(proctitle("taskd:{0}:{1}".format(
+                self.task.task_name, self.task._id))):
+            # Build the (fake) request
+            request_path = '/--%s--/%s/' % (self.task.task_name, self.task._id)
+            r = Request.blank(request_path,
+                              base_url=tg.config['base_url'].rstrip('/') + request_path,
+                              environ={'task': self.task,
+                               })
+            list(wsgi_app(r.environ, start_response))
+
+
+def parse_batch_limits(value):
+    '''Parse a --batch-limit value like "pattern=N,pattern=N" into a dict'''
+    limits = {}
+    if not value:
+        return limits
+    for item in value.split(','):
+        pattern, _, limit = item.strip().rpartition('=')
+        if not pattern:
+            raise ValueError('Invalid batch limit %r, expected pattern=N' % item)
+        limits[pattern] = int(limit)
+    return limits
+
+
+class WorkerPool(object):
+    '''A group of taskd worker processes handling the same task names, sized
+    between min_workers and max_workers according to queue depth.
+
+    Workers that crash within min_uptime seconds of starting are restarted
+    after a delay that doubles with each such crash, from backoff up to
+    max_backoff seconds, so a worker that can't start doesn't spin.'''
+
+    min_uptime = 10
+    backoff = 1
+    max_backoff = 300
+
+    def __init__(self, only, min_workers, max_workers):
+        self.only = only
+        self.min_workers = min_workers
+        self.max_workers = max(max_workers, min_workers)
+        self.size = min_workers
+        self.procs = []
+        self.stopping = []
+        self.started = {}
+        self.crashes = 0
+        self.restart_after = 0
+
+    @classmethod
+    def from_option(cls, value):
+        '''Parse a --pool value like "patterns:min:max"'''
+        try:
+            only, min_workers, max_workers = value.rsplit(':', 2)
+            only = [p.strip() for p in only.split(',') if p.strip()] or None
+            return cls(only, int(min_workers), int(max_workers))
+        except ValueError:
+            raise ValueError('Invalid pool %r, expected patterns:min:max' % value)
+
+    def __repr__(self):
+        return '<WorkerPool %s %s/%s-%s>' % (
+            ','.join(self.only or ['*']), len(self.procs),
+            self.min_workers, self.max_workers)
+
+    def reap(self):
+        '''Forget about workers that have exited'''
+        for proc in list(self.procs):
+            if proc.poll() is not None:
+                uptime = time.time() - self.started.pop(proc.pid, 0)
+                if proc.returncode != 0:
+                    base.log.warning('taskd worker pid %s in %r exited with %s' % (
+                        proc.pid, self, proc.returncode))
+                if proc.returncode != 0 and uptime < self.min_uptime:
+                    self._crashed_on_startup()
+                else:
+                    self.crashes = 0
+                self.procs.remove(proc)
+        self.stopping = [proc for proc in self.stopping if proc.poll() is None]
+
+    def _crashed_on_startup(self):
+        self.crashes += 1
+        delay = min(self.backoff * 2 ** (self.crashes - 1), self.max_backoff)
+        self.restart_after = time.time() + delay
+        base.log.warning('taskd workers in %r crashed on startup %s times in a row, '
+                         'restarting them in %ss' % (self, self.crashes, delay))
+
+    def scale(self, depth, tasks_per_worker, worker_args):
+        '''Start or gracefully stop workers to match the queue depth.  If
+        depth is None only replace workers that are missing.'''
+        if depth is not None:
+            wanted = int(math.ceil(depth / float(max(tasks_per_worker, 1))))
+            self.size = min(max(wanted, self.min_workers), self.max_workers)
+        while len(self.procs) < self.size and time.time() >= self.restart_after:
+            proc = subprocess.Popen(worker_args(self.only))
+            base.log.info('taskd started worker pid %s in %r' % (proc.pid, self))
+            self.started[proc.pid] = time.time()
+            self.procs.append(proc)
+        while len(self.procs) > self.size:
+            proc = self.procs.pop()
+            self.started.pop(proc.pid, None)
+            base.log.info('taskd stopping worker pid %s in %r' % (proc.pid, self))
+            proc.send_signal(signal.SIGTERM)
+            self.stopping.append(proc)
+
+    def signal(self, signum):
+        for proc in self.procs:
+            if proc.poll() is None:
+                proc.send_signal(signum)
+
+    def wait(self):
+        for proc in self.procs + self.stopping:
+            proc.wait()
+        self.procs = []
+        self.stopping = []
+
 
 class TaskCommand(base.Command):
     summary = 'Task command'
@@ -214,6 +420,7 @@ def _timeout(self):
         base.log.info('Reset tasks stuck for %ss or more', self.options.timeout)
         cutoff = datetime.utcnow() - timedelta(seconds=self.options.timeout)
         M.MonQTask.timeout_tasks(cutoff)
+        M.MonQTask.timeout_leases()
 
     def _commit(self):
         '''Schedule a SOLR commit'''
@@ -51,8 +51,8 @@
 from allura.lib.widgets import form_fields as ffw
 from allura.controllers.base import DispatchIndex
 from allura.controllers.feed import FeedController, FeedArgs
-from allura.lib.diff import HtmlSideBySideDiff
-from paste.deploy.converters import asbool
+from allura.lib.diff import HtmlSideBySideDiff, read_lines, diff_cache
+from paste.deploy.converters import asbool, asint
 from allura.app import SitemapEntry
 from .base import BaseController
 
@@ -593,10 +593,12 @@ def index(self, **kw):
             return self.raw()
         elif 'diff' in kw:
             tg.decorators.override_template(self.index, 'jinja:allura:templates/repo/diff.html')
-            return self.diff(kw['diff'], kw.pop('diformat', None))
+            return self.diff(kw['diff'], kw.pop('diformat', None),
+                             kw.get('context'))
         elif 'barediff' in kw:
             tg.decorators.override_template(self.index, 'jinja:allura:templates/repo/barediff.html')
-            return self.diff(kw['barediff'], kw.pop('diformat', None))
+            return self.diff(kw['barediff'], kw.pop('diformat', None),
+                             kw.get('context'), stream=True)
         else:
             force_display = 'force' in kw
             context = self._blob.context()
@@ -623,7 +625,13 @@ def raw(self, **kw):
             'Content-Disposition', 'attachment;filename=' + filename)
         return iter(self._blob)
 
-    def diff(self, commit, fmt=None, **kw):
+    def diff(self, commit, fmt=None, context=None, stream=False, **kw):
+        '''Diff against the blob at the same path in another commit.
+
+        Only the hunks are shown unless context is 'all'.  With stream, a
+        side-by-side diff that isn't cached is returned as an iterator of its
+        html, to be sent as it is rendered.
+        '''
         try:
             path, filename = os.path.split(self._blob.path())
             a_ci = c.app.repo.commit(commit)
@@ -633,13 +641,6 @@ def diff(self, commit, fmt=None, **kw):
             a = []
             apath = ''
         b = self._blob
-
-        if not self._blob.has_html_view:
-            diff = "Cannot display: file marked as a binary type."
-            return dict(a=a, b=b, diff=diff)
-
-        la = list(a)
-        lb = list(b)
         adesc = (u'a' + h.really_unicode(apath)).encode('utf-8')
         bdesc = (u'b' + h.really_unicode(b.path())).encode('utf-8')
 
@@ -648,13 +649,64 @@ def diff(self, commit, fmt=None, **kw):
         else:
             web_session['diformat'] = fmt
             web_session.save()
-        if fmt == 'sidebyside':
-            hd = HtmlSideBySideDiff()
-            diff = hd.make_table(la, lb, adesc, bdesc)
+        tabsize = 4
+        full = context == 'all'
+        expand_url = None
+        if not full:
+            expand_url = (u'%s?%s=%s&context=all' % (
+                b.url(), 'barediff' if stream else 'diff', commit)).encode('utf-8')
+        key = diff_cache.key(
+            getattr(a, '_id', None), b._id, adesc, bdesc, fmt, tabsize,
+            full, expand_url)
+        images = getattr(a, 'has_image_view', False) and b.has_image_view
+        if stream and fmt == 'sidebyside' and not images and b.has_html_view:
+            diff = diff_cache.get(key)
+            if diff is None:
+                return diff_cache.stream(key, self._side_by_side(
+                    a, b, adesc, bdesc, tabsize, full, expand_url))
         else:
-            diff = ''.join(difflib.unified_diff(la, lb, adesc, bdesc))
+            diff = diff_cache.render(key, lambda: self._render_diff(
+                a, b, adesc, bdesc, fmt, tabsize, full, expand_url))
         return dict(a=a, b=b, diff=diff)
 
+    def _render_diff(self, a, b, adesc, bdesc, fmt, tabsize, full, expand_url):
+        if not b.has_html_view:
+            diff = "Cannot display: file marked as a binary type."
+            if fmt == 'sidebyside':
+                return diff
+        elif fmt == 'sidebyside':
+            return ''.join(self._side_by_side(
+                a, b, adesc, bdesc, tabsize, full, expand_url))
+        else:
+            la, lb, truncated = self._diff_lines(a, b)
+            n = max(len(la), len(lb)) if full else 3
+            diff = ''.join(difflib.unified_diff(la, lb, adesc, bdesc, n=n))
+            if truncated:
+                diff += '... %s\n' % truncated
+        return g.highlight(diff, lexer='diff')
+
+    def _side_by_side(self, a, b, adesc, bdesc, tabsize, full, expand_url):
+        '''Read the lines to compare, and return an iterator of the html
+        table'''
+        la, lb, truncated = self._diff_lines(a, b)
+        hd = HtmlSideBySideDiff(tabsize)
+        return hd.iter_table(la, lb, adesc, bdesc,
+                             context=None if full else 5,
+                             expand_url=expand_url, truncated=truncated)
+
+    def _diff_lines(self, a, b):
+        '''Return the lines of a and b to compare, cut to scm.diff.max_lines
+        lines and scm.diff.max_bytes bytes each, and a note if they were cut'''
+        max_lines = asint(tg.config.get('scm.diff.max_lines', 10000))
+        max_bytes = asint(tg.config.get('scm.diff.max_bytes', 1 << 21))
+        la, a_cut = read_lines(a, max_lines, max_bytes)
+        lb, b_cut = read_lines(b, max_lines, max_bytes)
+        truncated = None
+        if a_cut or b_cut:
+            truncated = ('Diff truncated: only the first %d lines (up to %d bytes) '
+                         'of each file are compared.' % (max_lines, max_bytes))
+        return la, lb, truncated
+
 def topo_sort(children, parents, dates, head_ids):
     to_visit = sorted(list(set(head_ids)), key=lambda x: dates[x])
     visited = set()
@@ -59,7 +59,7 @@
 from allura.lib.widgets import analytics
 from allura.lib.security import Credentials
 from allura.lib.async import Connection, MockAMQ
-from allura.lib.solr import MockSOLR, make_solr_from_config
+from allura.lib.solr import MockSOLR, EmbeddedSOLR, make_solr_from_config
 from allura.lib.zarkov_helpers import ZarkovClient, zmq
 
 log = logging.getLogger(__name__)
@@ -141,6 +141,9 @@ def __init__(self):
         self.solr_query_server = config.get('solr.query_server')
         if asbool(config.get('solr.mock')):
             self.solr = self.solr_short_timeout = MockSOLR()
+        elif asbool(config.get('solr.embedded')):
+            self.solr = self.solr_short_timeout = EmbeddedSOLR(
+                config.get('solr.embedded_path') or None)
         elif self.solr_server:
             self.solr = make_solr_from_config(self.solr_server, self.solr_query_server)
             self.solr_short_timeout = make_solr_from_config(
@@ -0,0 +1,235 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+import os
+import mmap
+import struct
+import logging
+from binascii import hexlify, unhexlify
+
+log = logging.getLogger(__name__)
+
+
+class CommitGraph(object):
+    '''The commits of a repository and their parents, stored compactly so
+    that a refresh only has to ask the SCM about commits it hasn't seen.
+
+    Commits are numbered in the order they were added, parents before
+    children.  On disk the graph is a header followed by five arrays, and is
+    memory-mapped when loaded, so only the parts that are used get read:
+
+        tips      the 20-byte ids the refs pointed to at the last update
+        ids       the 20-byte id of each commit
+        offsets   uint32 per commit: where its parents start in `parents`
+        parents   uint32 commit numbers
+        sorted    uint32 commit numbers, ordered by id
+
+    Commits are looked up by binary search of `sorted`, so a lookup reads
+    a few pages of the file rather than every id.  New commits are kept in
+    memory, with a dict to look them up, until save() rewrites the file.
+    '''
+    MAGIC = 'ACG2'
+    _header = struct.Struct('<4sIII')
+
+    def __init__(self, tips=()):
+        self.tips = list(tips)
+        self._map = None
+        self._count = 0      # commits in the map
+        self._nparents = 0   # parent entries in the map
+        self._ids = []       # binary ids added since load
+        self._offsets = []
+        self._parents = []
+        self._new_index = {}  # binary id -> number, for those added since load
+
+    @classmethod
+    def load(cls, path):
+        '''Return the graph saved at path, or None if there isn't a usable
+        one'''
+        try:
+            with open(path, 'rb') as fp:
+                mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError), err:
+            if os.path.exists(path):
+                log.warning('Unable to read commit graph %s: %s', path, err)
+            return None
+        graph = cls()
+        try:
+            graph._open(mm)
+        except ValueError, err:
+            log.warning('Ignoring commit graph %s: %s', path, err)
+            mm.close()
+            return None
+        return graph
+
+    def _open(self, mm):
+        if len(mm) < self._header.size:
+            raise ValueError('truncated header')
+        magic, ntips, count, nparents = self._header.unpack_from(mm)
+        if magic != self.MAGIC:
+            raise ValueError('bad magic %r' % magic)
+        tips_at = self._header.size
+        self._ids_at = tips_at + 20 * ntips
+        self._offsets_at = self._ids_at + 20 * count
+        self._parents_at = self._offsets_at + 4 * count
+        self._sorted_at = self._parents_at + 4 * nparents
+        if len(mm) != self._sorted_at + 4 * count:
+            raise ValueError('size does not match header')
+        self.tips = [
+            hexlify(mm[at:at + 20])
+            for at in xrange(tips_at, self._ids_at, 20)]
+        self._map = mm
+        self._count = count
+        self._nparents = nparents
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def __len__(self):
+        return self._count + len(self._ids)
+
+    def __contains__(self, commit_id):
+        return self._find(unhexlify(commit_id)) is not None
+
+    def commit_ids(self):
+        '''Yield every commit id, children before parents, the most recently
+        added first'''
+        for i in xrange(len(self) - 1, -1, -1):
+            yield hexlify(self._binsha(i))
+
+    def parent_ids(self, commit_id):
+        i = self.number(commit_id)
+        return [hexlify(self._binsha(p)) for p in self._parent_indexes(i)]
+
+    def number(self, commit_id):
+        '''Return the number of commit_id, or raise KeyError'''
+        i = self._find(unhexlify(commit_id))
+        if i is None:
+            raise KeyError(commit_id)
+        return i
+
+    def commit_id(self, i):
+        '''Return the id of commit number i'''
+        return hexlify(self._binsha(i))
+
+    def add(self, commits, tips):
+        '''Add commits, given as (commit id, parent ids) pairs, children
+        before parents, and record the tips they were listed from.
+
+        Parents that aren't in the graph (e.g. in a shallow clone) are left
+        out.  Return the ids of the commits that were actually added, in the
+        order given.'''
+        added = []
+        for commit_id, parent_ids in reversed(commits):
+            binsha = unhexlify(commit_id)
+            if self._find(binsha) is not None: continue
+            parents = [self._find(unhexlify(p)) for p in parent_ids]
+            parents = [p for p in parents if p is not None]
+            self._new_index[binsha] = len(self)
+            self._ids.append(binsha)
+            self._offsets.append(self._nparents + len(self._parents))
+            self._parents.extend(parents)
+            added.append(commit_id)
+        self.tips = list(tips)
+        added.reverse()
+        return added
+
+    def save(self, path):
+        '''Write the graph to path, replacing it atomically'''
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        mm = self._map
+        with open(tmp, 'wb') as fp:
+            fp.write(self._header.pack(
+                self.MAGIC, len(self.tips), len(self),
+                self._nparents + len(self._parents)))
+            fp.write(''.join(unhexlify(t) for t in self.tips))
+            if mm is not None:
+                fp.write(mm[self._ids_at:self._offsets_at])
+            fp.write(''.join(self._ids))
+            if mm is not None:
+                fp.write(mm[self._offsets_at:self._parents_at])
+            fp.write(struct.pack('<%dI' % len(self._offsets), *self._offsets))
+            if mm is not None:
+                fp.write(mm[self._parents_at:self._sorted_at])
+            fp.write(struct.pack('<%dI' % len(self._parents), *self._parents))
+            # merge the new commits into the sorted array, copying the runs
+            # of old ones between them as they are
+            prev = 0
+            for binsha, i in sorted(self._new_index.iteritems()):
+                pos = self._bisect(binsha)
+                if pos > prev:
+                    fp.write(mm[self._sorted_at + 4 * prev:self._sorted_at + 4 * pos])
+                fp.write(struct.pack('<I', i))
+                prev = pos
+            if self._count > prev:
+                fp.write(mm[self._sorted_at + 4 * prev:self._sorted_at + 4 * self._count])
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.rename(tmp, path)
+
+    def _find(self, binsha):
+        i = self._new_index.get(binsha)
+        if i is None and self._count:
+            pos = self._bisect(binsha)
+            if pos < self._count:
+                i = self._sorted(pos)
+                if self._binsha(i) != binsha:
+                    i = None
+        return i
+
+    def _bisect(self, binsha):
+        '''Return where binsha belongs in the sorted array of the map'''
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._binsha(self._sorted(mid)) < binsha:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _sorted(self, pos):
+        return struct.unpack_from('<I', self._map, self._sorted_at + 4 * pos)[0]
+
+    def _binsha(self, i):
+        if i < self._count:
+            at = self._ids_at + 20 * i
+            return self._map[at:at + 20]
+        return self._ids[i - self._count]
+
+    def _parent_indexes(self, i):
+        if i < self._count:
+            start, = struct.unpack_from(
+                '<I', self._map, self._offsets_at + 4 * i)
+            if i + 1 < self._count:
+                end, = struct.unpack_from(
+                    '<I', self._map, self._offsets_at + 4 * (i + 1))
+            else:
+                end = self._nparents
+            return struct.unpack_from(
+                '<%dI' % (end - start), self._map, self._parents_at + 4 * start)
+        j = i - self._count
+        start = self._offsets[j] - self._nparents
+        if j + 1 < len(self._offsets):
+            end = self._offsets[j + 1] - self._nparents
+        else:
+            end = len(self._parents)
+        return self._parents[start:end]
@@ -32,6 +32,7 @@
 
 from allura.lib import helpers as h
 import allura.model.repo
+import allura.lib.diff
 
 log = logging.getLogger(__name__)
 
@@ -222,6 +223,7 @@ def timers(self):
             Timer('_diffs_copied', allura.model.repo.Commit, '_diffs_copied'),
             Timer('sequencematcher.{method_name}', allura.model.repo.SequenceMatcher, 'ratio', 'quick_ratio', 'real_quick_ratio'),
             Timer('unified_diff', allura.model.repo, 'unified_diff'),
+            Timer('diff_cache.{method_name}', allura.lib.diff.DiffCache, 'get', 'set'),
         ] + [Timer('sidebar', ep.load(), 'sidebar_menu') for ep in tool_entry_points]
 
     def before_logging(self, stat_record):
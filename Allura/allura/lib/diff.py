@@ -15,7 +15,22 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+import cgi
+import time
+import zlib
 import difflib
+import logging
+from hashlib import sha1
+from datetime import datetime, timedelta
+from collections import defaultdict
+
+import bson
+from tg import config
+from paste.deploy.converters import asint
+
+from allura.lib import helpers as h
+
+log = logging.getLogger(__name__)
 
 
 class HtmlSideBySideDiff(object):
@@ -40,6 +55,13 @@ class HtmlSideBySideDiff(object):
   <td%s><pre>%s</pre></td>
 </tr>'''.strip()
 
+    gap_link_tmpl = '<a class="diff-expand" href="%s" title="Show all lines">...</a>'
+
+    truncated_tmpl = '''
+<tr>
+  <td colspan="4" class="diff-truncated">%s</td>
+</tr>'''.strip()
+
     def __init__(self, tabsize=4):
         self._tabsize = tabsize
 
@@ -79,11 +101,14 @@ def _replace_marks(self, line):
         line = line.replace('\1', '</span>')
         return line, flag
 
-    def _make_line(self, diff):
+    def _make_line(self, diff, expand_url=None):
         aline, bline, changed = diff
         if changed is None:
             # context separation
-            return self._render_change('...', '...', '', '', 'diff-gap', 'diff-gap')
+            gap = '...'
+            if expand_url:
+                gap = self.gap_link_tmpl % cgi.escape(expand_url, True)
+            return self._render_change(gap, gap, '', '', 'diff-gap', 'diff-gap')
         anum, aline = aline
         bnum, bline = bline
         aline = self._preprocess(aline)
@@ -108,8 +133,160 @@ def make_table(self, a, b, adesc=None, bdesc=None, context=5):
 
         Uses difflib._mdiff function to generate diff.
         """
-        adesc = adesc or ''
-        bdesc = bdesc or ''
-        diff = difflib._mdiff(a, b, context=context)
-        lines = [self._make_line(d) for d in diff]
-        return self.table_tmpl % (adesc, bdesc, '\n'.join(lines))
+        return ''.join(self.iter_table(a, b, adesc, bdesc, context))
+
+    def iter_table(self, a, b, adesc=None, bdesc=None, context=5,
+                   expand_url=None, truncated=None):
+        """Yield the html table of make_table a row at a time, so that it
+        can be streamed
+
+        Takes the arguments of make_table (context=None shows all the
+        lines), and:
+         - expand_url -- url the separators between hunks link to (e.g. to
+           show all the lines)
+         - truncated -- note to show in a last row, when a or b were cut short
+        """
+        head, foot = self.table_tmpl.rsplit('%s', 1)
+        yield head % (adesc or '', bdesc or '')
+        sep = ''
+        for d in difflib._mdiff(a, b, context=context):
+            yield sep + self._make_line(d, expand_url)
+            sep = '\n'
+        if truncated:
+            yield sep + self.truncated_tmpl % cgi.escape(truncated)
+        yield foot
+
+
+def read_lines(blob, max_lines, max_bytes):
+    '''Return the lines of blob (or any iterable of lines), stopping before
+    max_lines lines or max_bytes bytes, and whether it was cut short'''
+    lines = []
+    size = 0
+    for line in blob:
+        size += len(line)
+        if len(lines) >= max_lines or size > max_bytes:
+            return lines, True
+        lines.append(line)
+    return lines, False
+
+
+class DiffCache(object):
+    '''Rendered diffs between two blobs, kept zlib compressed in mongo, so
+    that the diffs of a popular commit are only rendered once.
+
+    Blobs never change, so a diff is found by the ids of both blobs along
+    with the paths shown in it, the view and the tab size.  Diffs that
+    compress to more than scm.diff_cache.max_size bytes (default 1MB) aren't
+    kept.  When there are more than scm.diff_cache.max_entries diffs
+    (default 10000, 0 disables the cache) the least recently used are
+    removed, along with a tenth more so that this doesn't happen on every
+    store.  To keep views and stores cheap, a hit only records when the diff
+    was used if that was more than touch_interval ago, and the number of
+    diffs is only counted every evict_every stores (or every tenth of
+    max_entries, if that's less).
+
+    render() returns a whole diff, while stream() passes a diff on as it is
+    rendered and keeps a compressed copy on the way.  stats counts hits,
+    misses, stores, diffs too large to store and evictions, and the seconds
+    spent rendering misses.
+    '''
+
+    touch_interval = timedelta(hours=1)
+    evict_every = 100
+
+    def __init__(self):
+        self.stats = defaultdict(float)
+        self._unchecked_stores = 0
+
+    @property
+    def max_entries(self):
+        return asint(config.get('scm.diff_cache.max_entries', 10000))
+
+    @staticmethod
+    def key(*parts):
+        '''Return the key for a diff, given everything it's rendered from'''
+        parts = [p if isinstance(p, basestring) else repr(p) for p in parts]
+        return sha1('\0'.join(
+            h.really_unicode(p).encode('utf-8') for p in parts)).hexdigest()
+
+    def render(self, key, render):
+        '''Return the html cached under key, or else the html returned by
+        render(), caching it'''
+        html = self.get(key)
+        if html is None:
+            start = time.time()
+            html = h.html.literal(h.really_unicode(render()))
+            self.stats['seconds'] += time.time() - start
+            self.set(key, html)
+        return html
+
+    def get(self, key):
+        from allura.model.repo import DiffCacheDoc
+        if not self.max_entries:
+            return None
+        doc = DiffCacheDoc.m.find(
+            dict(_id=key), fields=['html', 'last_used'], validate=False).first()
+        if doc is None:
+            self.stats['misses'] += 1
+            log.debug('Diff cache miss for %s', key)
+            return None
+        self.stats['hits'] += 1
+        log.debug('Diff cache hit for %s', key)
+        now = datetime.utcnow()
+        if doc.last_used is None or doc.last_used < now - self.touch_interval:
+            DiffCacheDoc.m.update_partial(
+                dict(_id=key), {'$set': dict(last_used=now)})
+        return h.html.literal(h.really_unicode(zlib.decompress(doc.html)))
+
+    def set(self, key, html):
+        self._store(key, zlib.compress(h.really_unicode(html).encode('utf-8')))
+
+    def stream(self, key, chunks):
+        '''Yield the chunks of a diff's html as they are rendered, caching
+        the whole diff at the end unless it got too large'''
+        max_size = asint(config.get('scm.diff_cache.max_size', 1 << 20))
+        compressor = zlib.compressobj()
+        data, size = [], 0
+        start = time.time()
+        for chunk in chunks:
+            if isinstance(chunk, unicode):
+                chunk = chunk.encode('utf-8')
+            yield chunk
+            if data is not None:
+                data.append(compressor.compress(chunk))
+                size += len(data[-1])
+                if size > max_size:
+                    data = None
+        self.stats['seconds'] += time.time() - start
+        if data is None:
+            self.stats['too large'] += 1
+        else:
+            data.append(compressor.flush())
+            self._store(key, ''.join(data))
+
+    def _store(self, key, data):
+        from allura.model.repo import DiffCacheDoc
+        max_entries = self.max_entries
+        if not max_entries:
+            return
+        if len(data) > asint(config.get('scm.diff_cache.max_size', 1 << 20)):
+            self.stats['too large'] += 1
+            return
+        DiffCacheDoc(dict(
+                _id=key,
+                html=bson.Binary(data),
+                last_used=datetime.utcnow())).m.save()
+        self.stats['stores'] += 1
+        self._unchecked_stores += 1
+        if self._unchecked_stores < min(self.evict_every, max(max_entries // 10, 1)):
+            return
+        self._unchecked_stores = 0
+        extra = DiffCacheDoc.m.count() - max_entries
+        if extra > 0:
+            oldest = DiffCacheDoc.m.find({}, fields=['_id']).sort(
+                'last_used', 1).limit(extra + max_entries // 10)
+            ids = [doc._id for doc in oldest]
+            DiffCacheDoc.m.remove({'_id': {'$in': ids}})
+            self.stats['evictions'] += len(ids)
+
+diff_cache = DiffCache()
@@ -16,8 +16,12 @@
 #       under the License.
 
 import re
+import time
 import logging
 import smtplib
+import threading
+from contextlib import contextmanager
+from collections import defaultdict, namedtuple
 import email.feedparser
 from email.MIMEMultipart import MIMEMultipart
 from email.MIMEText import MIMEText
@@ -26,6 +30,8 @@
 import tg
 from paste.deploy.converters import asbool, asint
 from formencode import validators as fev
+from bson import ObjectId
+from ming.base import Object
 from pylons import tmpl_context as c
 
 from allura.lib.utils import ConfigProxy
@@ -178,11 +184,26 @@ def isvalid(addr):
         return False
 
 class SMTPClient(object):
+    '''Sends mail over a pool of persistent SMTP connections.
+
+    Up to smtp_pool_size (default 2) idle connections are kept open.  Each is
+    used for up to smtp_max_messages (default 100) messages, and is closed
+    once it has been idle for more than smtp_idle_timeout seconds (default
+    60).  If sending fails the connection is replaced and the message sent
+    again once.
+
+    Use ``with client.connection() as conn:`` to send several messages over
+    one connection; stats counts messages, connections and seconds spent
+    sending.
+    '''
 
     def __init__(self):
-        self._client = None
+        self._idle = []
+        self._lock = threading.Lock()
+        self.stats = defaultdict(float)
 
-    def sendmail(self, addrs, fromaddr, reply_to, subject, message_id, in_reply_to, message, sender=None):
+    def sendmail(self, addrs, fromaddr, reply_to, subject, message_id, in_reply_to, message, sender=None,
+                 connection=None):
         if not addrs: return
         # We send one message with multiple envelope recipients, so use a generic To: addr
         # It might be nice to refactor to send one message per recipient, and use the actual To: addr
@@ -205,17 +226,74 @@ def sendmail(self, addrs, fromaddr, reply_to, subject, message_id, in_reply_to,
             log.warning('No valid addrs in %s, so not sending mail',
                         map(unicode, addrs))
             return
+        if connection is None:
+            with self.connection() as connection:
+                return self._send(connection, smtp_addrs, content, message_id)
+        return self._send(connection, smtp_addrs, content, message_id)
+
+    @contextmanager
+    def connection(self):
+        '''Check out a connection, returning it to the pool afterwards
+        unless sending failed'''
+        conn = self._checkout()
+        try:
+            yield conn
+        except:
+            self._close(conn)
+            raise
+        self._checkin(conn)
+
+    def close(self):
+        '''Close all idle connections'''
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            self._close(conn)
+
+    def _send(self, conn, smtp_addrs, content, message_id):
+        start = time.time()
         try:
-            self._client.sendmail(
-                config.return_path,
-                smtp_addrs,
-                content)
+            conn.client.sendmail(config.return_path, smtp_addrs, content)
         except:
-            self._connect()
-            self._client.sendmail(
-                config.return_path,
-                smtp_addrs,
-                content)
+            self._close(conn)
+            conn.client = self._connect()
+            conn.sent = 0
+            self.stats['connections'] += 1
+            conn.client.sendmail(config.return_path, smtp_addrs, content)
+        elapsed = time.time() - start
+        conn.sent += 1
+        self.stats['messages'] += 1
+        self.stats['seconds'] += elapsed
+        log.debug('Sent message %s to %s recipients in %.3fs', message_id, len(smtp_addrs), elapsed)
+
+    def _checkout(self):
+        now = time.time()
+        idle_timeout = float(tg.config.get('smtp_idle_timeout', 60))
+        while True:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            if conn is None:
+                break
+            if now - conn.last_used <= idle_timeout:
+                return conn
+            self._close(conn)
+        self.stats['connections'] += 1
+        return _SMTPConnection(self._connect())
+
+    def _checkin(self, conn):
+        conn.last_used = time.time()
+        if conn.sent < asint(tg.config.get('smtp_max_messages', 100)):
+            with self._lock:
+                if len(self._idle) < asint(tg.config.get('smtp_pool_size', 2)):
+                    self._idle.append(conn)
+                    return
+        self._close(conn)
+
+    def _close(self, conn):
+        try:
+            conn.client.quit()
+        except:
+            pass
 
     def _connect(self):
         if asbool(tg.config.get('smtp_ssl', False)):
@@ -234,4 +312,116 @@ def _connect(self):
             smtp_client.login(tg.config['smtp_user'], tg.config['smtp_password'])
         if asbool(tg.config.get('smtp_tls', False)):
             smtp_client.starttls()
-        self._client = smtp_client
+        return smtp_client
+
+class _SMTPConnection(object):
+
+    def __init__(self, client):
+        self.client = client
+        self.sent = 0
+        self.last_used = time.time()
+
+
+Recipient = namedtuple('Recipient', 'address email_format')
+
+class RecipientResolver(object):
+    '''Looks up the addresses and email formats of the users mail is sent
+    to, loading all of them with one query.
+
+    With the local preferences provider only the fields preferences come from
+    are loaded.  Results (including users that are missing or disabled) are
+    remembered for mail.recipient_cache_ttl seconds (default 60, 0 disables
+    this).
+    '''
+    fields = ['display_name', 'email_addresses', 'preferences']
+
+    def __init__(self):
+        self._cache = {}
+
+    def clear(self):
+        self._cache = {}
+
+    def resolve(self, user_ids):
+        '''Return a dict of user id strings to a :class:`Recipient`, or None
+        for users that can't be sent mail'''
+        ttl = float(tg.config.get('mail.recipient_cache_ttl', 60))
+        now = time.time()
+        result = {}
+        for user_id in user_ids:
+            expires, recipient = self._cache.get(user_id, (0, None))
+            if expires > now:
+                result[user_id] = recipient
+        missing = [user_id for user_id in user_ids if user_id not in result]
+        if missing:
+            loaded = self._load(missing)
+            if len(self._cache) > asint(tg.config.get('mail.recipient_cache_size', 10000)):
+                self._cache = dict((k, v) for k, v in self._cache.iteritems() if v[0] > now)
+            for user_id in missing:
+                result[user_id] = loaded.get(user_id)
+                if ttl:
+                    self._cache[user_id] = (now + ttl, result[user_id])
+        return result
+
+    def partition(self, user_ids):
+        '''Return the addresses of user_ids preferring plain text, html and
+        multipart mail'''
+        plain, html, multi = [], [], []
+        recipients = self.resolve(user_ids)
+        for user_id in user_ids:
+            recipient = recipients[user_id]
+            if recipient is None:
+                continue
+            if recipient.email_format == 'plain':
+                plain.append(recipient.address)
+            elif recipient.email_format == 'html':
+                html.append(recipient.address)
+            else:
+                multi.append(recipient.address)
+        return plain, html, multi
+
+    def _load(self, user_ids):
+        from allura import model as M
+        from allura.lib import plugin
+        ids = {}
+        for user_id in user_ids:
+            try:
+                ids[ObjectId(user_id)] = user_id
+            except Exception:
+                log.exception('Error looking up user with ID: %r' % user_id)
+        spec = dict(_id={'$in': ids.keys()}, disabled=False)
+        provider = plugin.UserPreferencesProvider.get()
+        if type(provider) is plugin.LocalUserPreferencesProvider:
+            users = map(self._user, M.User.query.mapper.collection.m.find(
+                spec, fields=self.fields, validate=False))
+        else:
+            users = M.User.query.find(spec)
+        result = {}
+        for user in users:
+            result[ids[user._id]] = self._recipient(provider, user)
+        for user_id in set(ids.values()) - set(result):
+            log.warning('Cannot find user with ID: %s', user_id)
+        return result
+
+    def _user(self, doc):
+        '''Make a user-like object with just the fields the local preferences
+        provider needs from a user document'''
+        preferences = Object(email_address=None, email_format=None)
+        preferences.update(doc.get('preferences') or {})
+        return Object(
+            _id=doc['_id'],
+            display_name=doc.get('display_name'),
+            email_addresses=doc.get('email_addresses') or [],
+            preferences=preferences)
+
+    def _recipient(self, provider, user):
+        addr = provider.get_pref(user, 'email_address')
+        if addr:
+            addr = Header(u'"%s" ' % provider.get_pref(user, 'display_name'), u'<%s>' % addr)
+        elif user.email_addresses:
+            addr = user.email_addresses[0]
+            log.warning('User %s has not set primary email address, using %s',
+                        user._id, addr)
+        else:
+            log.error("User %s has not set any email address, can't deliver", user._id)
+            return None
+        return Recipient(addr, provider.get_pref(user, 'email_format'))
@@ -17,6 +17,8 @@
 
 import re
 import socket
+from collections import OrderedDict
+from hashlib import md5
 from logging import getLogger
 from urllib import urlencode
 from itertools import imap
@@ -42,12 +44,137 @@ def solarize(obj):
     if not doc.get('text'):
         doc['text'] = ''
     # Convert text to plain text (It usually contains markdown markup).
-    # To do so, we convert markdown into html, and then strip all html tags.
-    text = doc['text']
-    text = g.markdown.convert(text)
-    doc['text'] = jinja2.Markup.escape(text).striptags()
+    doc['text'] = markdown_to_text(doc['text'])
     return doc
 
+# Patterns used by markdown_to_text, applied in order.  An unclosed construct
+# must only be scanned up to the next opening of the same kind (or the end of
+# the line), so that text full of stray markup still takes linear time.
+_md_text_patterns = [(re.compile(p, flags), repl) for p, flags, repl in [
+    # script & style content is never text
+    (r'<(script|style)\b(?:(?!<\1\b).)*?</\1\s*>', re.I | re.S, ''),
+    (r'<!--(?:(?!<!--).)*?-->', re.S, ''),
+    # macros
+    (r'\[\[[^\]\[]+\]\]', 0, ''),
+    # markers of unclosed code fences and code highlighting hints
+    (r'^\s*(~~~+|```+).*$', re.M, ''),
+    (r'^[ \t]*:::\w+[ \t]*$', re.M, ''),
+    # reference link definitions
+    (r'^[ ]{0,3}\[[^\]]+\]:\s+\S+.*$', re.M, ''),
+    # headers, setext underlines, rules, blockquotes and list markers
+    (r'^[ \t]*#{1,6}[ \t]*|[ \t]+#+[ \t]*$', re.M, ''),
+    (r'^[ \t]*([=*_-][ \t]*){3,}$', re.M, ''),
+    (r'^[ \t]*(>[ \t]?)+', re.M, ''),
+    (r'^[ \t]*([*+-]|\d+\.)[ \t]+', re.M, ''),
+    # images and links keep their text
+    (r'!?\[([^\[\]]*)\]\([^()]*\)', 0, r'\1'),
+    (r'!?\[([^\[\]]*)\]\[[^\[\]]*\]', 0, r'\1'),
+    (r'<((?:https?|ftp|mailto):[^>\s]+)>', 0, r'\1'),
+    # html tags
+    (r'</?[A-Za-z][^<>]*>', 0, ''),
+    # emphasis and inline code, within a line
+    (r'(\*\*|__)(?=\S)((?:(?!\1)[^\n])+?)(?<=\S)\1', 0, r'\2'),
+    (r'(?<!\w)([*_])(?=\S)((?:(?!\1)[^\n])+?)(?<=\S)\1(?!\w)', 0, r'\2'),
+    (r'(`+)[ \t]*((?:(?!\1)[^\n])*?)[ \t]*\1', 0, r'\2'),
+    # table pipes
+    (r'^\|?([ \t]*:?-+:?[ \t]*\|)+[ \t]*:?-*:?[ \t]*$', re.M, ''),
+    (r'[ \t]*\|[ \t]*', 0, ' '),
+]]
+# backslash escaped characters are swapped for private use code points while
+# the patterns above are applied, so they aren't mistaken for markup
+_md_escape_re = re.compile(r'\\([\\`*_{}\[\]()#+.!|-])')
+_md_unescape_re = re.compile(u'[\ue000-\ue07f]')
+# code blocks are set aside the same way, as their text is kept verbatim
+_md_code_fence_re = re.compile(r'^[ \t]*(~~~+|```+)')
+_md_indented_re = re.compile(r'^( {4}|\t)')
+_md_code_hint_re = re.compile(r'^[ \t]*:::\w+[ \t]*$')
+_md_list_item_re = re.compile(r'^[ \t]*([*+-]|\d+\.)[ \t]+')
+_md_code_ref_re = re.compile(u'\ue080(\\d+)\ue081')
+
+_md_text_cache = OrderedDict()
+_md_text_cache_size = 1000
+
+def markdown_to_text(text):
+    '''Extract the plain text from markdown, for search indexing.
+
+    This is much cheaper than rendering the markdown with g.markdown and
+    stripping the tags: macros, artifact links and code highlighting are
+    skipped entirely and no database lookups are made.  Results are cached
+    by the md5 of the text.
+    '''
+    if not text:
+        return u''
+    if isinstance(text, unicode):
+        key = md5(text.encode('utf-8')).digest()
+    else:
+        key = md5(text).digest()
+    result = _md_text_cache.pop(key, None)
+    if result is None:
+        result = h.really_unicode(text)
+        code = []
+        result = _md_stash_code(result, code)
+        result = _md_escape_re.sub(lambda m: unichr(0xe000 + ord(m.group(1))), result)
+        for pattern, repl in _md_text_patterns:
+            result = pattern.sub(repl, result)
+        result = _md_unescape_re.sub(lambda m: unichr(ord(m.group(0)) - 0xe000), result)
+        result = _md_code_ref_re.sub(lambda m: code[int(m.group(1))], result)
+        result = jinja2.Markup(u' '.join(result.split())).unescape()
+        if len(_md_text_cache) >= _md_text_cache_size:
+            _md_text_cache.popitem(last=False)
+    _md_text_cache[key] = result
+    return result
+
+def _md_stash_code(text, code):
+    '''Replace fenced and indented code blocks in `text` with placeholders,
+    appending their contents to `code`.'''
+    # the placeholder delimiters can't be trusted if they're in the input
+    text = text.replace(u'\ue080', u'').replace(u'\ue081', u'')
+    lines = text.split('\n')
+    result = []
+    unclosed = set()  # fences with no closing line after them
+    blank = True  # previous line was blank
+    prev = None  # last non-blank line
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        match = _md_code_fence_re.match(line)
+        indented = _md_indented_re.match(line) and line.strip()
+        end = None
+        if match and match.group(1) not in unclosed:
+            fence = match.group(1)
+            for j in xrange(i + 1, len(lines)):
+                match = _md_code_fence_re.match(lines[j])
+                if match and match.group(1) == fence:
+                    result.append(_md_code_ref(code, lines[i + 1:j]))
+                    end = j
+                    break
+            else:
+                unclosed.add(fence)
+        elif indented and blank and not (prev and (
+                _md_indented_re.match(prev) or _md_list_item_re.match(prev))):
+            # indented code runs up to the next non-blank unindented line
+            end = i
+            for j in xrange(i + 1, len(lines)):
+                if _md_indented_re.match(lines[j]) and lines[j].strip():
+                    end = j
+                elif lines[j].strip():
+                    break
+            result.append(_md_code_ref(code, lines[i:end + 1]))
+        if end is None:
+            result.append(line)
+            end = i
+        blank = not lines[end].strip()
+        if not blank:
+            prev = lines[end]
+        i = end + 1
+    return u'\n'.join(result)
+
+def _md_code_ref(code, lines):
+    if lines and _md_code_hint_re.match(lines[0]):
+        lines = lines[1:]
+    code.append(u'\n'.join(lines))
+    return u'\ue080%d\ue081' % (len(code) - 1)
+
 class SearchError(SolrError):
     pass
 
@@ -70,9 +197,11 @@ def search(q,short_timeout=False,ignore_errors=True,**kw):
             match = re.search(r'<pre>(.*)</pre>', str(e))
             raise SearchError('Error running search query: %s' % (match.group(1) if match else e))
 
-def search_artifact(atype, q, history=False, rows=10, short_timeout=False, **kw):
+def search_artifact(atype, q, history=False, rows=10, short_timeout=False, fq=None, **kw):
     """Performs SOLR search.
 
+    Additional filter queries can be given in fq.
+
     Raises SearchError if SOLR returns an error.
     """
     # first, grab an artifact and get the fields that it indexes
@@ -84,7 +213,7 @@ def search_artifact(atype, q, history=False, rows=10, short_timeout=False, **kw)
     fq = [
         'type_s:%s' % fields['type_s'],
         'project_id_s:%s' % c.project._id,
-        'mount_point_s:%s' % c.app.config.options.mount_point ]
+        'mount_point_s:%s' % c.app.config.options.mount_point ] + (fq or [])
     if not history:
         fq.append('is_history_b:False')
     return search(q, fq=fq, rows=rows, short_timeout=short_timeout, ignore_errors=False, **kw)
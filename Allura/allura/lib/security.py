@@ -19,10 +19,13 @@
 This module provides the security predicates used in decorating various models.
 """
 import logging
-from collections import defaultdict
+import threading
+from collections import defaultdict, OrderedDict
 
 from pylons import tmpl_context as c
 from pylons import request
+from tg import config
+from paste.deploy.converters import asint
 from webob import exc
 from itertools import chain
 from ming.utils import LazyProperty
@@ -55,6 +58,17 @@ def clear(self):
         'clear cache'
         self.users = {}
         self.projects = {}
+        self.clear_access()
+
+    def clear_access(self):
+        'clear memoized has_access results'
+        self.access = {}
+        self.access_hits = 0
+        self.access_misses = 0
+        # see _acl_fingerprint and _security_project
+        self.fingerprints = {}
+        self.security_projects = {}
+        self.neighborhoods = {}
 
     def clear_user(self, user_id, project_id=None):
         if project_id == '*':
@@ -64,6 +78,7 @@ def clear_user(self, user_id, project_id=None):
         for uid, pid in to_remove:
             self.projects.pop(pid, None)
             self.users.pop((uid, pid), None)
+        self.access = {}
 
     def load_user_roles(self, user_id, *project_ids):
         '''Load the credentials with all user roles for a set of projects'''
@@ -240,6 +255,114 @@ def reaching_ids(self):
     def reaching_ids_set(self):
         return set(self.reaching_ids)
 
+# has_access results shared between requests, see _access_key
+_shared_access = OrderedDict()
+_shared_access_lock = threading.Lock()
+
+def _shared_access_size():
+    return asint(config.get('security.access_cache_size', 0))
+
+def _security_project(obj, cred=None):
+    '''The project whose roles are used for access checks on obj.
+
+    Given the request's credentials, the project of an artifact is only
+    looked up once per app config.'''
+    from allura import model as M
+    if isinstance(obj, M.Neighborhood):
+        return obj.neighborhood_project
+    elif isinstance(obj, M.Project):
+        return obj.root_project
+    app_config_id = getattr(obj, 'app_config_id', None)
+    if cred is not None and app_config_id is not None:
+        project = cred.security_projects.get(app_config_id)
+        if project is None:
+            project = getattr(obj, 'project', None) or c.project
+            project = cred.security_projects[app_config_id] = project.root_project
+        return project
+    project = getattr(obj, 'project', None) or c.project
+    return project.root_project
+
+def _parent_key(obj):
+    '''The (class, _id) of obj's parent security context, if it can be told
+    without loading the parent'''
+    from allura import model as M
+    if isinstance(obj, M.Project) and not obj.is_root:
+        return (M.Project, obj.parent_id)
+    if (isinstance(obj, M.Artifact) and
+            type(obj).parent_security_context.im_func is
+            M.Artifact.parent_security_context.im_func):
+        return (M.AppConfig, obj.app_config_id)
+    return None
+
+def _acl_fingerprint(obj, fingerprints=None):
+    '''The content of every ACL consulted for obj, up its parent contexts.
+
+    Given a dict of fingerprints (the request's Credentials.fingerprints),
+    those of the parent contexts that many objects share (app configs and
+    parent projects) are kept in it by their (class, _id), so that once it
+    is warm only obj's own ACL is read.
+    '''
+    own = tuple((ace.access, ace.role_id, ace.permission) for ace in obj.acl)
+    key = _parent_key(obj) if fingerprints is not None else None
+    result = fingerprints.get(key) if key is not None else None
+    if result is None:
+        parent = obj.parent_security_context()
+        result = _acl_fingerprint(parent, fingerprints) if parent else ()
+        if key is not None:
+            fingerprints[key] = result
+    return (own,) + result
+
+def _context_fingerprint(cred, cls, _id, load):
+    '''The fingerprint of the context of class cls with _id, which is
+    loaded with load() only if it isn't known yet in this request'''
+    key = (cls, _id)
+    result = cred.fingerprints.get(key)
+    if result is None:
+        obj = load()
+        result = cred.fingerprints[key] = (
+            _acl_fingerprint(obj, cred.fingerprints) if obj else ())
+    return result
+
+def _access_key(cred, obj, permission, user, project, roles, shared=False):
+    '''Memo key for a top-level has_access check.
+
+    The key is built from what the check actually reads: the ACLs of obj and
+    its parent contexts, of the project and of its neighborhood (for the
+    implicit admin checks), the user's roles and the permission.  Objects
+    that share all of those (e.g. the tickets of one tracker) share an entry,
+    and changing obj's own ACL changes the key rather than requiring
+    invalidation.
+
+    Building the key makes no queries once the request has seen the
+    contexts involved: the ACLs of app configs, projects and neighborhoods
+    are fixed for a request, like the user's roles, and their fingerprints
+    are kept on the credentials (see :func:`_acl_fingerprint`).
+
+    Entries shared between requests also record the user's roles in the
+    neighborhood project, which are otherwise only fixed for a request.
+    '''
+    from allura import model as M
+    key = (permission, user._id, project._id, tuple(roles),
+           isinstance(obj, M.Neighborhood), isinstance(obj, M.Project),
+           _acl_fingerprint(obj, cred.fingerprints),
+           _context_fingerprint(cred, M.Project, project._id, lambda: project),
+           _context_fingerprint(cred, M.Neighborhood, project.neighborhood_id,
+                                lambda: _neighborhood(cred, project)))
+    if shared:
+        nbhd = _neighborhood(cred, project)
+        if nbhd and nbhd.neighborhood_project:
+            nbhd_roles = cred.user_roles(
+                user_id=user._id, project_id=nbhd.neighborhood_project._id)
+            key += (tuple(nbhd_roles.reaching_ids),)
+    return key
+
+def _neighborhood(cred, project):
+    try:
+        return cred.neighborhoods[project.neighborhood_id]
+    except KeyError:
+        nbhd = cred.neighborhoods[project.neighborhood_id] = project.neighborhood
+        return nbhd
+
 def has_access(obj, permission, user=None, project=None):
     '''Return whether the given user has the permission name on the given object.
 
@@ -278,6 +401,10 @@ def has_access(obj, permission, user=None, project=None):
          traversal of the ACLs, then access is allowed.
 
       3. Otherwise, DENY access to the resource.
+
+    Results of top-level checks are memoized on the request's
+    :class:`Credentials` (and, if ``security.access_cache_size`` is set,
+    in an LRU shared between requests); see :func:`_access_key`.
     '''
     from allura import model as M
     def predicate(obj=obj, user=user, project=project, roles=None):
@@ -288,18 +415,33 @@ def predicate(obj=obj, user=user, project=project, roles=None):
             assert user, 'c.user should always be at least M.User.anonymous()'
             cred = Credentials.get()
             if project is None:
-                if isinstance(obj, M.Neighborhood):
-                    project = obj.neighborhood_project
-                    if project is None:
-                        log.error('Neighborhood project missing for %s', obj)
-                        return False
-                elif isinstance(obj, M.Project):
-                    project = obj.root_project
-                else:
-                    project = getattr(obj, 'project', None) or c.project
-                    project = project.root_project
+                project = _security_project(obj, cred)
+                if project is None:
+                    log.error('Neighborhood project missing for %s', obj)
+                    return False
             roles = cred.user_roles(user_id=user._id, project_id=project._id).reaching_ids
-
+            shared = _shared_access_size()
+            key = _access_key(cred, obj, permission, user, project, roles, shared)
+            result = cred.access.get(key)
+            if result is None and shared:
+                with _shared_access_lock:
+                    result = _shared_access.pop(key, None)
+                    if result is not None:
+                        _shared_access[key] = cred.access[key] = result
+            if result is not None:
+                cred.access_hits += 1
+                return result
+            cred.access_misses += 1
+            result = cred.access[key] = check(obj, user, project, roles)
+            if shared:
+                with _shared_access_lock:
+                    _shared_access[key] = result
+                    while len(_shared_access) > shared:
+                        _shared_access.popitem(last=False)
+            return result
+        return check(obj, user, project, roles)
+
+    def check(obj, user, project, roles):
         # TODO: move deny logic into loop below; see ticket [#6715]
         if user != M.User.anonymous():
             user_roles = Credentials.get().user_roles(user_id=user._id,
@@ -337,6 +479,38 @@ def predicate(obj=obj, user=user, project=project, roles=None):
         return result
     return TruthyCallable(predicate)
 
+def filter_readable(objects, permission='read', user=None, project=None):
+    '''Return the objects (in order) on which the given user has the
+    permission.
+
+    This is the same as filtering with :func:`has_access`, but the check is
+    made only once for each distinct set of ACLs (those of the object and its
+    parent contexts), so e.g. all the public tickets of a tracker cost a
+    single check.  The project and parent contexts are looked up once per
+    app config (see :func:`_acl_fingerprint`), so each further object only
+    has its own ACL read.
+    '''
+    from allura import model as M
+    cred = Credentials.get()
+    results = {}
+    allowed = []
+    for obj in objects:
+        if obj is None:
+            continue
+        obj_project = project or _security_project(obj, cred)
+        if obj_project is None:
+            continue
+        key = (obj_project._id,
+               isinstance(obj, M.Neighborhood), isinstance(obj, M.Project),
+               _acl_fingerprint(obj, cred.fingerprints))
+        result = results.get(key)
+        if result is None:
+            result = results[key] = has_access(
+                obj, permission, user=user, project=obj_project)()
+        if result:
+            allowed.append(obj)
+    return allowed
+
 def all_allowed(obj, user_or_role=None, project=None):
     '''
     List all the permission names that a given user or named role
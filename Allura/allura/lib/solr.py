@@ -15,11 +15,28 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+import os
+import re
 import shlex
+import time
+import fcntl
+import cPickle
+import logging
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from fnmatch import fnmatch
+from multiprocessing.pool import ThreadPool
+from multiprocessing import TimeoutError
 
 from tg import config
-from paste.deploy.converters import asbool
+from paste.deploy.converters import asbool, asint
 import pysolr
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
+
+log = logging.getLogger(__name__)
 
 
 def make_solr_from_config(push_servers, query_server=None, **kwargs):
@@ -31,7 +48,12 @@ def make_solr_from_config(push_servers, query_server=None, **kwargs):
         commit=asbool(config.get('solr.commit', True)),
         commitWithin=config.get('solr.commitWithin'),
         timeout=int(config.get('solr.long_timeout', 60)),
+        push_timeout=asint(config.get('solr.push_timeout', 0)) or None,
+        retries=asint(config.get('solr.push_retries', 2)),
+        backoff=float(config.get('solr.push_backoff', 0.5)),
     )
+    if asbool(config.get('solr.journal', True)):
+        solr_kwargs['journal'] = MongoSolrJournal()
     solr_kwargs.update(kwargs)
     return Solr(push_servers, query_server, **solr_kwargs)
 
@@ -45,45 +67,222 @@ class Solr(object):
     Also, accepts default values for `commit` and `commitWithin`
     and passes those values through to each `add` and `delete` call,
     unless explicitly overridden.
+
+    Updates are pushed to all servers concurrently.  Each push is retried
+    `retries` times, waiting `backoff` seconds (doubling each time) in
+    between, and gives up after `push_timeout` seconds.  If a `journal` is
+    given, updates for a server that failed are recorded there, so that one
+    replica being down doesn't fail the update as long as another replica got
+    it.  Later updates for that server are journaled behind them until the
+    journal has been replayed, which is tried every `replay_interval`
+    seconds.
     """
 
+    # seconds between attempts to replay journaled updates to a server
+    replay_interval = 30
+
     def __init__(self, push_servers, query_server=None,
-                 commit=True, commitWithin=None, **kw):
-        self.push_pool = [pysolr.Solr(s, **kw) for s in push_servers]
+                 commit=True, commitWithin=None, push_timeout=None,
+                 retries=0, backoff=0.5, journal=None, **kw):
+        self.push_servers = list(push_servers)
+        push_kw = dict(kw)
+        if push_timeout:
+            # bound each request, so that a hung server can't keep a push
+            # (and its pool thread) going past push_timeout
+            push_kw['timeout'] = min(
+                kw.get('timeout', 60), float(push_timeout) / (retries + 1))
+        self.push_pool = [pysolr.Solr(s, **push_kw) for s in push_servers]
         if query_server:
             self.query_server = pysolr.Solr(query_server, **kw)
         else:
             self.query_server = self.push_pool[0]
         self._commit = commit
         self.commitWithin = commitWithin
+        self.push_timeout = push_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.journal = journal
+        self._next_replay = {}
+        self._thread_pool = None
+        self._pool_lock = threading.Lock()
 
     def add(self, *args, **kw):
         if 'commit' not in kw:
             kw['commit'] = self._commit
         if self.commitWithin and 'commitWithin' not in kw:
             kw['commitWithin'] = self.commitWithin
-        responses = []
-        for solr in self.push_pool:
-            responses.append(solr.add(*args, **kw))
-        return responses
+        return self._push('add', args, kw)
 
     def delete(self, *args, **kw):
         if 'commit' not in kw:
             kw['commit'] = self._commit
-        responses = []
-        for solr in self.push_pool:
-            responses.append(solr.delete(*args, **kw))
-        return responses
+        return self._push('delete', args, kw)
 
     def commit(self, *args, **kw):
-        responses = []
-        for solr in self.push_pool:
-            responses.append(solr.commit(*args, **kw))
-        return responses
+        return self._push('commit', args, kw)
 
     def search(self, *args, **kw):
         return self.query_server.search(*args, **kw)
 
+    def _push(self, method, args, kw):
+        """Call `method` on every push server and return the responses,
+        journaling the update for servers that failed if possible."""
+        if len(self.push_pool) == 1 and not self.journal:
+            return [self._call(self.push_pool[0], method, args, kw)]
+        with self._pool_lock:
+            if self._thread_pool is None:
+                self._thread_pool = ThreadPool(len(self.push_pool))
+            pool = self._thread_pool
+            results = [
+                pool.apply_async(self._push_one, (server, solr, method, args, kw))
+                for server, solr in zip(self.push_servers, self.push_pool)]
+        responses = []
+        errors = []
+        deadline = self.push_timeout and time.time() + self.push_timeout
+        for server, result in zip(self.push_servers, results):
+            try:
+                if deadline:
+                    timeout = max(deadline - time.time(), 0)
+                    responses.append(result.get(timeout))
+                else:
+                    responses.append(result.get())
+            except Exception as e:
+                if isinstance(e, TimeoutError):
+                    e = TimeoutError('Timed out pushing to %s' % server)
+                    self._replace_pool(pool)
+                log.warning('Error in solr %s on %s: %r', method, server, e)
+                responses.append(None)
+                errors.append((server, e))
+        if errors:
+            if not self.journal or len(errors) == len(self.push_pool):
+                raise errors[0][1]
+            for server, e in errors:
+                self.journal.record(server, method, args, kw)
+        return responses
+
+    def _replace_pool(self, pool):
+        """Stop using `pool`, one of whose threads is stuck in a push, so that
+        the next pushes aren't queued behind it."""
+        with self._pool_lock:
+            if self._thread_pool is pool:
+                self._thread_pool = None
+                pool.close()
+
+    def _push_one(self, server, solr, method, args, kw):
+        if self.journal and self.journal.pending(server):
+            # while updates are journaled for the server, journal this one
+            # too, so that it can't overtake them
+            self.journal.record(server, method, args, kw)
+            if self._next_replay.get(server, 0) <= time.time():
+                self._next_replay[server] = time.time() + self.replay_interval
+                self.replay(server, solr)
+            return None
+        return self._call(solr, method, args, kw)
+
+    def _call(self, solr, method, args, kw):
+        """Call `method` on one server, retrying with backoff"""
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            try:
+                return getattr(solr, method)(*args, **kw)
+            except Exception:
+                if attempt == self.retries:
+                    raise
+                time.sleep(delay)
+                delay *= 2
+
+    def replay(self, server, solr=None):
+        """Replay journaled updates for `server`, oldest first.  Returns False
+        if an update could not be replayed.
+
+        Only one process at a time replays the journal of a server; if
+        another one already is, this returns True right away.
+        """
+        if solr is None:
+            solr = self.push_pool[self.push_servers.index(server)]
+        while self.journal.pending(server):
+            claim = self.journal.claim(server)
+            if not claim:
+                return True
+            try:
+                for entry in self.journal.entries(server):
+                    try:
+                        self._call(solr, entry['method'], entry['args'], entry['kw'])
+                    except Exception as e:
+                        log.warning('Error replaying solr journal on %s: %r', server, e)
+                        return False
+                    self.journal.remove(entry)
+                    if not self.journal.claim(server, claim):
+                        # took so long that another process took over
+                        return True
+            finally:
+                self.journal.release(server, claim)
+            # check again for updates journaled while we were finishing
+        log.info('Solr journal for %s replayed', server)
+        return True
+
+
+class MongoSolrJournal(object):
+    """Persistent record of updates that could not be pushed to a solr server.
+    """
+
+    # seconds a replay may go without progress before another process may
+    # take over
+    claim_timeout = 300
+
+    @property
+    def db(self):
+        from allura import model as M
+        return M.session.main_doc_session.db
+
+    @property
+    def collection(self):
+        return self.db['solr_journal']
+
+    def record(self, server, method, args, kw):
+        self.collection.ensure_index([('server', 1), ('seq', 1)])
+        # a counter rather than the ObjectId, which doesn't order inserts
+        # made in the same second by different processes
+        seq = self.db['solr_journal_state'].find_and_modify(
+            {'_id': 'seq'}, {'$inc': {'seq': 1}}, upsert=True, new=True)['seq']
+        self.collection.insert(dict(
+            server=server, seq=seq, method=method, args=list(args), kw=kw,
+            timestamp=datetime.utcnow()))
+
+    def pending(self, server):
+        return self.collection.find(dict(server=server)).limit(1).count(True)
+
+    def entries(self, server):
+        return self.collection.find(dict(server=server)).sort('seq')
+
+    def remove(self, entry):
+        self.collection.remove(dict(_id=entry['_id']))
+
+    def claim(self, server, owner=None):
+        """Claim (or renew the claim `owner` holds on) the replay of the
+        updates journaled for `server`.  Returns the claim, or None if
+        another replay holds it."""
+        owner = owner or str(ObjectId())
+        now = datetime.utcnow()
+        claim = {'_id': 'replay:' + server, 'owner': owner,
+                 'expires': now + timedelta(seconds=self.claim_timeout)}
+        state = self.db['solr_journal_state']
+        try:
+            state.insert(claim, safe=True)
+            return owner
+        except DuplicateKeyError:
+            pass
+        # held already: renew it if it's ours, or take it over if it expired
+        result = state.update(
+            {'_id': claim['_id'],
+             '$or': [{'owner': owner}, {'expires': {'$lt': now}}]},
+            claim, safe=True)
+        return owner if result['n'] else None
+
+    def release(self, server, owner):
+        self.db['solr_journal_state'].remove(
+            {'_id': 'replay:' + server, 'owner': owner})
+
 
 class MockSOLR(object):
 
@@ -126,14 +325,18 @@ def search(self, q, fq=None, **kw):
         for obj in self.db.values():
             for field, value in preds:
                 neg = False
-                if field[0] == '!':
+                if field[0] in '!-':
                     neg = True
                     field = field[1:]
                 if field == 'text' or field.endswith('_t'):
                     if (value not in str(obj.get(field, ''))) ^ neg:
                         break
                 else:
-                    if (value != str(obj.get(field, ''))) ^ neg:
+                    if value.startswith('(') and value.endswith(')'):
+                        values = value[1:-1].split(' OR ')
+                    else:
+                        values = [value]
+                    if (str(obj.get(field, '')) not in values) ^ neg:
                         break
             else:
                 result.append(obj)
@@ -147,3 +350,554 @@ def delete(self, *args, **kwargs):
         elif kwargs.get('q', None):
             for doc in self.search(kwargs['q']):
                 self.delete(id=doc['id'])
+
+
+class EmbeddedSOLR(object):
+    """In-process search engine implementing the parts of the :class:`Solr`
+    interface Allura uses, for small installations and test suites.
+
+    Documents are kept in memory with an inverted index per field.  Fields
+    are typed by their suffix like the dynamic fields of our solr schema:
+    ``_s`` (exact string), ``_i``/``_l`` (integer), ``_f``/``_d`` (float),
+    ``_b`` (boolean), ``_dt`` (date) and everything else (``text``,
+    ``title``, ``_t``, ...) as tokenized text.
+
+    Supports the Lucene query syntax subset Allura generates: terms,
+    ``"phrases"``, ``field:value``, ``field:(a OR b)``, ``[a TO b]`` ranges,
+    ``*`` wildcards, ``AND``/``OR``/``NOT``/``&&``/``||``, ``-``/``!``
+    negation and grouping, plus ``fq``, ``sort``, ``start``, ``rows``, ``fl``,
+    dismax ``qf`` boosts and basic highlighting.
+
+    If `path` is given, the index is saved there and can be shared by several
+    processes (web, taskd): updates are appended to a log under a file lock
+    and each process replays the updates of the others before using the
+    index.
+    """
+
+    class Results(list):
+        hits = 0
+        highlighting = None
+
+        @property
+        def docs(self):
+            return self
+
+    # fold the update log into the snapshot once it grows past this many
+    # bytes and past the size of the snapshot itself
+    compact_size = 1 << 20
+
+    def __init__(self, path=None):
+        self.path = path
+        self.log_path = path and path + '.log'
+        self.lock = threading.RLock()
+        # (inode, mtime, size) of the loaded snapshot, and how far into the
+        # update log we have read
+        self.snapshot = None
+        self.log_offset = 0
+        self._clear()
+        self._refresh()
+
+    def _clear(self):
+        self.docs = {}
+        # field -> token -> {doc id: term frequency}
+        self.postings = defaultdict(lambda: defaultdict(dict))
+        # field -> normalized value -> set of doc ids
+        self.values = defaultdict(lambda: defaultdict(set))
+
+    # Indexing
+
+    def add(self, docs, commit=True, commitWithin=None, **kw):
+        docs = [self._prepare(doc) for doc in docs]
+        with self._locked(exclusive=True):
+            self._write('add', docs)
+
+    def delete(self, id=None, q=None, commit=True, **kw):
+        with self._locked(exclusive=True):
+            if id is not None:
+                ids = [id]
+            elif q == '*:*':
+                ids = list(self.docs)
+            elif q:
+                ids = list(self._query(q))
+            else:
+                ids = []
+            self._write('delete', ids)
+
+    def commit(self, *args, **kw):
+        # updates are written to the log as they are made, so there is
+        # nothing to flush; just pick up those of other processes
+        self._refresh()
+
+    def _prepare(self, doc):
+        doc = dict(doc)
+        if isinstance(doc.get('text'), (list, tuple)):
+            doc['text'] = ''.join(doc['text'])
+        return doc
+
+    def _apply(self, op, arg):
+        if op == 'add':
+            for doc in arg:
+                self._unindex(doc['id'])
+                self._index(doc)
+        else:
+            for doc_id in arg:
+                self._unindex(doc_id)
+
+    # Persistence
+    #
+    # The index file holds a snapshot of all documents, and every update is
+    # appended to a log next to it under an exclusive lock.  Each process
+    # replays the log records it hasn't seen before reading or writing, and
+    # the log is folded into a new snapshot once it gets big, so writes cost
+    # O(1) amortized and no process overwrites another's updates.
+
+    @contextmanager
+    def _locked(self, exclusive=False):
+        """Hold the index lock and bring the index up to date with the files
+        on disk.  Writers take the file lock exclusively, readers shared."""
+        with self.lock:
+            if not self.path:
+                yield
+                return
+            with open(self.path + '.lock', 'a') as fp:
+                fcntl.flock(fp, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+                self._sync()
+                yield
+
+    def _refresh(self):
+        with self._locked():
+            pass
+
+    def _sync(self):
+        try:
+            st = os.stat(self.path)
+            snapshot = (st.st_ino, st.st_mtime, st.st_size)
+        except OSError:
+            snapshot = None
+        if snapshot != self.snapshot:
+            # first load, or another process compacted the log
+            self._clear()
+            if snapshot:
+                with open(self.path, 'rb') as fp:
+                    for doc in cPickle.load(fp):
+                        self._index(doc)
+            self.snapshot = snapshot
+            self.log_offset = 0
+        if not os.path.exists(self.log_path):
+            return
+        with open(self.log_path, 'rb') as fp:
+            fp.seek(self.log_offset)
+            while True:
+                try:
+                    op, arg = cPickle.load(fp)
+                except Exception:
+                    # end of the log, or a record cut short by a crash
+                    break
+                self._apply(op, arg)
+                self.log_offset = fp.tell()
+
+    def _write(self, op, arg):
+        if self.path:
+            self._append(op, arg)
+        self._apply(op, arg)
+        snapshot_size = self.snapshot[2] if self.snapshot else 0
+        if self.path and self.log_offset > max(self.compact_size, snapshot_size):
+            self._compact()
+
+    def _append(self, op, arg):
+        fd = os.open(self.log_path, os.O_RDWR | os.O_CREAT, 0644)
+        with os.fdopen(fd, 'r+b') as fp:
+            # drop any partial record left by a crashed writer
+            fp.truncate(self.log_offset)
+            fp.seek(self.log_offset)
+            cPickle.dump((op, arg), fp, cPickle.HIGHEST_PROTOCOL)
+            self.log_offset = fp.tell()
+
+    def _compact(self):
+        tmp = '%s.%s.tmp' % (self.path, os.getpid())
+        with open(tmp, 'wb') as fp:
+            cPickle.dump(self.docs.values(), fp, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, self.path)
+        # replaying the old log over the new snapshot would be harmless, so
+        # a crash before this truncate loses nothing
+        open(self.log_path, 'wb').close()
+        st = os.stat(self.path)
+        self.snapshot = (st.st_ino, st.st_mtime, st.st_size)
+        self.log_offset = 0
+
+    def _index(self, doc):
+        doc_id = doc['id']
+        self.docs[doc_id] = doc
+        for field, value in doc.iteritems():
+            for v in value if isinstance(value, (list, tuple)) else [value]:
+                if self._is_text(field):
+                    for token in self._tokenize(v):
+                        postings = self.postings[field][token]
+                        postings[doc_id] = postings.get(doc_id, 0) + 1
+                else:
+                    self.values[field][self._normalize(field, v)].add(doc_id)
+
+    def _unindex(self, doc_id):
+        doc = self.docs.pop(doc_id, None)
+        if doc is None:
+            return
+        for field, value in doc.iteritems():
+            for v in value if isinstance(value, (list, tuple)) else [value]:
+                if self._is_text(field):
+                    index = self.postings[field]
+                    for token in self._tokenize(v):
+                        index.get(token, {}).pop(doc_id, None)
+                        if token in index and not index[token]:
+                            del index[token]
+                else:
+                    index = self.values[field]
+                    key = self._normalize(field, v)
+                    index.get(key, set()).discard(doc_id)
+                    if key in index and not index[key]:
+                        del index[key]
+
+    def _field_type(self, field):
+        for suffix in ('_dt', '_s', '_i', '_l', '_f', '_d', '_b'):
+            if field.endswith(suffix):
+                return suffix
+        if field == 'id':
+            return '_s'
+        return '_t'
+
+    def _is_text(self, field):
+        return self._field_type(field) == '_t'
+
+    def _normalize(self, field, value):
+        typ = self._field_type(field)
+        try:
+            if typ == '_b':
+                if isinstance(value, basestring):
+                    return value.lower() == 'true'
+                return bool(value)
+            if typ == '_dt':
+                if isinstance(value, datetime):
+                    return value.strftime('%Y-%m-%dT%H:%M:%SZ')
+                return self._date_math(value)
+            if typ in ('_i', '_l'):
+                return int(value)
+            if typ in ('_f', '_d'):
+                return float(value)
+        except (TypeError, ValueError):
+            pass
+        return _unicode(value)
+
+    def _date_math(self, value):
+        '''Resolve NOW, NOW-7DAYS, etc. to an ISO date string'''
+        value = _unicode(value).upper()
+        if not value.startswith('NOW'):
+            return value
+        result = datetime.utcnow()
+        for sign, num, unit in re.findall(r'([+-])(\d+)([A-Z]+?)S?\b', value[3:]):
+            name, multiplier = self._date_units.get(unit, ('days', 1))
+            delta = timedelta(**{name: int(num) * multiplier})
+            result = result + delta if sign == '+' else result - delta
+        return result.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    _date_units = dict(
+        YEAR=('days', 365), MONTH=('days', 30), DAY=('days', 1),
+        HOUR=('hours', 1), MINUTE=('minutes', 1), SECOND=('seconds', 1))
+
+    @staticmethod
+    def _tokenize(value):
+        return _token_re.findall(_unicode(value).lower())
+
+    # Searching
+
+    def search(self, q, fq=None, sort=None, start=0, rows=10, fl=None, **kw):
+        self._refresh()
+        with self.lock:
+            weights = self._query_fields(kw)
+            matched = self._query(q or '*:*', weights)
+            if isinstance(fq, basestring):
+                fq = [fq]
+            for f in fq or []:
+                matched &= self._query(f)
+            scores = self._score(matched, q or '', weights)
+            ids = self._sort(matched, scores, sort or 'score desc')
+            result = self.Results()
+            result.hits = len(ids)
+            start, rows = int(start or 0), int(rows if rows is not None else 10)
+            for doc_id in ids[start:start + rows]:
+                doc = self.docs[doc_id]
+                if fl:
+                    names = [f.strip() for f in fl.split(',')] + ['id', 'score']
+                    doc = dict((k, v) for k, v in doc.iteritems() if k in names)
+                else:
+                    doc = dict(doc)
+                doc['score'] = scores.get(doc_id, 0)
+                result.append(doc)
+            if kw.get('hl') in (True, 'true', 'on'):
+                result.highlighting = self._highlight(result, q or '', kw)
+            else:
+                result.highlighting = {}
+            return result
+
+    def _query_fields(self, kw):
+        '''Default search fields and their boosts'''
+        if kw.get('qt') == 'dismax' and kw.get('qf'):
+            weights = {}
+            for spec in kw['qf'].split():
+                field, _, boost = spec.partition('^')
+                weights[field] = float(boost or 1)
+            return weights
+        return {'text': 1.0}
+
+    def _query(self, q, weights=None):
+        if isinstance(q, str):
+            q = q.decode('utf-8', 'replace')
+        parser = _QueryParser(self, q, weights or {'text': 1.0})
+        return parser.parse()
+
+    def _all_ids(self):
+        return set(self.docs)
+
+    def _match(self, field, kind, value, default_fields):
+        '''Set of ids of documents where field matches value'''
+        if field is None:
+            result = set()
+            for f in default_fields:
+                result |= self._match(f, kind, value, default_fields)
+            return result
+        if field == '*' and value == '*':
+            return self._all_ids()
+        if kind == 'range':
+            return self._match_range(field, value)
+        if self._is_text(field):
+            return self._match_text(field, kind, value)
+        index = self.values.get(field, {})
+        if value == '*':
+            result = set()
+            for ids in index.itervalues():
+                result |= ids
+            return result
+        if kind == 'word' and ('*' in value or '?' in value):
+            result = set()
+            for key, ids in index.iteritems():
+                if fnmatch(_unicode(key), value):
+                    result |= ids
+            return result
+        return set(index.get(self._normalize(field, value), ()))
+
+    def _match_text(self, field, kind, value):
+        index = self.postings.get(field, {})
+        if kind == 'word' and ('*' in value or '?' in value):
+            pattern = value.lower()
+            result = set()
+            for token, postings in index.iteritems():
+                if fnmatch(token, pattern):
+                    result.update(postings)
+            return result
+        tokens = self._tokenize(value)
+        if not tokens:
+            return set()
+        result = None
+        for token in tokens:
+            ids = set(index.get(token, ()))
+            result = ids if result is None else result & ids
+            if not result:
+                return set()
+        if kind == 'phrase' and len(tokens) > 1:
+            phrase = ' %s ' % ' '.join(tokens)
+            result = set(
+                doc_id for doc_id in result
+                if phrase in ' %s ' % ' '.join(
+                    self._tokenize(self.docs[doc_id].get(field, ''))))
+        return result
+
+    def _match_range(self, field, value):
+        inclusive_low, low, high, inclusive_high = value
+        if low != '*':
+            low = self._normalize(field, low)
+        if high != '*':
+            high = self._normalize(field, high)
+        result = set()
+        for key, ids in self.values.get(field, {}).iteritems():
+            if low != '*' and (key < low or (key == low and not inclusive_low)):
+                continue
+            if high != '*' and (key > high or (key == high and not inclusive_high)):
+                continue
+            result |= ids
+        return result
+
+    def _score(self, ids, q, weights):
+        terms = [t for t in self._tokenize(q) if t not in ('and', 'or', 'not')]
+        scores = {}
+        for doc_id in ids:
+            score = 0.0
+            for field, boost in weights.iteritems():
+                index = self.postings.get(field, {})
+                for term in terms:
+                    score += boost * index.get(term, {}).get(doc_id, 0)
+            scores[doc_id] = score
+        return scores
+
+    def _sort(self, ids, scores, sort):
+        ids = sorted(ids)
+        for spec in reversed(sort.split(',')):
+            parts = spec.split()
+            if not parts:
+                continue
+            field = parts[0]
+            reverse = len(parts) > 1 and parts[1].lower() == 'desc'
+            if field == 'score':
+                key = lambda doc_id: scores.get(doc_id, 0)
+            else:
+                def key(doc_id, field=field):
+                    value = self.docs[doc_id].get(field)
+                    if isinstance(value, (list, tuple)):
+                        value = value[0] if value else None
+                    if value is None:
+                        # missing values sort last either way
+                        return (not reverse, None)
+                    return (reverse, self._normalize(field, value))
+            ids.sort(key=key, reverse=reverse)
+        return ids
+
+    def _highlight(self, docs, q, kw):
+        pre = kw.get('hl.simple.pre', '<em>')
+        post = kw.get('hl.simple.post', '</em>')
+        terms = set(t for t in self._tokenize(q) if t not in ('and', 'or', 'not'))
+        highlighting = {}
+        if not terms:
+            return highlighting
+        def mark(match):
+            word = match.group(0)
+            return pre + word + post if word.lower() in terms else word
+        for doc in docs:
+            hl = {}
+            for field in ('title', 'text'):
+                value = doc.get(field)
+                if isinstance(value, (list, tuple)):
+                    value = ' '.join(_unicode(v) for v in value)
+                if not value:
+                    continue
+                value = _unicode(value)
+                marked = _token_re.sub(mark, value)
+                if marked != value:
+                    first = marked.index(pre)
+                    snippet = marked[max(first - 50, 0):first + 150]
+                    hl[field] = [snippet]
+            if hl:
+                highlighting[doc['id']] = hl
+        return highlighting
+
+
+_token_re = re.compile(r'\w+', re.UNICODE)
+
+
+def _unicode(value):
+    if isinstance(value, unicode):
+        return value
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return unicode(value)
+
+
+class _QueryParser(object):
+    '''Recursive descent parser for the query syntax EmbeddedSOLR supports.
+    Evaluates directly to sets of document ids.'''
+
+    token_re = re.compile(r'''
+        (?P<ws>\s+)
+      | (?P<range>[\[{][^\]}]*[\]}])
+      | (?P<phrase>"(?:[^"\\]|\\.)*")
+      | (?P<lparen>\()
+      | (?P<rparen>\))
+      | (?P<op>&&|\|\|)
+      | (?P<prefix>[-+!])
+      | (?P<field>[\w.*]+:)
+      | (?P<word>[^\s()"]+)
+    ''', re.VERBOSE | re.UNICODE)
+
+    def __init__(self, engine, q, weights):
+        self.engine = engine
+        self.default_fields = list(weights)
+        self.tokens = []
+        for m in self.token_re.finditer(q):
+            kind = m.lastgroup
+            if kind != 'ws':
+                self.tokens.append((kind, m.group(kind)))
+        self.pos = 0
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return (None, None)
+
+    def next(self):
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def parse(self):
+        if not self.tokens:
+            return set()
+        result = self.parse_or(None)
+        # ignore anything unbalanced after a complete expression
+        return result
+
+    def parse_or(self, field):
+        result = self.parse_and(field)
+        while self.peek() in (('op', '||'), ('word', 'OR')):
+            self.next()
+            result = result | self.parse_and(field)
+        return result
+
+    def parse_and(self, field):
+        result = self.parse_unary(field)
+        while True:
+            kind, value = self.peek()
+            if kind is None or kind == 'rparen' or (kind, value) in (('op', '||'), ('word', 'OR')):
+                return result
+            if (kind, value) in (('op', '&&'), ('word', 'AND')):
+                self.next()
+            result = result & self.parse_unary(field)
+
+    def parse_unary(self, field):
+        kind, value = self.peek()
+        if (kind, value) in (('prefix', '-'), ('prefix', '!'), ('word', 'NOT')):
+            self.next()
+            return self.engine._all_ids() - self.parse_unary(field)
+        if (kind, value) == ('prefix', '+'):
+            self.next()
+        return self.parse_primary(field)
+
+    def parse_primary(self, field):
+        kind, value = self.next()
+        if kind == 'lparen':
+            result = self.parse_or(field)
+            if self.peek()[0] == 'rparen':
+                self.next()
+            return result
+        if kind == 'field':
+            name = value[:-1]
+            if self.peek()[0] == 'lparen':
+                self.next()
+                result = self.parse_or(name)
+                if self.peek()[0] == 'rparen':
+                    self.next()
+                return result
+            if self.peek()[0] in ('word', 'phrase', 'range'):
+                return self.parse_value(name, *self.next())
+            return set()
+        if kind in ('word', 'phrase', 'range'):
+            return self.parse_value(field, kind, value)
+        return set()
+
+    def parse_value(self, field, kind, value):
+        if kind == 'phrase':
+            value = re.sub(r'\\(.)', r'\1', value[1:-1])
+        elif kind == 'range':
+            m = re.match(r'([\[{])\s*(\S+)\s+TO\s+(\S+)\s*([\]}])$', value)
+            if not m:
+                return set()
+            value = (m.group(1) == '[', m.group(2).strip('"'),
+                     m.group(3).strip('"'), m.group(4) == ']')
+        else:
+            value = re.sub(r'\\(.)', r'\1', value)
+        return self.engine._match(field, kind, value, self.default_fields)
@@ -165,8 +165,13 @@ def related_artifacts(self):
 
         """
         related_artifacts = []
-        for ref_id in self.refs+self.backrefs:
-            ref = ArtifactReference.query.get(_id=ref_id)
+        ref_ids = self.refs + self.backrefs
+        refs = dict(
+            (ref._id, ref)
+            for ref in ArtifactReference.query.find(dict(_id={'$in': ref_ids})))
+        ArtifactReference.load_artifacts(refs.values())
+        for ref_id in ref_ids:
+            ref = refs.get(ref_id)
             if ref is None: continue
             artifact = ref.artifact
             if artifact is None: continue
@@ -63,6 +63,9 @@
     Index('project_id', 'link'), # used by from_links()  More helpful to have project_id first, for other queries
 )
 
+# pickled artifact class -> class, see ArtifactReference.artifact_class
+_artifact_classes = {}
+
 # Class definitions
 class ArtifactReference(object):
 
@@ -90,13 +93,57 @@ def artifact(self):
         '''Look up the artifact referenced'''
         aref = self.artifact_reference
         try:
-            cls = loads(str(aref.cls))
+            cls = self.artifact_class(aref.cls)
             with h.push_context(aref.project_id):
                 return cls.query.get(_id=aref.artifact_id)
         except:
             log.exception('Error loading artifact for %s: %r',
                           self._id, aref)
 
+    @staticmethod
+    def artifact_class(pickled_cls):
+        '''Unpickle an artifact class, caching the result'''
+        key = str(pickled_cls)
+        cls = _artifact_classes.get(key)
+        if cls is None:
+            cls = _artifact_classes[key] = loads(key)
+        return cls
+
+    @classmethod
+    def load_artifacts(cls, refs):
+        '''Look up the artifacts for many references at once, with one query
+        per artifact class and project.  Sets ``ref.artifact`` on each of the
+        refs, so later access doesn't hit the database, and returns the refs.
+        '''
+        groups = defaultdict(list)
+        for ref in refs:
+            if 'artifact' in ref.__dict__:
+                continue
+            aref = ref.artifact_reference
+            try:
+                acls = cls.artifact_class(aref.cls)
+            except:
+                log.exception('Error loading artifact class for %s: %r',
+                              ref._id, aref)
+                ref.__dict__['artifact'] = None
+                continue
+            groups[acls, aref.project_id].append(ref)
+        for (acls, project_id), group in groups.iteritems():
+            ids = [ref.artifact_reference.artifact_id for ref in group]
+            try:
+                with h.push_context(project_id):
+                    found = dict(
+                        (a._id, a)
+                        for a in acls.query.find(dict(_id={'$in': ids})))
+            except:
+                log.exception('Error loading %s artifacts for project %s',
+                              acls.__name__, project_id)
+                found = {}
+            for ref in group:
+                ref.__dict__['artifact'] = found.get(
+                    ref.artifact_reference.artifact_id)
+        return refs
+
 class Shortlink(object):
     '''Collection mapping shorthand_ids for artifacts to ArtifactReferences'''
 
@@ -15,25 +15,29 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+import re
 import sys
 import time
 import traceback
 import logging
+from collections import OrderedDict, defaultdict
+from fnmatch import fnmatch, translate
 from datetime import datetime, timedelta
 
 import pymongo
 from pylons import tmpl_context as c, app_globals as g
 from tg import config
-from paste.deploy.converters import asbool
+from paste.deploy.converters import asbool, asint
 
 import ming
 from ming.utils import LazyProperty
 from ming import schema as S
 from ming.orm import session, FieldProperty
+from ming.orm.base import state
 from ming.orm.declarative import MappedClass
 
 from allura.lib.helpers import log_output
-from .session import task_orm_session
+from .session import task_orm_session, task_doc_session
 
 log = logging.getLogger(__name__)
 
@@ -53,6 +57,8 @@ class MonQTask(MappedClass):
         - time_stop - time taskd stopped working on the task
         - task_name - full dotted name of the task function to run
         - process - identifier for which taskd process is working on the task
+        - lease_expires - for tasks claimed in a batch by get_batch(), the time
+          after which an unstarted task may be handed back to the queue
         - context - values used to set c.project, c.app, c.user for the task
         - args - *args to be sent to the task function
         - kwargs - **kwargs to be sent to the task function
@@ -88,6 +94,7 @@ class __mongometa__:
 
     task_name = FieldProperty(str)
     process = FieldProperty(str)
+    lease_expires = FieldProperty(datetime, if_missing=None)
     context = FieldProperty(dict(
             project_id=S.ObjectId,
             app_config_id=S.ObjectId,
@@ -172,13 +179,89 @@ def post(cls,
             log.warning('Error putting to amq_conn', exc_info=True)
         return obj
 
+    @classmethod
+    def coalesce(cls, function, ids, kwargs=None, max_size=1000):
+        '''Merge ids into the list passed as the first argument of a pending
+        task for function with the same kwargs, instead of posting a new task.
+
+        Only tasks that would hold no more than max_size ids afterwards are
+        considered.  Returns the task the ids were merged into, or None if
+        there was no suitable task.
+        '''
+        if kwargs is None: kwargs = {}
+        if not ids or len(ids) >= max_size:
+            return None
+        task_name = '%s.%s' % (function.__module__, function.__name__)
+        query = dict(state='ready', task_name=task_name)
+        query['args.1'] = {'$exists': False}
+        # the task's id list must have room left for all of the new ids
+        query['args.0.%d' % (max_size - len(ids))] = {'$exists': False}
+        for k, v in kwargs.iteritems():
+            query['kwargs.%s' % k] = v
+        try:
+            return cls.query.find_and_modify(
+                query=query,
+                update={'$addToSet': {'args.0': {'$each': list(ids)}}},
+                new=True)
+        except pymongo.errors.OperationFailure, exc:
+            if 'No matching object found' not in exc.args[0]:
+                raise
+            return None
+
+    @classmethod
+    def discard_ids(cls, function, ids, kwargs=None):
+        '''Remove ids from the list passed as the first argument of every
+        pending task for function with the given kwargs.  Tasks left with
+        nothing to do are marked 'skipped'.'''
+        if kwargs is None: kwargs = {}
+        if not ids: return
+        task_name = '%s.%s' % (function.__module__, function.__name__)
+        query = dict(state='ready', task_name=task_name)
+        if kwargs:
+            for k, v in kwargs.iteritems():
+                query['kwargs.%s' % k] = v
+        else:
+            query['kwargs'] = {}
+        cls.query.update(
+            dict(query, **{'args.0': {'$in': list(ids)}}),
+            {'$pullAll': {'args.0': list(ids)}},
+            multi=True)
+        cls.query.update(
+            dict(query, **{'args.0': {'$size': 0}}),
+            {'$set': dict(state='skipped')},
+            multi=True)
+
+    @classmethod
+    def claim_slot(cls, name, stale_after=3600):
+        '''Atomically claim the slot called name, e.g. so that only one task of
+        a kind is queued at a time.  Returns False if the slot is held, unless
+        it was claimed more than stale_after seconds ago (its holder may have
+        died before posting its task).  free_slot() gives the slot up.'''
+        slots = task_doc_session.db['monq_slot']
+        now = datetime.utcnow()
+        try:
+            slots.insert(dict(_id=name, claimed=now), safe=True)
+            return True
+        except pymongo.errors.DuplicateKeyError:
+            pass
+        result = slots.update(
+            {'_id': name, 'claimed': {'$lt': now - timedelta(seconds=stale_after)}},
+            {'$set': dict(claimed=now)},
+            safe=True)
+        return bool(result['n'])
+
+    @classmethod
+    def free_slot(cls, name):
+        task_doc_session.db['monq_slot'].remove({'_id': name})
+
     @classmethod
     def get(cls, process='worker', state='ready', waitfunc=None, only=None):
         '''Get the highest-priority, oldest, ready task and lock it to the
         current process.  If no task is available and waitfunc is supplied, call
         the waitfunc before trying to get the task again.  If waitfunc is None
         and no tasks are available, return None.  If waitfunc raises a
-        StopIteration, stop waiting for a task
+        StopIteration, stop waiting for a task.  only may contain task names
+        or glob patterns.
         '''
         sort = [
                 ('priority', ming.DESCENDING),
@@ -188,7 +271,7 @@ def get(cls, process='worker', state='ready', waitfunc=None, only=None):
                 query = dict(state=state)
                 query['time_queue'] = {'$lte': datetime.utcnow()}
                 if only:
-                    query['task_name'] = {'$in': only}
+                    query['task_name'] = cls._task_name_spec(only)
                 obj = cls.query.find_and_modify(
                     query=query,
                     update={
@@ -209,6 +292,165 @@ def get(cls, process='worker', state='ready', waitfunc=None, only=None):
             except StopIteration:
                 return None
 
+    @classmethod
+    def _task_name_spec(cls, only):
+        '''Build a task_name query from a list of task names, any of which may
+        be a glob pattern like "allura.tasks.repo_tasks.*"'''
+        names = []
+        for name in only:
+            if any(ch in name for ch in '*?['):
+                names.append(re.compile(translate(name)))
+            else:
+                names.append(name)
+        return {'$in': names}
+
+    @classmethod
+    def queue_depth(cls, only=None):
+        '''Number of tasks that are ready to run now, optionally limited to the
+        given task names or patterns.'''
+        query = dict(state='ready')
+        query['time_queue'] = {'$lte': datetime.utcnow()}
+        if only:
+            query['task_name'] = cls._task_name_spec(only)
+        return cls.query.find(query).count()
+
+    @classmethod
+    def get_batch(cls, process='worker', state='ready', waitfunc=None,
+                  only=None, batch_size=1, limits=None, lease_time=600):
+        '''Like get(), but claim up to batch_size tasks with a single update
+        and return them as a list in the order they should be run.
+
+        The claimed tasks are marked 'busy', tagged with process and leased
+        until lease_time seconds from now.  Tasks that are still unstarted when
+        the lease expires are returned to the queue by timeout_leases().
+
+        limits is an optional dict mapping task_name glob patterns to the
+        maximum number of matching tasks to claim in one batch, so that a
+        worker doesn't hoard long-running tasks another worker could start.
+        '''
+        limits = limits or {}
+        sort = [
+                ('priority', ming.DESCENDING),
+                ('time_queue', ming.ASCENDING)]
+        while True:
+            now = datetime.utcnow()
+            query = dict(state=state)
+            query['time_queue'] = {'$lte': now}
+            if only:
+                query['task_name'] = cls._task_name_spec(only)
+            # over-fetch a little so that per-name limits don't starve the batch
+            candidates = cls.query.find(query).sort(sort).limit(batch_size * 2)
+            ids = cls._select_batch(candidates, batch_size, limits)
+            if ids:
+                lease_expires = now + timedelta(seconds=lease_time)
+                cls.query.update(
+                    {'_id': {'$in': ids}, 'state': state},
+                    {'$set': dict(
+                        state='busy',
+                        process=process,
+                        lease_expires=lease_expires)},
+                    multi=True)
+                # only the tasks whose update we won are ours
+                tasks = cls.query.find({
+                    '_id': {'$in': ids},
+                    'state': 'busy',
+                    'process': process,
+                    'lease_expires': lease_expires,
+                    }, refresh=True).sort(sort).all()
+                if tasks: return tasks
+                continue
+            if waitfunc is None:
+                return []
+            try:
+                waitfunc()
+            except StopIteration:
+                return []
+
+    @classmethod
+    def _select_batch(cls, candidates, batch_size, limits):
+        '''Pick the ids of up to batch_size tasks from candidates, respecting
+        the per-task_name limits.'''
+        ids = []
+        counts = {}
+        for task in candidates:
+            pattern = None
+            for p in limits:
+                if fnmatch(task.task_name, p):
+                    pattern = p
+                    break
+            if pattern is not None:
+                if counts.get(pattern, 0) >= limits[pattern]:
+                    continue
+                counts[pattern] = counts.get(pattern, 0) + 1
+            ids.append(task._id)
+            if len(ids) >= batch_size:
+                break
+        return ids
+
+    @classmethod
+    def release(cls, tasks):
+        '''Return claimed but unstarted tasks to the queue, e.g. when a worker
+        is asked to stop before it finished its batch.'''
+        ids = [t._id for t in tasks]
+        if not ids: return
+        cls.query.update(
+            {'_id': {'$in': ids}, 'state': 'busy', 'time_start': None},
+            {'$set': dict(state='ready', process=None, lease_expires=None)},
+            multi=True)
+
+    @classmethod
+    def start_leased(cls, task):
+        '''Mark a task claimed by get_batch() as started, if its lease is still
+        held.  Returns False if the lease has expired, in which case
+        timeout_leases() may have handed the task to another worker and it
+        must not be run.'''
+        now = datetime.utcnow()
+        try:
+            obj = cls.query.find_and_modify(
+                query={
+                    '_id': task._id,
+                    'state': 'busy',
+                    'process': task.process,
+                    'lease_expires': {'$gt': now},
+                    },
+                update={'$set': dict(time_start=now)},
+                new=True)
+        except pymongo.errors.OperationFailure, exc:
+            if 'No matching object found' not in exc.args[0]:
+                raise
+            obj = None
+        if obj is None:
+            return False
+        task.time_start = now
+        return True
+
+    @classmethod
+    def renew_leases(cls, tasks, lease_time=600):
+        '''Extend the leases of claimed but unstarted tasks, e.g. between the
+        tasks of a long batch.  Leases that already expired aren't renewed.'''
+        ids = [t._id for t in tasks]
+        if not ids: return
+        now = datetime.utcnow()
+        spec = {'_id': {'$in': ids}, 'state': 'busy', 'time_start': None}
+        spec['lease_expires'] = {'$gt': now}
+        cls.query.update(
+            spec,
+            {'$set': dict(lease_expires=now + timedelta(seconds=lease_time))},
+            multi=True)
+
+    @classmethod
+    def timeout_leases(cls, now=None):
+        '''Return tasks whose batch lease expired before they were started to
+        the queue.  Used to recover tasks claimed by a worker that died.'''
+        if now is None:
+            now = datetime.utcnow()
+        spec = dict(state='busy', time_start=None)
+        spec['lease_expires'] = {'$lt': now}
+        cls.query.update(
+            spec,
+            {'$set': dict(state='ready', process=None, lease_expires=None)},
+            multi=True)
+
     @classmethod
     def timeout_tasks(cls, older_than):
         '''Mark all busy tasks older than a certain datetime as 'ready' again.
@@ -246,14 +488,18 @@ def __call__(self, restore_context=True):
         old_cuser = getattr(c, 'user', None)
         try:
             func = self.function
-            c.project = M.Project.query.get(_id=self.context.project_id)
-            c.app = None
-            if c.project:
-                c.project.notifications_disabled = self.context.get('notifications_disabled', False)
-                app_config = M.AppConfig.query.get(_id=self.context.app_config_id)
-                if app_config:
-                    c.app = c.project.app_instance(app_config)
-            c.user = M.User.query.get(_id=self.context.user_id)
+            cache = TaskContextCache.get()
+            if cache is None:
+                c.project = M.Project.query.get(_id=self.context.project_id)
+                c.app = None
+                if c.project:
+                    c.project.notifications_disabled = self.context.get('notifications_disabled', False)
+                    app_config = M.AppConfig.query.get(_id=self.context.app_config_id)
+                    if app_config:
+                        c.app = c.project.app_instance(app_config)
+                c.user = M.User.query.get(_id=self.context.user_id)
+            else:
+                c.project, c.app, c.user = cache.context(self.context)
             with log_output(log):
                 self.result = func(*self.args, **self.kwargs)
             self.state = 'complete'
@@ -289,3 +535,178 @@ def list(cls, state='ready'):
         '''Print all tasks of a certain status to sys.stdout.  Used for debugging.'''
         for t in cls.query.find(dict(state=state)):
             sys.stdout.write('%r\n' % t)
+
+
+class TaskContextCache(object):
+    '''Keeps the project, app config, user and app instance that tasks run
+    with across tasks in a worker process, since consecutive tasks mostly
+    share them.
+
+    Objects are looked up in the current session first.  Otherwise a cached
+    object is used as long as its stamp is unchanged: saving or deleting a
+    project, app config or user through the ORM bumps its stamp (see
+    ContextStampExtension), unless only volatile fields changed.  The stamps
+    of a task's objects are read with a single query, and an object that
+    has to be loaded costs one more.  Writes that bypass the ORM don't bump
+    stamps, so cached objects are also reloaded after
+    monq.context_cache_ttl seconds (default 600).  App instances are reused
+    as long as their project and app config are, with any attributes set on
+    them since they were created removed.
+
+    The size is set with monq.context_cache_size (default 100, 0 disables
+    the cache); stats counts hits and misses for each kind of object, the
+    objects looked up and the queries made for them, and the tasks and
+    seconds spent setting up their context.
+    '''
+    # fields that change without affecting tasks, so saving them doesn't
+    # bump the stamp
+    volatile_fields = dict(Project=('last_updated',))
+
+    _instance = None
+
+    @classmethod
+    def get(cls):
+        size = asint(config.get('monq.context_cache_size', 100))
+        if not size:
+            return None
+        if cls._instance is None or cls._instance.size != size:
+            cls._instance = cls(size)
+        return cls._instance
+
+    @classmethod
+    def cached_class(cls, obj):
+        '''Return the class obj is cached under, or None'''
+        from allura import model as M
+        for model_cls in (M.Project, M.AppConfig, M.User):
+            if isinstance(obj, model_cls):
+                return model_cls
+
+    @classmethod
+    def stamps(cls):
+        return task_doc_session.db['monq_context_stamp']
+
+    @classmethod
+    def _stamp_id(cls, obj_cls, _id):
+        return '%s:%s' % (obj_cls.__name__, _id)
+
+    @classmethod
+    def saved(cls, obj, st, deleted=False):
+        '''Bump the stamp of obj, which was just saved or deleted, unless only
+        volatile fields of it changed'''
+        obj_cls = cls.cached_class(obj)
+        if obj_cls is None:
+            return
+        volatile = cls.volatile_fields.get(obj_cls.__name__, ())
+        doc, orig = st.document, st.original_document
+        if not deleted and volatile and orig is not None:
+            keys = (set(doc) | set(orig)) - set(volatile)
+            if all(doc.get(k) == orig.get(k) for k in keys):
+                return
+        cls.stamps().update(
+            dict(_id=cls._stamp_id(obj_cls, obj._id)),
+            {'$inc': dict(stamp=1)}, upsert=True)
+
+    def __init__(self, size):
+        self.size = size
+        self.ttl = asint(config.get('monq.context_cache_ttl', 600))
+        self.objects = OrderedDict()  # (class, _id) -> (stamp, load time, object, attrs)
+        self.apps = OrderedDict()  # (project _id, app config _id) -> (project, app config, app, attrs)
+        self.stats = defaultdict(float)
+
+    def context(self, context):
+        '''Return the (project, app, user) for a MonQTask context'''
+        from allura import model as M
+        start = time.time()
+        current = self._current_stamps([
+                (M.Project, context.project_id),
+                (M.AppConfig, context.app_config_id),
+                (M.User, context.user_id)])
+        project = self.object(M.Project, context.project_id, current)
+        app = None
+        if project:
+            project.notifications_disabled = context.get('notifications_disabled', False)
+            app_config = self.object(M.AppConfig, context.app_config_id, current)
+            if app_config:
+                app = self.app(project, app_config)
+        user = self.object(M.User, context.user_id, current)
+        self.stats['tasks'] += 1
+        self.stats['seconds'] += time.time() - start
+        return project, app, user
+
+    def _current_stamps(self, keys):
+        '''Read the stamps of the objects that aren't in the session yet'''
+        keys = [(cls, _id) for cls, _id in keys
+                if _id is not None and session(cls).imap.get(cls, _id) is None]
+        if not keys:
+            return {}
+        self.stats['lookups'] += len(keys)
+        self.stats['queries'] += 1
+        ids = dict((self._stamp_id(cls, _id), (cls.__name__, _id))
+                   for cls, _id in keys)
+        current = dict((key, 0) for key in ids.itervalues())
+        for doc in self.stamps().find({'_id': {'$in': ids.keys()}}):
+            current[ids[doc['_id']]] = doc['stamp']
+        return current
+
+    def object(self, cls, _id, current):
+        sess = session(cls)
+        obj = sess.imap.get(cls, _id)
+        if obj is not None:
+            return obj
+        key = (cls.__name__, _id)
+        stamp = current.get(key, 0)
+        cached = self.objects.pop(key, None)
+        if (cached and cached[0] == stamp and time.time() - cached[1] < self.ttl
+                and state(cached[2]).status == state(cached[2]).clean):
+            self.stats[cls.__name__ + ' hits'] += 1
+            _, loaded, obj, attrs = cached
+            # drop cached relations and lazy properties, which may refer to
+            # objects from an earlier task's session
+            state(obj).extra_state.clear()
+            self._reset(obj, attrs)
+            sess.save(obj)
+        else:
+            self.stats[cls.__name__ + ' misses'] += 1
+            self.stats['queries'] += 1
+            loaded = time.time()
+            obj = cls.query.get(_id=_id)
+            attrs = set(obj.__dict__) if obj is not None else None
+        if obj is not None:
+            self.objects[key] = (stamp, loaded, obj, attrs)
+            if len(self.objects) > self.size:
+                self.objects.popitem(last=False)
+        return obj
+
+    def app(self, project, app_config):
+        key = (project._id, app_config._id)
+        cached = self.apps.pop(key, None)
+        if cached and cached[0] is project and cached[1] is app_config:
+            self.stats['app hits'] += 1
+            app, attrs = cached[2], cached[3]
+            self._reset(app, attrs)
+        else:
+            self.stats['app misses'] += 1
+            app = project.app_instance(app_config)
+            if app is None:
+                return None
+            attrs = set(app.__dict__)
+        self.apps[key] = (project, app_config, app, attrs)
+        if len(self.apps) > self.size:
+            self.apps.popitem(last=False)
+        return app
+
+    def _reset(self, obj, attrs):
+        '''Remove attributes set on obj since it was loaded'''
+        for name in set(obj.__dict__) - attrs:
+            del obj.__dict__[name]
+
+    def log_stats(self):
+        stats = self.stats
+        log.info('Task context cache: %d tasks, %.3fs setting up their context',
+                 stats['tasks'], stats['seconds'])
+        log.info('  %d objects looked up with %d queries, %d fewer than '
+                 'loading each of them', stats['lookups'], stats['queries'],
+                 stats['lookups'] - stats['queries'])
+        for kind in ('Project', 'AppConfig', 'User', 'app'):
+            log.info('  %s: %d hits, %d misses', kind,
+                     stats[kind + ' hits'], stats[kind + ' misses'])
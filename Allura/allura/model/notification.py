@@ -32,16 +32,18 @@
 
 '''
 
+import sys
 import logging
 from bson import ObjectId
 from datetime import datetime, timedelta
 from collections import defaultdict
+from itertools import islice
 
 from pylons import tmpl_context as c, app_globals as g
 from tg import config
 import pymongo
 import jinja2
-from paste.deploy.converters import asbool
+from paste.deploy.converters import asbool, asint
 
 from ming import schema as S
 from ming.orm import FieldProperty, ForeignIdProperty, RelationProperty, session
@@ -249,7 +251,7 @@ def send_simple(self, toaddr):
             text=(self.text or '') + self.footer(toaddr))
 
     def send_direct(self, user_id):
-        user = User.query.get(_id=ObjectId(user_id), disabled=False)
+        user = _enabled_user(user_id)
         artifact = self.ref.artifact
         log.debug('Sending direct notification %s to user %s', self._id, user_id)
         # Don't send if user disabled
@@ -280,17 +282,25 @@ def send_direct(self, user_id):
     def send_digest(self, user_id, from_address, subject, notifications,
                     reply_to_address=None):
         if not notifications: return
-        user = User.query.get(_id=ObjectId(user_id), disabled=False)
+        user = _enabled_user(user_id)
         if not user:
             log.debug("Skipping notification - enabled user %s not found " % user_id)
             return
         # Filter out notifications for which the user doesn't have read
         # permissions to the artifact.
-        artifact = self.ref.artifact
-        def perm_check(notification):
-            return not (user and artifact) or \
-                    security.has_access(artifact, 'read', user)()
-        notifications = filter(perm_check, notifications)
+        from .index import ArtifactReference
+        ref_ids = list(set(n.ref_id for n in notifications if n.ref_id))
+        refs_by_id = dict(
+            (ref._id, ref) for ref in
+            ArtifactReference.query.find(dict(_id={'$in': ref_ids})))
+        refs = [refs_by_id.get(n.ref_id) for n in notifications]
+        ArtifactReference.load_artifacts(refs_by_id.values())
+        artifacts = [ref and ref.artifact for ref in refs]
+        readable = set(id(a) for a in security.filter_readable(
+            filter(None, artifacts), 'read', user))
+        notifications = [n for n, a in zip(notifications, artifacts)
+                         if a is None or id(a) in readable]
+        if not notifications: return
 
         log.debug('Sending digest of notifications [%s] to user %s', ', '.join([n._id for n in notifications]), user_id)
         if reply_to_address is None:
@@ -483,30 +493,25 @@ def deliver(cls, nid, artifact_index_id, topic):
             'artifact_index_id':{'$in':[None, artifact_index_id]},
             'topic':{'$in':[None, topic]}
             }
-        mboxes = cls.query.find(d).all()
-        log.debug('Delivering notification %s to mailboxes [%s]', nid, ', '.join([str(m._id) for m in mboxes]))
-        for mbox in mboxes:
-            try:
-                mbox.query.update(
-                    {'$push':dict(queue=nid),
-                     '$set':dict(last_modified=datetime.utcnow(),
-                                 queue_empty=False),
-                    })
-                # Make sure the mbox doesn't stick around to be flush()ed
-                session(mbox).expunge(mbox)
-            except:
-                # log error but try to keep processing, lest all the other eligible
-                # mboxes for this notification get skipped and lost forever
-                log.exception(
-                    'Error adding notification: %s for artifact %s on project %s to user %s',
-                    nid, artifact_index_id, c.project._id, mbox.user_id)
+        log.debug('Delivering notification %s to mailboxes matching %s', nid, d)
+        cls.query.update(d, {
+            '$push':dict(queue=nid),
+            '$set':dict(last_modified=datetime.utcnow(),
+                        queue_empty=False),
+            }, multi=True)
 
     @classmethod
-    def fire_ready(cls):
+    def fire_ready(cls, limit=None, batch_size=None):
         '''Fires all direct subscriptions with notifications as well as
         all summary & digest subscriptions with notifications that are ready.
         Clears the mailbox queue.
+
+        Mailboxes are claimed and fired batch_size (mailbox.fire_batch_size)
+        at a time, loading the notifications for the whole batch at once.  At
+        most limit mailboxes are fired; returns True if that left some ready.
         '''
+        if batch_size is None:
+            batch_size = asint(config.get('mailbox.fire_batch_size', 100))
         now = datetime.utcnow()
         # Queries to find all matching subscription objects
         q_direct = dict(
@@ -528,37 +533,78 @@ def find_and_modify_direct_mbox():
                         )},
                 new=False)
 
-        for mbox in take_while_true(find_and_modify_direct_mbox):
+        def find_and_modify_digest_mbox():
+            for mbox in take_while_true(lambda: cls.query.find(q_digest).first()):
+                next_scheduled = now
+                if mbox.frequency.unit == 'day':
+                    next_scheduled += timedelta(days=mbox.frequency.n)
+                elif mbox.frequency.unit == 'week':
+                    next_scheduled += timedelta(days=7 * mbox.frequency.n)
+                elif mbox.frequency.unit == 'month':
+                    next_scheduled += timedelta(days=30 * mbox.frequency.n)
+                mbox = cls.query.find_and_modify(
+                    query=dict(q_digest, _id=mbox._id),
+                    update={'$set': dict(
+                            next_scheduled=next_scheduled,
+                            queue=[],
+                            queue_empty=True,
+                            )},
+                    new=False)
+                if mbox:
+                    # otherwise another process has fired it already
+                    return mbox
+
+        fired = 0
+        for claim in (find_and_modify_direct_mbox, find_and_modify_digest_mbox):
+            mboxes = take_while_true(claim)
+            while True:
+                if limit is not None:
+                    batch_size = min(batch_size, limit - fired)
+                batch = list(islice(mboxes, batch_size))
+                if not batch:
+                    break
+                cls.fire_batch(batch, now)
+                fired += len(batch)
+                if limit is not None and fired >= limit:
+                    return bool(cls.query.find(q_direct).first() or
+                                cls.query.find(q_digest).first())
+        return False
+
+    @classmethod
+    def fire_batch(cls, mboxes, now):
+        '''Fire mboxes, which have already been claimed, loading their
+        notifications with one query.  An error firing one mailbox doesn't
+        stop the rest (their queues have already been cleared), but is raised
+        afterwards.
+        '''
+        nids = set(nid for mbox in mboxes for nid in mbox.queue)
+        notifications = dict(
+            (n._id, n) for n in Notification.query.find(dict(_id={'$in':list(nids)})))
+        # load the recipients into the session for _enabled_user
+        User.query.find(dict(
+            _id={'$in':list(set(mbox.user_id for mbox in mboxes))},
+            disabled=False)).all()
+        error = None
+        for mbox in mboxes:
             try:
-                mbox.fire(now)
+                mbox.fire(now, notifications)
             except:
                 log.exception('Error firing mbox: %s with queue: [%s]', str(mbox._id), ', '.join(mbox.queue))
-                raise  # re-raise so we don't keep (destructively) trying to process mboxes
-
-        for mbox in cls.query.find(q_digest):
-            next_scheduled = now
-            if mbox.frequency.unit == 'day':
-                next_scheduled += timedelta(days=mbox.frequency.n)
-            elif mbox.frequency.unit == 'week':
-                next_scheduled += timedelta(days=7 * mbox.frequency.n)
-            elif mbox.frequency.unit == 'month':
-                next_scheduled += timedelta(days=30 * mbox.frequency.n)
-            mbox = cls.query.find_and_modify(
-                query=dict(_id=mbox._id),
-                update={'$set': dict(
-                        next_scheduled=next_scheduled,
-                        queue=[],
-                        queue_empty=True,
-                        )},
-                new=False)
-            mbox.fire(now)
+                error = error or sys.exc_info()
+        if error:
+            raise error[0], error[1], error[2]
 
-    def fire(self, now):
+    def fire(self, now, notifications=None):
         '''
         Send all notifications that this mailbox has enqueued.
+
+        :param notifications: already loaded notifications, by _id
         '''
-        notifications = Notification.query.find(dict(_id={'$in':self.queue}))
-        notifications = notifications.all()
+        if notifications is None:
+            notifications = Notification.query.find(dict(_id={'$in':self.queue}))
+            notifications = notifications.all()
+        else:
+            notifications = [notifications[nid] for nid in self.queue if nid in notifications]
         if len(notifications) != len(self.queue):
             log.error('Mailbox queue error: Mailbox %s queued [%s], found [%s]', str(self._id), ', '.join(self.queue), ', '.join([n._id for n in notifications]))
         else:
@@ -606,6 +652,18 @@ def fire(self, now):
                 notifications)
 
 
+def _enabled_user(user_id):
+    '''Return the user with user_id if they're enabled, using the copy in
+    the session if there is one'''
+    user_id = ObjectId(user_id)
+    user = session(User).imap.get(User, user_id)
+    if user is None:
+        user = User.query.get(_id=user_id, disabled=False)
+    if user and not user.disabled:
+        return user
+    return None
+
+
 class MailFooter(object):
     view = jinja2.Environment(
         loader=jinja2.PackageLoader('allura', 'templates'),
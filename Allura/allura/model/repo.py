@@ -22,7 +22,7 @@
 from hashlib import sha1
 from itertools import chain
 from datetime import datetime
-from collections import defaultdict, OrderedDict
+from collections import defaultdict, OrderedDict, Counter
 from difflib import SequenceMatcher, unified_diff
 import bson
 
@@ -56,6 +56,8 @@
     '.pl','.php4','.php3','.rhtml','.svg','.markdown','.json','.ini','.tcl','.vbs','.xsl']
 
 DIFF_SIMILARITY_THRESHOLD = .5  # used for determining file renames
+RENAME_LIMIT = 1000  # with more unmatched files, only identical renames are found
+RENAME_CANDIDATES = 5  # added files compared with each removed one
 
 # Basic commit information
 # One of these for each commit in the physical repo on disk. The _id is the
@@ -119,7 +121,11 @@
     Field('_id', str),
     Field(
         'differences',
-        [ dict(name=str, lhs_id=str, rhs_id=str)]))
+        [ dict(name=str, lhs_id=str, rhs_id=str)]),
+    # renames among the differences; None until the diffs are first viewed
+    Field(
+        'copied',
+        S.Array(dict(old=str, new=str, ratio=float), if_missing=None)))
 
 # List of commit runs (a run is a linear series of single-parent commits)
 # CommitRunDoc.commit_ids = [ CommitDoc._id, ... ]
@@ -130,6 +136,14 @@
     Field('commit_ids', [str], index=True),
     Field('commit_times', [datetime]))
 
+# Rendered diffs between two blobs (see allura.lib.diff.DiffCache)
+# DiffCacheDoc._id = sha1 of the blob ids, paths, view and tab size
+DiffCacheDoc = collection(
+    'repo_diff_cache', main_doc_session,
+    Field('_id', str),
+    Field('html', S.Binary()),  # zlib compressed utf-8
+    Field('last_used', datetime, index=True))
+
 class RepoObject(object):
 
     def __repr__(self): # pragma no cover
@@ -299,71 +313,79 @@ def paged_diffs(self, start=0, end=None):
                 added.append(change.name)
             else:
                 changed.append(change.name)
-        copied = self._diffs_copied(added, removed)
+        copied = self._diffs_copied(added, removed, self._renames(di))
         return Object(
             added=added, removed=removed,
             changed=changed, copied=copied,
             total=len(di.differences))
 
-    def _diffs_copied(self, added, removed):
+    def _renames(self, di):
+        '''Return the renames in a DiffInfoDoc, finding and saving them
+        the first time'''
+        if di.copied is None:
+            di.copied = self._find_renames(di.differences)
+            DiffInfoDoc.m.update_partial(
+                dict(_id=di._id), {'$set': dict(copied=di.copied)})
+        return di.copied
+
+    def _find_renames(self, differences):
+        '''Return dict(old, new, ratio) for each removed path that was
+        renamed (or copied) to an added path, in the order of `differences`.
+
+        Paths with the same object id are paired first.  Each removed blob
+        left is then compared with the RENAME_CANDIDATES added blobs sharing
+        the most lines with it, and the best pairs over
+        DIFF_SIMILARITY_THRESHOLD are kept.
+        '''
+        removed = [d for d in differences if d.rhs_id is None]
+        added = [d for d in differences if d.lhs_id is None]
+        if not removed or not added:
+            return []
+        renames = {}
+        added_by_id = defaultdict(list)
+        for d in reversed(added):
+            added_by_id[d.rhs_id].append(d.name)
+        for d in removed:
+            names = added_by_id.get(d.lhs_id)
+            if names:
+                renames[d.name] = dict(old=d.name, new=names.pop(), ratio=1.0)
+        matched = set(r['new'] for r in renames.itervalues())
+        removed = [d.name for d in removed if d.name not in renames]
+        added = [d.name for d in added if d.name not in matched]
+        if removed and added and max(len(removed), len(added)) <= RENAME_LIMIT:
+            prev_commit = self.get_parent()
+            if prev_commit is not None:
+                removed = _blob_fingerprints(prev_commit.tree, removed)
+                added = _blob_fingerprints(self.tree, added)
+                for old, new, ratio in _similar_blobs(removed, added):
+                    renames[old] = dict(old=old, new=new, ratio=ratio)
+        return [renames.pop(d.name) for d in differences if d.name in renames]
+
+    def _diffs_copied(self, added, removed, renames):
         '''Return list with file renames diffs.
 
         Will change `added` and `removed` lists also.
         '''
-        def _blobs_similarity(removed_blob, added):
-            best = dict(ratio=0, name='', blob=None)
-            for added_name in added:
-                added_blob = self.tree.get_obj_by_path(added_name)
-                if not isinstance(added_blob, Blob):
-                    continue
-                diff = SequenceMatcher(None, removed_blob.text,
-                                       added_blob.text)
-                ratio = diff.quick_ratio()
-                if ratio > best['ratio']:
-                    best['ratio'] = ratio
-                    best['name'] = added_name
-                    best['blob'] = added_blob
-
-                if ratio == 1:
-                    break  # we'll won't find better similarity than 100% :)
-
-            if best['ratio'] > DIFF_SIMILARITY_THRESHOLD:
-                diff = ''
-                if best['ratio'] < 1:
-                    added_blob = best['blob']
-                    rpath = ('a' + removed_blob.path()).encode('utf-8')
-                    apath = ('b' + added_blob.path()).encode('utf-8')
-                    diff = ''.join(unified_diff(list(removed_blob),
-                                                list(added_blob),
-                                                rpath, apath))
-                return dict(new=best['name'],
-                            ratio=best['ratio'], diff=diff)
-
-        def _trees_similarity(removed_tree, added):
-            for added_name in added:
-                added_tree = self.tree.get_obj_by_path(added_name)
-                if not isinstance(added_tree, Tree):
-                    continue
-                if removed_tree._id == added_tree._id:
-                    return dict(new=added_name,
-                                ratio=1, diff='')
-
-        if not removed:
-            return []
         copied = []
-        prev_commit = self.get_parent()
-        for removed_name in removed[:]:
-            removed_blob = prev_commit.tree.get_obj_by_path(removed_name)
-            rename_info = None
-            if isinstance(removed_blob, Blob):
-                rename_info = _blobs_similarity(removed_blob, added)
-            elif isinstance(removed_blob, Tree):
-                rename_info = _trees_similarity(removed_blob, added)
-            if rename_info is not None:
-                rename_info['old'] = removed_name
-                copied.append(rename_info)
-                removed.remove(rename_info['old'])
-                added.remove(rename_info['new'])
+        prev_commit = None
+        for rename in renames:
+            if rename['new'] in added:
+                added.remove(rename['new'])
+            if rename['old'] not in removed:
+                continue  # on another page
+            removed.remove(rename['old'])
+            diff = ''
+            if rename['ratio'] < 1:
+                prev_commit = prev_commit or self.get_parent()
+                removed_blob = prev_commit.tree.get_obj_by_path(rename['old'])
+                added_blob = self.tree.get_obj_by_path(rename['new'])
+                rpath = ('a' + removed_blob.path()).encode('utf-8')
+                apath = ('b' + added_blob.path()).encode('utf-8')
+                diff = ''.join(unified_diff(list(removed_blob),
+                                            list(added_blob),
+                                            rpath, apath))
+            copied.append(dict(old=rename['old'], new=rename['new'],
+                               ratio=rename['ratio'], diff=diff))
         return copied
 
     def get_path(self, path, create=True):
@@ -778,6 +800,55 @@ def diff(cls, v0, v1):
         differ = SequenceMatcher(v0, v1)
         return differ.get_opcodes()
 
+def _blob_fingerprints(tree, paths):
+    '''Return (path, line hash counts, line count) for the blobs among paths'''
+    result = []
+    for path in paths:
+        blob = tree.get_obj_by_path(path)
+        if not isinstance(blob, Blob):
+            continue
+        lines = Counter(hash(line.rstrip('\n')) for line in blob)
+        result.append((path, lines, sum(lines.itervalues())))
+    return result
+
+def _similar_blobs(removed, added):
+    '''Pair removed and added blob fingerprints by the share of lines they have
+    in common, best pairs first, yielding (old, new, ratio) over
+    DIFF_SIMILARITY_THRESHOLD.
+
+    Only the added blobs sharing the most lines with a removed blob are
+    compared with it; lines found in many added blobs (blank lines, closing
+    braces) are left out of that count.
+    '''
+    index = defaultdict(list)
+    for i, (path, lines, size) in enumerate(added):
+        for line in lines:
+            index[line].append(i)
+    common = max(10, len(added) // 10)
+    pairs = []
+    for old, lines, size in removed:
+        shared = Counter()
+        for line in lines:
+            candidates = index.get(line, ())
+            if len(candidates) <= common:
+                shared.update(candidates)
+        for i, count in shared.most_common(RENAME_CANDIDATES):
+            new, added_lines, added_size = added[i]
+            if len(lines) < len(added_lines):
+                same = sum(min(n, added_lines[l]) for l, n in lines.iteritems())
+            else:
+                same = sum(min(n, lines[l]) for l, n in added_lines.iteritems())
+            ratio = 2.0 * same / (size + added_size)
+            if ratio > DIFF_SIMILARITY_THRESHOLD:
+                pairs.append((ratio, old, new))
+    pairs.sort(key=lambda p: -p[0])
+    olds, news = set(), set()
+    for ratio, old, new in pairs:
+        if old not in olds and new not in news:
+            olds.add(old)
+            news.add(new)
+            yield old, new, ratio
+
 class LastCommit(RepoObject):
     def __repr__(self):
         return '<LastCommit /%s %s>' % (self.path, self.commit_id)
@@ -16,21 +16,26 @@
 #       under the License.
 
 import logging
+from time import time
 from itertools import chain
 from cPickle import dumps
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
 
 import bson
 
 import tg
 import jinja2
+from paste.deploy.converters import asint
 from pylons import tmpl_context as c, app_globals as g
+from pymongo.errors import DuplicateKeyError
 
 from ming.base import Object
 from ming.orm import mapper, session, ThreadLocalORMSession
+from ming.orm.base import state
 
 from allura.lib import utils
 from allura.lib import helpers as h
+from allura.lib.commit_graph import CommitGraph
 from allura.model.repo import CommitDoc, TreeDoc, TreesDoc, DiffInfoDoc
 from allura.model.repo import LastCommitDoc, CommitRunDoc
 from allura.model.repo import Commit, Tree, LastCommit, ModelCache
@@ -42,10 +47,23 @@
 QSIZE=100
 
 def refresh_repo(repo, all_commits=False, notify=True, new_clone=False):
-    all_commit_ids = commit_ids = list(repo.all_commit_ids())
-    if not commit_ids:
-        # the repo is empty, no need to continue
-        return
+    graph, graph_commits = update_commit_graph(
+        repo, rebuild=all_commits or new_clone)
+    if graph is None:
+        all_commit_ids = commit_ids = list(repo.all_commit_ids())
+        if not commit_ids:
+            # the repo is empty, no need to continue
+            return
+        parent_ids = None
+    else:
+        if not len(graph):
+            # the repo is empty, no need to continue
+            return
+        # Only commits added to the graph since the last refresh can be new
+        # to this repo; the full list is only needed to check the CommitRuns
+        graph_commit_ids = commit_ids = [ oid for oid, parents in graph_commits ]
+        all_commit_ids = None
+        parent_ids = dict(graph_commits)
     new_commit_ids = unknown_commit_ids(commit_ids)
     stats_log = h.log_action(log, 'commit')
     for ci in new_commit_ids:
@@ -61,16 +79,19 @@ def refresh_repo(repo, all_commits=False, notify=True, new_clone=False):
 
     # Refresh commits
     seen = set()
-    for i, oid in enumerate(commit_ids):
-        repo.refresh_commit_info(oid, seen, not all_commits)
-        if (i+1) % 100 == 0:
-            log.info('Refresh commit info %d: %s', (i+1), oid)
+    repo.refresh_commits_info(commit_ids, seen, not all_commits)
 
-    refresh_commit_repos(all_commit_ids, repo)
+    if graph is None:
+        refresh_commit_repos(all_commit_ids, repo)
+    else:
+        refresh_commit_repos(graph_commit_ids, repo)
 
     # Refresh child references
     for i, oid in enumerate(commit_ids):
-        ci = CommitDoc.m.find(dict(_id=oid), validate=False).next()
+        if parent_ids is None:
+            ci = CommitDoc.m.find(dict(_id=oid), validate=False).next()
+        else:
+            ci = Object(_id=oid, parent_ids=parent_ids[oid])
         refresh_children(ci)
         if (i+1) % 100 == 0:
             log.info('Refresh child info %d for parents of %s', (i+1), ci._id)
@@ -81,11 +102,21 @@ def refresh_repo(repo, all_commits=False, notify=True, new_clone=False):
         # Check if the CommitRuns for the repo are in a good state by checking for
         # a CommitRunDoc that contains the last known commit. If there isn't one,
         # the CommitRuns for this repo are in a bad state - rebuild them entirely.
-        if commit_run_ids != all_commit_ids:
-            last_commit = last_known_commit_id(all_commit_ids, new_commit_ids)
+        if graph is None:
+            partial = commit_run_ids != all_commit_ids
+        else:
+            # commit_ids are distinct commits of the graph
+            partial = len(commit_run_ids) != len(graph)
+        if partial:
+            if graph is None:
+                last_commit = last_known_commit_id(all_commit_ids, new_commit_ids)
+            else:
+                last_commit = last_known_commit_id_in_graph(graph, new_commit_ids)
             log.info('Last known commit id: %s', last_commit)
             if not CommitRunDoc.m.find(dict(commit_ids=last_commit)).count():
                 log.info('CommitRun incomplete, rebuilding with all commits')
+                if all_commit_ids is None:
+                    all_commit_ids = list(graph.commit_ids())
                 commit_run_ids = all_commit_ids
         log.info('Starting CommitRunBuilder for %s', repo.full_fs_path)
         rb = CommitRunBuilder(commit_run_ids)
@@ -110,24 +141,19 @@ def refresh_repo(repo, all_commits=False, notify=True, new_clone=False):
     # would be too expensive, so we skip them here and do them on-demand
     # with caching.
     if repo._refresh_precompute:
+        writer = BulkWriter(repo.full_fs_path, replace=all_commits)
         for i, oid in enumerate(commit_ids):
             cid = CommitDoc.m.find(dict(_id=oid), validate=False).next()
             ci = mapper(Commit).create(cid, dict(instrument=False))
             ci.set_context(repo)
-            compute_diffs(repo._id, cache, ci)
+            compute_diffs(repo._id, cache, ci, writer)
             if (i+1) % 100 == 0:
                 log.info('Compute diffs %d: %s', (i+1), ci._id)
+        writer.flush()
+        writer.log_stats()
 
     if repo._refresh_precompute:
-        model_cache = ModelCache()
-        lcid_cache = {}
-        for i, oid in enumerate(reversed(commit_ids)):
-            ci = model_cache.get(Commit, dict(_id=oid))
-            ci.set_context(repo)
-            compute_lcds(ci, model_cache, lcid_cache)
-            ThreadLocalORMSession.flush_all()
-            if (i+1) % 100 == 0:
-                log.info('Compute last commit info %d: %s', (i+1), ci._id)
+        refresh_lcds(repo, commit_ids)
 
     if not all_commits and not new_clone:
         for commit in commit_ids:
@@ -138,6 +164,12 @@ def refresh_repo(repo, all_commits=False, notify=True, new_clone=False):
             if user is not None:
                 g.statsUpdater.newCommit(new, repo.app_config.project, user)
 
+    if graph is not None:
+        # Only save once everything above succeeded, so a failed refresh is
+        # retried in full next time
+        graph.save(repo.commit_graph_path)
+        graph.close()
+
     log.info('Refresh complete for %s', repo.full_fs_path)
     g.post_event('repo_refreshed', len(commit_ids), all_commits, new_clone)
 
@@ -145,6 +177,34 @@ def refresh_repo(repo, all_commits=False, notify=True, new_clone=False):
     if notify:
         send_notifications(repo, commit_ids)
 
+def update_commit_graph(repo, rebuild=False):
+    '''Bring the repo's commit graph up to date with its refs.
+
+    Return the graph (unsaved) and the (commit id, parent ids) pairs added to
+    it, heads first, or (None, None) if the repo doesn't keep a graph.'''
+    path = repo.commit_graph_path
+    if path is None:
+        return None, None
+    graph = None if rebuild else CommitGraph.load(path)
+    result = None
+    if graph is not None:
+        result = repo.commits_since(graph.tips)
+        if result is None:
+            graph.close()
+            graph = None
+    if graph is None:
+        result = repo.commits_since([])
+        if result is None:
+            return None, None
+        log.info('Building commit graph for %s', repo.full_fs_path)
+        graph = CommitGraph()
+    tips, commits = result
+    added = set(graph.add(commits, tips))
+    commits = [ (oid, parents) for oid, parents in commits if oid in added ]
+    log.info('%d commits added to the commit graph of %s (%d total)',
+             len(commits), repo.full_fs_path, len(graph))
+    return graph, commits
+
 def refresh_commit_trees(ci, cache):
     '''Refresh the list of trees included withn a commit'''
     if ci.tree_id is None: return cache
@@ -202,6 +262,72 @@ def refresh_children(ci):
         {'$addToSet': dict(child_ids=ci._id)},
         multi=True)
 
+class BulkWriter(object):
+    '''Buffer the docs written during a refresh and insert them in batches.
+
+    Each batch is checked with one $in query, and only the docs that aren't
+    there yet (e.g. trees shared with another repo) are inserted, with
+    continue_on_error.  With replace=True the existing docs are updated one
+    by one instead, never removed, as other repos may be using them.
+
+    Buffers are written in the order their collections were first used, so
+    insert the docs that others depend on first: a commit should only appear
+    once its trees are there.'''
+
+    def __init__(self, name, replace=False, batch_size=None):
+        if batch_size is None:
+            batch_size = asint(tg.config.get('scm.refresh.batch_size', 1000))
+        self.name = name
+        self.replace = replace
+        self.batch_size = batch_size
+        self._docs = OrderedDict() # by collection
+        self._pending = 0
+        self.written = defaultdict(int) # by collection name
+        self.started = time()
+        self.elapsed = 0.0 # time spent writing
+
+    def insert(self, doc):
+        self._docs.setdefault(type(doc), []).append(doc)
+        self._pending += 1
+        if self._pending >= self.batch_size:
+            self.flush()
+            self.log_stats()
+
+    def flush(self):
+        start = time()
+        for cls, docs in self._docs.iteritems():
+            if not docs: continue
+            data = OrderedDict((doc._id, cls.make(doc)) for doc in docs)
+            del docs[:]
+            collection = cls.m.session.db[cls.m.collection_name]
+            spec = {'_id': {'$in': data.keys()}}
+            existing = []
+            for doc in collection.find(spec, fields=['_id']):
+                existing.append(data.pop(doc['_id']))
+            if self.replace:
+                # docs like trees are shared between repos, so they are
+                # overwritten in place rather than removed and reinserted
+                for doc in existing:
+                    collection.update({'_id': doc['_id']}, doc, upsert=True, safe=True)
+                self.written[cls.m.collection_name] += len(existing)
+            if not data: continue
+            try:
+                collection.insert(data.values(), safe=True, continue_on_error=True)
+            except DuplicateKeyError:
+                # a concurrent refresh got there first
+                pass
+            self.written[cls.m.collection_name] += len(data)
+        self._pending = 0
+        self.elapsed += time() - start
+
+    def log_stats(self):
+        total = sum(self.written.itervalues())
+        elapsed = time() - self.started
+        log.info('Refresh of %s: %d docs (%s) in %.1fs, %.1fs writing, %.0f docs/s',
+                 self.name, total,
+                 ', '.join('%s: %d' % kv for kv in sorted(self.written.items())),
+                 elapsed, self.elapsed, total / elapsed if elapsed else 0)
+
 class CommitRunBuilder(object):
     '''Class used to build up linear runs of single-parent commits'''
 
@@ -331,8 +457,10 @@ def unknown_commit_ids(all_commit_ids):
         result += [ oid for oid in chunk if oid not in known_commit_ids ]
     return result
 
-def compute_diffs(repo_id, tree_cache, rhs_ci):
-    '''compute simple differences between a commit and its first parent'''
+def compute_diffs(repo_id, tree_cache, rhs_ci, writer=None):
+    '''compute simple differences between a commit and its first parent
+
+    If a BulkWriter is given, the diff info is written through it.'''
     if rhs_ci.tree_id is None: return tree_cache
 
     def _update_cache(lhs_tree_ids, rhs_tree_ids):
@@ -384,7 +512,10 @@ def _update_cache(lhs_tree_ids, rhs_tree_ids):
     di = DiffInfoDoc(dict(
             _id=rhs_ci._id,
             differences=differences))
-    di.m.save()
+    if writer is None:
+        di.m.save()
+    else:
+        writer.insert(di)
     return tree_cache
 
 def send_notifications(repo, commit_ids):
@@ -522,31 +653,168 @@ def last_known_commit_id(all_commit_ids, new_commit_ids):
     if not new_commit_ids: return all_commit_ids[-1]
     return all_commit_ids[all_commit_ids.index(new_commit_ids[0]) - 1]
 
+def last_known_commit_id_in_graph(graph, new_commit_ids):
+    """
+    Like last_known_commit_id, with every commit id taken from graph, in the
+    order of graph.commit_ids(), but without listing them all.
+    """
+    if not len(graph): return None
+    if not new_commit_ids: return graph.commit_id(0)
+    i = graph.number(new_commit_ids[0]) + 1
+    return graph.commit_id(i if i < len(graph) else 0)
+
+
+LCD_TASK = 'allura.tasks.repo_tasks.compute_lcds'
+
+def refresh_lcds(repo, commit_ids):
+    '''Compute the LastCommit data for commit_ids, given newest first.
+
+    Small refreshes are computed right here.  From
+    scm.refresh.lcd_task_threshold commits up, the work is split into units
+    of scm.refresh.lcd_unit_size commits and one top-level directory (or the
+    root alone), which don't depend on each other, and each is posted as a
+    compute_lcds task for the taskd workers to share.  Return the id of the
+    job the units were posted under, if they were.'''
+    commit_ids = list(reversed(commit_ids))
+    threshold = asint(tg.config.get('scm.refresh.lcd_task_threshold', 1000))
+    if not threshold or len(commit_ids) < threshold:
+        compute_lcd_unit(repo, commit_ids)
+        return None
+    from allura.tasks import repo_tasks
+    unit_size = asint(tg.config.get('scm.refresh.lcd_unit_size', 1000))
+    job = str(bson.ObjectId())
+    units = 0
+    with h.push_config(c, project=repo.app.project, app=repo.app):
+        for chunk in utils.chunked_iter(commit_ids, unit_size):
+            chunk = list(chunk)
+            for subtree in [''] + sorted(_changed_subtrees(chunk)):
+                repo_tasks.compute_lcds.post(chunk, subtree, job=job)
+                units += 1
+    log.info('Posted %d last commit units as job %s for %s',
+             units, job, repo.full_fs_path)
+    return job
+
+def compute_lcd_unit(repo, commit_ids, subtree=None, job=None):
+    '''Compute the LastCommit data for commit_ids, oldest first, and write
+    it in batches.
+
+    If subtree is given, only the LCDs for that top-level directory are
+    computed, or for the root alone if it's ''.  A unit of a job stops if
+    the job is cancelled, and after scm.refresh.lcd_unit_time seconds; the
+    commit ids it didn't get to are returned, so it can be resumed.'''
+    model_cache = ModelCache()
+    lcid_cache = {}
+    writer = BulkWriter(repo.full_fs_path)
+    time_limit = asint(tg.config.get('scm.refresh.lcd_unit_time', 600))
+    start = last_check = time()
+    try:
+        for i, oid in enumerate(commit_ids):
+            if job is not None and time() - last_check > 5:
+                last_check = time()
+                if lcd_job_cancelled(job):
+                    log.info('Last commit job %s cancelled', job)
+                    return []
+                if time_limit and last_check - start > time_limit:
+                    return commit_ids[i:]
+            ci = model_cache.get(Commit, dict(_id=oid))
+            ci.set_context(repo)
+            compute_lcds(ci, model_cache, lcid_cache, subtree, writer)
+            if (i+1) % 100 == 0:
+                log.info('Compute last commit info %d: %s', (i+1), ci._id)
+    finally:
+        writer.flush()
+        writer.log_stats()
+    return []
+
+def cancel_lcds(repo):
+    '''Cancel the pending and running last commit units of a repo'''
+    from allura.model import MonQTask
+    MonQTask.query.update(
+        {'task_name': LCD_TASK,
+         'context.app_config_id': repo.app_config_id,
+         'state': {'$in': ['ready', 'busy']}},
+        {'$set': dict(state='skipped')},
+        multi=True)
 
-def compute_lcds(commit, model_cache, lcid_cache):
+def lcd_job_cancelled(job):
+    from allura.model import MonQTask
+    return MonQTask.query.find(
+        {'task_name': LCD_TASK, 'kwargs.job': job, 'state': 'skipped'}
+        ).count() > 0
+
+def _changed_subtrees(commit_ids):
+    '''Return the top-level directories changed by any of the commits'''
+    subtrees = set()
+    top_level = defaultdict(set) # object ids by top-level name
+    for di in DiffInfoDoc.m.find(dict(_id={'$in': commit_ids}), validate=False):
+        for d in di.differences:
+            name = d.name.strip('/')
+            if '/' in name:
+                subtrees.add(name.split('/', 1)[0])
+            else:
+                top_level[name].update(oid for oid in (d.lhs_id, d.rhs_id) if oid)
+    oids = set(chain(*top_level.values()))
+    if oids:
+        tree_ids = set(t._id for t in TreeDoc.m.find(
+            dict(_id={'$in': list(oids)}), fields=['_id'], validate=False))
+        subtrees.update(
+            name for name, ids in top_level.iteritems() if ids & tree_ids)
+    return subtrees
+
+def compute_lcds(commit, model_cache, lcid_cache, subtree=None, writer=None):
     '''
     Compute LastCommit data for every Tree node under this tree.
+
+    See compute_lcd_unit for subtree.  If a BulkWriter is given, the new
+    LastCommit docs are written through it instead of the ORM session.
     '''
     trees = model_cache.get(TreesDoc, dict(_id=commit._id))
     if not trees:
         log.error('Missing TreesDoc for %s; skipping compute_lcd' % commit)
         return
+    built = []
     with h.push_config(c, model_cache=model_cache, lcid_cache=lcid_cache):
-        _update_tree_cache(trees.tree_ids, model_cache)
+        if subtree is None:
+            _update_tree_cache(trees.tree_ids, model_cache)
         tree = _pull_tree(model_cache, commit.tree_id, commit)
-        _compute_lcds(tree, model_cache)
+        _compute_lcds(tree, model_cache, subtree, built)
         for changed_path in tree.commit.changed_paths:
             lcid_cache[changed_path] = tree.commit._id
+    if writer is not None:
+        for lcd in built:
+            _write_lcd(lcd, writer)
 
-def _compute_lcds(tree, cache):
+def _compute_lcds(tree, cache, subtree=None, built=None):
     path = tree.path().strip('/')
     if path not in tree.commit.changed_paths:
         return
-    if not cache.get(LastCommit, dict(commit_id=tree.commit._id, path=path)):
-        lcd = LastCommit._build(tree)
+    # a subtree unit does everything below the root, the root unit only it
+    if subtree is None or (path == '') == (subtree == ''):
+        if not cache.get(LastCommit, dict(commit_id=tree.commit._id, path=path)):
+            lcd = LastCommit._build(tree)
+            if built is not None:
+                built.append(lcd)
+    if subtree == '':
+        return
     for x in tree.tree_ids:
+        if subtree is not None and not path and x.name != subtree:
+            continue
         sub_tree = _pull_tree(cache, x.id, tree, x.name)
-        _compute_lcds(sub_tree, cache)
+        _compute_lcds(sub_tree, cache, subtree, built)
+
+def _write_lcd(lcd, writer):
+    '''Queue a new LastCommit in writer, and take it out of the session's
+    hands'''
+    st = state(lcd)
+    if st.status != st.new:
+        return
+    lcd._id = getattr(lcd, '_id', None) or bson.ObjectId()
+    writer.insert(LastCommitDoc(dict(
+        _id=lcd._id,
+        commit_id=lcd.commit_id,
+        path=lcd.path,
+        entries=[ dict(name=e.name, commit_id=e.commit_id) for e in lcd.entries ])))
+    st.status = st.clean
 
 def _pull_tree(cache, tree_id, *context):
     '''
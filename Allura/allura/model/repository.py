@@ -80,6 +80,18 @@ def commit(self, revision): # pragma no cover
     def all_commit_ids(self): # pragma no cover
         raise NotImplementedError, 'all_commit_ids'
 
+    def commits_since(self, tips):
+        '''Return (tips, commits) where tips are the ids of the commits the
+        repo's refs point to now, and commits are (commit id, parent ids)
+        pairs, heads first, for every commit not reachable from the given
+        tips.
+
+        Return None if the old tips can't be used (e.g. they were rewritten
+        away, or reach commits the refs no longer do, which the commit graph
+        mustn't keep), or if the implementation doesn't support incremental
+        refresh, in which case every commit is checked.'''
+        return None
+
     def new_commits(self, all_commits=False): # pragma no cover
         '''Return a list of native commits in topological order (heads first).
 
@@ -97,6 +109,14 @@ def refresh_commit_info(self, oid, lazy=True): # pragma no cover
         '''Refresh the data in the commit with id oid'''
         raise NotImplementedError, 'refresh_commit_info'
 
+    def refresh_commits_info(self, commit_ids, seen, lazy=True):
+        '''Refresh the data in each of the commits.  Implementations can
+        override this to batch their reads and writes.'''
+        for i, oid in enumerate(commit_ids):
+            self.refresh_commit_info(oid, seen, lazy)
+            if (i+1) % 100 == 0:
+                log.info('Refresh commit info %d: %s', (i+1), oid)
+
     def _setup_hooks(self, source_path=None): # pragma no cover
         '''Install a hook in the repository that will ping the refresh url for
         the repo.  Optionally provide a path from which to copy existing hooks.'''
@@ -298,6 +318,13 @@ def tarball_path(self):
                             self.project.shortname,
                             self.name)
 
+    @property
+    def commit_graph_path(self):
+        root = tg.config.get('scm.commit_graph.root')
+        if not root:
+            return None
+        return os.path.join(root, self.tool, str(self._id))
+
     def tarball_filename(self, revision, path=None):
         shortname = c.project.shortname.replace('/', '-')
         mount_point = c.app.config.options.mount_point
@@ -336,8 +363,12 @@ def commit(self, rev):
         return self._impl.commit(rev)
     def all_commit_ids(self):
         return self._impl.all_commit_ids()
+    def commits_since(self, tips):
+        return self._impl.commits_since(tips)
     def refresh_commit_info(self, oid, seen, lazy=True):
         return self._impl.refresh_commit_info(oid, seen, lazy)
+    def refresh_commits_info(self, commit_ids, seen, lazy=True):
+        return self._impl.refresh_commits_info(commit_ids, seen, lazy)
     def open_blob(self, blob):
         return self._impl.open_blob(blob)
     def blob_size(self, blob):
@@ -83,11 +83,27 @@ def update_index(self, objects_deleted, arefs):
         if arefs:
             index_tasks.add_artifacts.post([aref._id for aref in arefs])
 
+class ContextStampExtension(SessionExtension):
+    '''Invalidate the projects, app configs and users that taskd workers
+    keep between tasks when they are saved (see TaskContextCache)'''
+
+    def after_update(self, obj, st):
+        from .monq_model import TaskContextCache
+        TaskContextCache.saved(obj, st)
+
+    def after_delete(self, obj, st):
+        from .monq_model import TaskContextCache
+        TaskContextCache.saved(obj, st, deleted=True)
+
 main_doc_session = Session.by_name('main')
 project_doc_session = Session.by_name('project')
 task_doc_session = Session.by_name('task')
-main_orm_session = ThreadLocalORMSession(main_doc_session)
-project_orm_session = ThreadLocalORMSession(project_doc_session)
+main_orm_session = ThreadLocalORMSession(
+    doc_session=main_doc_session,
+    extensions = [ ContextStampExtension ])
+project_orm_session = ThreadLocalORMSession(
+    doc_session=project_doc_session,
+    extensions = [ ContextStampExtension ])
 task_orm_session = ThreadLocalORMSession(task_doc_session)
 artifact_orm_session = ThreadLocalORMSession(
     doc_session=project_doc_session,
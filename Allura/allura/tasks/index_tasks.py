@@ -20,10 +20,15 @@
 from contextlib import contextmanager
 
 from pylons import app_globals as g
+from ming.orm import session
+from ming.orm.base import state
+from tg import config
+from paste.deploy.converters import asint
 
 from allura.lib.decorators import task
 from allura.lib.exceptions import CompoundError
 from allura.lib.solr import make_solr_from_config
+from allura.lib.utils import chunked_list
 
 log = logging.getLogger(__name__)
 
@@ -32,6 +37,11 @@ def add_artifacts(ref_ids, update_solr=True, update_refs=True, solr_hosts=None):
     '''
     Add the referenced artifacts to SOLR and shortlinks.
 
+    Artifacts are loaded and indexed in batches of index_tasks.batch_size,
+    and sent to SOLR whenever index_tasks.batch_size documents or
+    index_tasks.batch_bytes bytes of text have accumulated, so memory use
+    doesn't grow with the number of ref_ids.
+
     :param solr_hosts: a list of solr hosts to use instead of the defaults
     :type solr_hosts: [str]
     '''
@@ -41,33 +51,48 @@ def add_artifacts(ref_ids, update_solr=True, update_refs=True, solr_hosts=None):
         solr = make_solr_from_config(solr_hosts)
     else:
         solr = g.solr
+    batch_size = asint(config.get('index_tasks.batch_size', 100))
+    batch_bytes = asint(config.get('index_tasks.batch_bytes', 5 * 1024 * 1024))
     exceptions = []
-    solr_updates = []
+    updates = _SolrBatch(solr, batch_size, batch_bytes)
     with _indexing_disabled(M.session.artifact_orm_session._get()):
-        for ref in M.ArtifactReference.query.find(dict(_id={'$in': ref_ids})):
-            try:
-                artifact = ref.artifact
-                s = solarize(artifact)
-                if s is None:
-                    continue
-                if update_solr:
-                    solr_updates.append(s)
-                if update_refs:
-                    if isinstance(artifact, M.Snapshot):
+        for chunk in chunked_list(ref_ids, batch_size):
+            refs = M.ArtifactReference.query.find(dict(_id={'$in': chunk})).all()
+            M.ArtifactReference.load_artifacts(refs)
+            artifacts = []
+            for ref in refs:
+                try:
+                    artifact = ref.artifact
+                    artifacts.append(artifact)
+                    s = solarize(artifact)
+                    if s is None:
                         continue
-                    # Find shortlinks in the raw text, not the escaped html
-                    # created by the `solarize()`.
-                    ref.references = [
-                        link.ref_id for link in find_shortlinks(artifact.index().get('text') or '')]
-            except Exception:
-                log.error('Error indexing artifact %s', ref._id)
-                exceptions.append(sys.exc_info())
-        solr.add(solr_updates)
+                    if update_solr:
+                        updates.add(s)
+                    if update_refs:
+                        if isinstance(artifact, M.Snapshot):
+                            continue
+                        # Find shortlinks in the raw text, not the escaped html
+                        # created by the `solarize()`.
+                        ref.references = [
+                            link.ref_id for link in find_shortlinks(artifact.index().get('text') or '')]
+                except Exception:
+                    log.error('Error indexing artifact %s', ref._id)
+                    exceptions.append(sys.exc_info())
+            # save the refs and drop this batch from the sessions' identity
+            # maps, so they don't hold on to every artifact we've indexed
+            M.main_orm_session.flush()
+            for obj in refs + artifacts:
+                if obj is not None and state(obj).status == state(obj).clean:
+                    session(obj).expunge(obj)
+        updates.flush()
 
     if len(exceptions) == 1:
         raise exceptions[0][0], exceptions[0][1], exceptions[0][2]
     if exceptions:
         raise CompoundError(*exceptions)
+    return 'Indexed %s of %s artifacts in %s solr updates' % (
+        updates.total, len(ref_ids), updates.flushes)
 
 @task
 def del_artifacts(ref_ids):
@@ -82,6 +107,64 @@ def del_artifacts(ref_ids):
 def commit():
     g.solr.commit()
 
+def _coalescing_post(func, superseded, superseded_kwargs, **defaults):
+    '''Replace func.post with a version that merges ref_ids into a pending
+    task with the same arguments when there is one.  Posts with the default
+    arguments also drop the ids from pending tasks for superseded that have
+    superseded_kwargs: a plain add is superseded by a later delete of the
+    same ids, and vice versa.  Adds that only update refs or go to other solr
+    hosts don't do the same work as a delete, so they are left alone.
+
+    Set index_tasks.coalesce_max_size = 0 in the config to disable.
+    '''
+    post = func.post
+    def coalescing_post(ref_ids, **kw):
+        from allura import model as M
+        max_size = asint(config.get('index_tasks.coalesce_max_size', 1000))
+        if not max_size or 'delay' in kw:
+            return post(ref_ids, **kw)
+        kwargs = dict(defaults, **kw)
+        if kwargs == defaults:
+            M.MonQTask.discard_ids(superseded, ref_ids, superseded_kwargs)
+        task = M.MonQTask.coalesce(func, ref_ids, kwargs, max_size=max_size)
+        if task is None:
+            task = post(list(ref_ids), **kwargs)
+        return task
+    func.post = coalescing_post
+    return func
+
+_add_artifacts_defaults = dict(update_solr=True, update_refs=True, solr_hosts=None)
+_coalescing_post(add_artifacts, del_artifacts, {}, **_add_artifacts_defaults)
+_coalescing_post(del_artifacts, add_artifacts, _add_artifacts_defaults)
+
+class _SolrBatch(object):
+    '''Accumulates solr documents and sends them in bounded batches'''
+
+    def __init__(self, solr, max_docs, max_bytes):
+        self.solr = solr
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.docs = []
+        self.size = 0
+        self.total = 0
+        self.flushes = 0
+
+    def add(self, doc):
+        self.docs.append(doc)
+        self.size += len(doc.get('text') or '') + len(doc.get('title') or '')
+        if len(self.docs) >= self.max_docs or self.size >= self.max_bytes:
+            self.flush()
+
+    def flush(self):
+        if not self.docs:
+            return
+        self.solr.add(self.docs)
+        self.total += len(self.docs)
+        self.flushes += 1
+        log.info('Sent %s documents to solr (%s so far)', len(self.docs), self.total)
+        self.docs = []
+        self.size = 0
+
 @contextmanager
 def _indexing_disabled(session):
     session.disable_artifact_index = session.skip_mod_date = True
@@ -16,9 +16,13 @@
 #       under the License.
 
 import logging
+import hashlib
 import HTMLParser
+from collections import OrderedDict
 
+import tg
 from pylons import tmpl_context as c, app_globals as g
+from paste.deploy.converters import asint
 from bson import ObjectId
 
 from allura.lib import helpers as h
@@ -29,6 +33,8 @@
 log = logging.getLogger(__name__)
 
 smtp_client = mail_util.SMTPClient()
+recipients = mail_util.RecipientResolver()
+_rendered = OrderedDict()
 
 @task
 def route_email(
@@ -78,9 +84,6 @@ def route_email(
 def sendmail(fromaddr, destinations, text, reply_to, subject,
              message_id, in_reply_to=None, sender=None):
     from allura import model as M
-    addrs_plain = []
-    addrs_html = []
-    addrs_multi = []
     if fromaddr is None:
         fromaddr = u'noreply@in.sf.net'
     elif '@' not in fromaddr:
@@ -92,47 +95,28 @@ def sendmail(fromaddr, destinations, text, reply_to, subject,
         else:
             fromaddr = user.email_address_header()
     # Divide addresses based on preferred email formats
-    for addr in destinations:
-        if mail_util.isvalid(addr):
-            addrs_plain.append(addr)
-        else:
-            try:
-                user = M.User.query.get(_id=ObjectId(addr), disabled=False)
-                if not user:
-                    log.warning('Cannot find user with ID: %s', addr)
-                    continue
-            except:
-                log.exception('Error looking up user with ID: %r' % addr)
-                continue
-            addr = user.email_address_header()
-            if not addr and user.email_addresses:
-                addr = user.email_addresses[0]
-                log.warning('User %s has not set primary email address, using %s',
-                            user._id, addr)
-            if not addr:
-                log.error("User %s (%s) has not set any email address, can't deliver",
-                          user._id, user.username)
-                continue
-            if user.get_pref('email_format') == 'plain':
-                addrs_plain.append(addr)
-            elif user.get_pref('email_format') == 'html':
-                addrs_html.append(addr)
-            else:
-                addrs_multi.append(addr)
-    htmlparser = HTMLParser.HTMLParser()
-    plain_msg = mail_util.encode_email_part(htmlparser.unescape(text), 'plain')
-    html_text = g.forge_markdown(email=True).convert(text)
+    addrs_plain = [addr for addr in destinations if mail_util.isvalid(addr)]
+    user_ids = [addr for addr in destinations if not mail_util.isvalid(addr)]
+    plain, addrs_html, addrs_multi = recipients.partition(user_ids)
+    addrs_plain += plain
+    if not (addrs_multi or addrs_plain or addrs_html):
+        return
+    plain_text, html_text = _render(text)
+    plain_msg = mail_util.encode_email_part(plain_text, 'plain')
     html_msg = mail_util.encode_email_part(html_text, 'html')
-    multi_msg = mail_util.make_multipart_message(plain_msg, html_msg)
-    smtp_client.sendmail(
-        addrs_multi, fromaddr, reply_to, subject, message_id,
-        in_reply_to, multi_msg, sender=sender)
-    smtp_client.sendmail(
-        addrs_plain, fromaddr, reply_to, subject, message_id,
-        in_reply_to, plain_msg, sender=sender)
-    smtp_client.sendmail(
-        addrs_html, fromaddr, reply_to, subject, message_id,
-        in_reply_to, html_msg, sender=sender)
+    multi_msg = mail_util.make_multipart_message(
+        mail_util.encode_email_part(plain_text, 'plain'),
+        mail_util.encode_email_part(html_text, 'html'))
+    with smtp_client.connection() as conn:
+        smtp_client.sendmail(
+            addrs_multi, fromaddr, reply_to, subject, message_id,
+            in_reply_to, multi_msg, sender=sender, connection=conn)
+        smtp_client.sendmail(
+            addrs_plain, fromaddr, reply_to, subject, message_id,
+            in_reply_to, plain_msg, sender=sender, connection=conn)
+        smtp_client.sendmail(
+            addrs_html, fromaddr, reply_to, subject, message_id,
+            in_reply_to, html_msg, sender=sender, connection=conn)
 
 @task
 def sendsimplemail(
@@ -155,11 +139,34 @@ def sendsimplemail(
             fromaddr = u'noreply@in.sf.net'
         else:
             fromaddr = user.email_address_header()
-    htmlparser = HTMLParser.HTMLParser()
-    plain_msg = mail_util.encode_email_part(htmlparser.unescape(text), 'plain')
-    html_text = g.forge_markdown(email=True).convert(text)
+    plain_text, html_text = _render(text)
+    plain_msg = mail_util.encode_email_part(plain_text, 'plain')
     html_msg = mail_util.encode_email_part(html_text, 'html')
     multi_msg = mail_util.make_multipart_message(plain_msg, html_msg)
     smtp_client.sendmail(
         [toaddr], fromaddr, reply_to, subject, message_id,
         in_reply_to, multi_msg, sender=sender)
+
+def _render(text):
+    '''Return the plain text and html parts for a message.
+
+    The last mail.render_cache_size (default 100) are remembered, so a
+    notification sent to many users is only rendered once.  They are kept
+    per project and tool, since links and macros are resolved against
+    c.project and c.app.
+    '''
+    project = getattr(c, 'project', None)
+    app = getattr(c, 'app', None)
+    key = (project and project._id, app and app.config._id,
+           hashlib.sha1(h.really_unicode(text).encode('utf-8')).digest())
+    parts = _rendered.pop(key, None)
+    if parts is None:
+        htmlparser = HTMLParser.HTMLParser()
+        parts = (htmlparser.unescape(text),
+                 g.forge_markdown(email=True).convert(text))
+    size = asint(tg.config.get('mail.render_cache_size', 100))
+    if size:
+        _rendered[key] = parts
+        while len(_rendered) > size:
+            _rendered.popitem(last=False)
+    return parts
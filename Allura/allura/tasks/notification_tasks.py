@@ -14,11 +14,50 @@
 #       KIND, either express or implied.  See the License for the
 #       specific language governing permissions and limitations
 #       under the License.
+from pylons import tmpl_context as c
+from tg import config
+from paste.deploy.converters import asint
 
+from allura.lib import helpers as h
 from allura.lib.decorators import task
 
 @task
 def notify(n_id, ref_id, topic):
     from allura import model as M
     M.Mailbox.deliver(n_id, ref_id, topic)
-    M.Mailbox.fire_ready()
+    schedule_fire_ready()
+
+@task
+def fire_ready():
+    '''Fire ready mailboxes, up to mailbox.fire_limit of them, and schedule
+    the next run (straight away if that left some ready).'''
+    from allura import model as M
+    # from here on, new notifications need another run to be queued
+    M.MonQTask.free_slot(_fire_ready_slot())
+    more = False
+    try:
+        more = M.Mailbox.fire_ready(limit=asint(config.get('mailbox.fire_limit', 1000)))
+    finally:
+        schedule_fire_ready(delay=0 if more else None)
+
+def schedule_fire_ready(delay=None):
+    '''Make sure a fire_ready task is queued, to run after delay seconds
+    (mailbox.fire_interval by default) if one isn't already.
+
+    Whether one is queued is tracked with a MonQTask slot, claimed
+    atomically here and freed when the task starts, so concurrent callers
+    can't queue more than one.'''
+    from allura import model as M
+    if not M.MonQTask.claim_slot(_fire_ready_slot()):
+        return None
+    if delay is None:
+        delay = asint(config.get('mailbox.fire_interval', 30))
+    try:
+        with h.push_config(c, project=None, app=None, user=None):
+            return fire_ready.post(delay=delay)
+    except:
+        M.MonQTask.free_slot(_fire_ready_slot())
+        raise
+
+def _fire_ready_slot():
+    return '%s.%s' % (fire_ready.__module__, fire_ready.__name__)
@@ -54,6 +54,7 @@ def reclone(*args, **kwargs):
     from ming.orm import ThreadLocalORMSession
     repo = c.app.repo
     if repo is not None:
+        M.repo_refresh.cancel_lcds(repo)
         shutil.rmtree(repo.full_fs_path, ignore_errors=True)
         repo.delete()
     ThreadLocalORMSession.flush_all()
@@ -84,11 +85,24 @@ def refresh(**kwargs):
     else:
         log.info('Refresh task for %s:%s skipped due to backlog', c.project.shortname, c.app.config.options.mount_point)
 
+@task
+def compute_lcds(commit_ids, subtree, job=None):
+    '''Compute the LastCommit data of one unit of a refresh, and post the
+    rest of it again if it ran out of time'''
+    from allura.model.repo_refresh import compute_lcd_unit
+    repo = c.app.repo
+    if repo is None:
+        return
+    left = compute_lcd_unit(repo, commit_ids, subtree, job)
+    if left:
+        compute_lcds.post(left, subtree, job=job)
+
 @task
 def uninstall(**kwargs):
     from allura import model as M
     repo = c.app.repo
     if repo is not None:
+        M.repo_refresh.cancel_lcds(repo)
         shutil.rmtree(repo.full_fs_path, ignore_errors=True)
         repo.delete()
     M.MergeRequest.query.remove(dict(
@@ -130,6 +130,21 @@ def test_artifactlink():
     ThreadLocalORMSession.flush_all()
     assert q.count() == 0
 
+@with_setup(setUp, tearDown)
+def test_load_artifacts():
+    pages = [WM.Page(title='LoadPage%s' % i) for i in range(3)]
+    ThreadLocalORMSession.flush_all()
+    refs = [M.ArtifactReference.from_artifact(pg) for pg in pages]
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    refs = M.ArtifactReference.query.find(dict(
+        _id={'$in': [pg.index_id() for pg in pages]})).all()
+    M.ArtifactReference.load_artifacts(refs)
+    # artifacts are cached on the refs, no further lookups needed
+    assert all('artifact' in ref.__dict__ for ref in refs)
+    titles = sorted(ref.artifact.title for ref in refs)
+    assert titles == ['LoadPage0', 'LoadPage1', 'LoadPage2'], titles
+
 @with_setup(setUp, tearDown)
 def test_gen_messageid():
     assert re.match(r'[0-9a-zA-Z]*.wiki@test.p.sourceforge.net', h.gen_message_id())
@@ -16,6 +16,7 @@
 #       under the License.
 
 import pprint
+from datetime import datetime, timedelta
 from nose.tools import with_setup
 
 from ming.orm import ThreadLocalORMSession
@@ -38,3 +39,123 @@ def test_basic_task():
     assert task
     task()
     assert task.result == 'I[5, 6]', task.result
+
+@with_setup(setUp)
+def test_get_batch():
+    for i in range(5):
+        M.MonQTask.post(pprint.pformat, ([i],))
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    tasks = M.MonQTask.get_batch(process='worker 1', batch_size=3)
+    assert len(tasks) == 3, tasks
+    assert all(t.state == 'busy' for t in tasks)
+    assert all(t.process == 'worker 1' for t in tasks)
+    assert all(t.lease_expires is not None for t in tasks)
+    tasks += M.MonQTask.get_batch(process='worker 2', batch_size=3)
+    assert len(tasks) == 5, tasks
+    assert len(set(t._id for t in tasks)) == 5
+    assert M.MonQTask.get_batch(batch_size=3) == []
+
+@with_setup(setUp)
+def test_get_batch_limits():
+    for i in range(3):
+        M.MonQTask.post(pprint.pformat, ([i],))
+        M.MonQTask.post(pprint.saferepr, ([i],))
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    tasks = M.MonQTask.get_batch(batch_size=10, limits={'pprint.pformat': 1})
+    names = [t.task_name for t in tasks]
+    assert names.count('pprint.pformat') == 1, names
+    assert names.count('pprint.saferepr') == 3, names
+
+@with_setup(setUp)
+def test_release_and_timeout_leases():
+    for i in range(3):
+        M.MonQTask.post(pprint.pformat, ([i],))
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    tasks = M.MonQTask.get_batch(batch_size=3, lease_time=0)
+    tasks[0]()
+    M.MonQTask.release(tasks[1:2])
+    assert M.MonQTask.query.find(dict(state='ready')).count() == 1
+    M.MonQTask.timeout_leases(datetime.utcnow() + timedelta(seconds=1))
+    assert M.MonQTask.query.find(dict(state='ready')).count() == 2
+    assert M.MonQTask.query.find(dict(state='complete')).count() == 1
+
+@with_setup(setUp)
+def test_start_leased():
+    for i in range(3):
+        M.MonQTask.post(pprint.pformat, ([i],))
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    tasks = M.MonQTask.get_batch(process='worker 1', batch_size=3)
+    assert M.MonQTask.start_leased(tasks[0])
+    assert tasks[0].time_start is not None
+    # a started task is no longer subject to its lease
+    M.MonQTask.timeout_leases(datetime.utcnow() + timedelta(hours=1))
+    ThreadLocalORMSession.close_all()
+    assert M.MonQTask.query.get(_id=tasks[0]._id).state == 'busy'
+    # an expired lease is lost to another worker
+    assert M.MonQTask.get_batch(process='worker 2', batch_size=3) != []
+    assert not M.MonQTask.start_leased(tasks[1])
+
+@with_setup(setUp)
+def test_renew_leases():
+    for i in range(2):
+        M.MonQTask.post(pprint.pformat, ([i],))
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    tasks = M.MonQTask.get_batch(batch_size=2, lease_time=60)
+    M.MonQTask.renew_leases(tasks, lease_time=3600)
+    M.MonQTask.timeout_leases(datetime.utcnow() + timedelta(seconds=120))
+    ThreadLocalORMSession.close_all()
+    assert M.MonQTask.query.find(dict(state='busy')).count() == 2
+    assert all(M.MonQTask.start_leased(t) for t in tasks)
+
+@with_setup(setUp)
+def test_queue_depth():
+    M.MonQTask.post(pprint.pformat, ([1],))
+    M.MonQTask.post(pprint.saferepr, ([1],))
+    M.MonQTask.post(pprint.saferepr, ([1],), delay=60)
+    ThreadLocalORMSession.flush_all()
+    assert M.MonQTask.queue_depth() == 2
+    assert M.MonQTask.queue_depth(['pprint.safe*']) == 1
+    assert M.MonQTask.queue_depth(['pprint.*']) == 2
+    assert M.MonQTask.queue_depth(['other.*']) == 0
+
+@with_setup(setUp)
+def test_task_context_cache():
+    from pylons import tmpl_context as c
+    from ming.base import Object
+    cache = M.TaskContextCache(10)
+    context = Object(project_id=c.project._id,
+                     app_config_id=c.project.app_config('admin')._id,
+                     user_id=c.user._id)
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    project, app, user = cache.context(context)
+    assert app.config.options.mount_point == 'admin', app.config.options
+    app.some_state = 1
+    ThreadLocalORMSession.close_all()
+    assert cache.context(context) == (project, app, user)
+    assert not hasattr(app, 'some_state')
+    assert cache.stats['Project hits'] == 1, cache.stats
+    assert cache.stats['app hits'] == 1, cache.stats
+    # the cached objects are only checked with one query for their stamps
+    assert cache.stats['lookups'] == 6, cache.stats
+    assert cache.stats['queries'] == 5, cache.stats
+    # saving only volatile fields keeps the project cached
+    M.Project.query.get(_id=project._id).last_updated = datetime.utcnow()
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    assert cache.context(context)[0] is project
+    # a changed project is loaded again, along with its tools
+    M.Project.query.get(_id=project._id).short_description = 'changed'
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    project2, app2, user2 = cache.context(context)
+    assert project2 is not project
+    assert project2.short_description == 'changed'
+    assert app2 is not app
+    assert user2 is user
+    assert cache.stats['Project misses'] == 2, cache.stats
@@ -217,7 +217,7 @@ def test_email(self):
         assert_equal(M.Notification.query.get()['from_address'], '"Test Admin" <test-admin@users.localhost>')
         assert_equal(M.Mailbox.query.find().count(), 2)
 
-        M.MonQTask.run_ready()  # sends the notification out into "mailboxes", and from mailboxes into email tasks
+        M.MonQTask.run_ready()  # sends the notification out into "mailboxes"
         mboxes = M.Mailbox.query.find().all()
         assert_equal(len(mboxes), 2)
         assert_equal(len(mboxes[0].queue), 1)
@@ -225,7 +225,9 @@ def test_email(self):
         assert_equal(len(mboxes[1].queue), 1)
         assert not mboxes[1].queue_empty
 
-        email_tasks = M.MonQTask.query.find({'state': 'ready'}).all()
+        M.MonQTask.run_ready()  # fire_ready sends them from mailboxes into email tasks
+        email_tasks = M.MonQTask.query.find({
+            'state': 'ready', 'task_name': 'allura.tasks.mail_tasks.sendmail'}).all()
         assert_equal(len(email_tasks), 2)  # make sure both subscribers will get an email
 
         first_destinations = [e.kwargs['destinations'][0] for e in email_tasks]
@@ -322,6 +324,19 @@ def test_summary_sub(self):
         self._post_notification()
         M.Mailbox.fire_ready()
 
+    @mock.patch.object(M.Mailbox, 'fire')
+    def test_fire_ready_limit(self, fire):
+        for i in range(3):
+            M.Mailbox(type='direct', user_id=bson.ObjectId(), queue=['n%s' % i], queue_empty=False)
+        ThreadLocalORMSession.flush_all()
+        ThreadLocalORMSession.close_all()
+        assert M.Mailbox.fire_ready(limit=2, batch_size=1)
+        assert_equal(fire.call_count, 2)
+        assert_equal(M.Mailbox.query.find(dict(queue_empty=False)).count(), 1)
+        assert not M.Mailbox.fire_ready(limit=2)
+        assert_equal(fire.call_count, 3)
+        assert_equal(M.Mailbox.query.find(dict(queue_empty=False)).count(), 0)
+
     def test_message(self):
         self._test_message()
 
@@ -617,3 +617,46 @@ def test_pruning_instance_flush(self, session):
         session.assert_called_once_with(tree1)
         session.return_value.flush.assert_called_once_with(tree1)
         session.return_value.expunge.assert_called_once_with(tree1)
+
+
+class TestBulkWriter(unittest.TestCase):
+    def setUp(self):
+        setup_basic_test()
+        setup_global_objects()
+
+    def _tree(self, _id):
+        return M.repo.TreeDoc(dict(
+                _id=_id, tree_ids=[], blob_ids=[], other_ids=[]))
+
+    def test_batches(self):
+        writer = M.repo_refresh.BulkWriter('test', batch_size=2)
+        writer.insert(self._tree('t1'))
+        self.assertEqual(M.repo.TreeDoc.m.find().count(), 0)
+        writer.insert(self._tree('t2'))
+        self.assertEqual(M.repo.TreeDoc.m.find().count(), 2)
+        writer.insert(M.repo.DiffInfoDoc(dict(_id='c1', differences=[])))
+        writer.flush()
+        self.assertEqual(M.repo.DiffInfoDoc.m.find().count(), 1)
+        self.assertEqual(writer.written, {'repo_tree': 2, 'repo_diffinfo': 1})
+
+    def test_existing(self):
+        self._tree('t1').m.insert()
+        writer = M.repo_refresh.BulkWriter('test')
+        writer.insert(self._tree('t1'))
+        writer.insert(self._tree('t2'))
+        writer.insert(self._tree('t2'))
+        writer.flush()
+        self.assertEqual(
+            sorted(t._id for t in M.repo.TreeDoc.m.find()), ['t1', 't2'])
+        self.assertEqual(writer.written, {'repo_tree': 1})
+
+    def test_replace(self):
+        M.repo.DiffInfoDoc(dict(_id='c1', differences=[
+                dict(name='a', lhs_id='x', rhs_id='y')])).m.insert()
+        writer = M.repo_refresh.BulkWriter('test', replace=True)
+        writer.insert(M.repo.DiffInfoDoc(dict(_id='c1', differences=[])))
+        writer.insert(M.repo.DiffInfoDoc(dict(_id='c2', differences=[])))
+        writer.flush()
+        self.assertEqual(M.repo.DiffInfoDoc.m.get(_id='c1').differences, [])
+        self.assertEqual(M.repo.DiffInfoDoc.m.find().count(), 2)
+        self.assertEqual(writer.written, {'repo_diffinfo': 2})
@@ -15,18 +15,27 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+import socket
+import asyncore
+import smtplib
+import threading
+from datetime import datetime
+
 from nose.tools import assert_raises, assert_in
 from datadiff.tools import assert_equal
 from ming.orm import ThreadLocalORMSession
+from pylons import tmpl_context as c
 from mock import Mock, call, patch
 import pymongo
 
 from alluratest.controller import setup_basic_test, setup_global_objects
 from allura.command import base, script, set_neighborhood_features, \
-                           create_neighborhood, show_models, taskd_cleanup
+                           create_neighborhood, show_models, taskd_cleanup, \
+                           taskd, smtp_server
 from allura import model as M
 from forgeblog import model as BM
 from allura.lib.exceptions import InvalidNBFeatureValueError
+from allura.lib.solr import MockSOLR
 from allura.tests import decorators as td
 
 test_config = 'test.ini#main'
@@ -353,9 +362,11 @@ class TestReindexCommand(object):
 
     @patch('allura.command.show_models.g')
     def test_skip_solr_delete(self, g):
+        # only documents of artifacts that no longer exist are deleted
+        g.solr.search.return_value = MockSOLR.MockHits([{'id': 'gone#1'}])
         cmd = show_models.ReindexCommand('reindex')
         cmd.run([test_config, '-p', 'test', '--solr'])
-        assert g.solr.delete.called, 'solr.delete() must be called'
+        g.solr.delete.assert_called_with(q='id:(gone#1)')
         g.solr.delete.reset_mock()
         cmd.run([test_config, '-p', 'test', '--solr', '--skip-solr-delete'])
         assert not g.solr.delete.called, 'solr.delete() must not be called'
@@ -421,6 +432,95 @@ def on_post(chunk, **kw):
         ]
         assert_equal(expected, add_artifacts.post.call_args_list)
 
+    @td.with_wiki
+    @patch('allura.command.show_models.g')
+    @patch('allura.command.show_models.add_artifacts')
+    def test_incremental(self, add_artifacts, g):
+        from forgewiki import model as WM
+        g.solr.search.return_value = MockSOLR.MockHits()
+        def reindexed(*args):
+            add_artifacts.reset_mock()
+            cmd = show_models.ReindexCommand('reindex')
+            cmd.run([test_config, '-p', 'test'] + list(args))
+            return set(id for call in add_artifacts.call_args_list for id in call[0][0])
+        page = WM.Page.query.get(app_config_id=c.app.config._id, title='Home')
+        page_id = page._id
+        assert_in(page.index_id(), reindexed())
+        assert_equal(reindexed('--incremental'), set())
+        page = WM.Page.query.get(_id=page_id)
+        page.text = 'changed'
+        ThreadLocalORMSession.flush_all()
+        assert_equal(reindexed('--incremental'), set([page.index_id()]))
+        # a reindex of only solr keeps its own checkpoints
+        assert_in(page.index_id(), reindexed('--incremental', '--solr'))
+
+    @patch('allura.command.show_models.g')
+    @patch.object(show_models.ReindexCommand, '_remove_stale')
+    def test_incremental_remove_stale(self, _remove_stale, g):
+        cmd = show_models.ReindexCommand('reindex')
+        cmd.run([test_config, '-p', 'test', '--incremental'])
+        assert not _remove_stale.called, '_remove_stale() must not be called'
+        cmd.run([test_config, '-p', 'test', '--incremental', '--remove-stale'])
+        assert_equal(_remove_stale.call_count, 1)
+        cmd.run([test_config, '-p', 'test'])
+        assert_equal(_remove_stale.call_count, 2)
+
+    @td.with_wiki
+    @patch('allura.command.show_models.g')
+    def test_remove_orphaned_shortlinks(self, g):
+        from forgewiki import model as WM
+        g.solr.search.return_value = MockSOLR.MockHits()
+        page = WM.Page.query.get(app_config_id=c.app.config._id, title='Home')
+        page_ref_id = page.index_id()
+        M.Shortlink(ref_id='gone#1', project_id=c.project._id,
+                    app_config_id=c.app.config._id,
+                    link='gone', url='/p/test/wiki/gone/')
+        ThreadLocalORMSession.flush_all()
+        cmd = show_models.ReindexCommand('reindex')
+        cmd.run([test_config, '-p', 'test', '--refs'])
+        assert_equal(M.Shortlink.query.find(dict(ref_id='gone#1')).count(), 0)
+        assert_equal(M.Shortlink.query.find(dict(ref_id=page_ref_id)).count(), 1)
+
+    @patch('allura.command.show_models.multiprocessing')
+    def test_workers(self, multiprocessing):
+        pool = multiprocessing.Pool.return_value
+        pool.imap_unordered.side_effect = lambda func, ids: [
+            dict(project=str(id), artifacts=3, errors=0, failure=None, seconds=1.0)
+            for id in ids]
+        cmd = show_models.ReindexCommand('reindex')
+        cmd.run([test_config, '-p', 'test', '--workers', '2'])
+        multiprocessing.Pool.assert_called_once_with(
+            2, show_models._init_reindex_worker, (cmd,))
+        project = M.Project.query.get(shortname='test')
+        pool.imap_unordered.assert_called_once_with(
+            show_models._reindex_worker, [project._id])
+        assert pool.close.called
+        assert_equal([r['artifacts'] for r in cmd.results], [3])
+
+    @patch('allura.command.show_models.g')
+    @patch.object(show_models.ReindexCommand, '_reindex_class')
+    def test_project_failure(self, _reindex_class, g):
+        _reindex_class.side_effect = ValueError('oops')
+        cmd = show_models.ReindexCommand('reindex')
+        cmd.run([test_config, '-p', 'test'])
+        assert_equal(len(cmd.results), 1)
+        assert_equal(cmd.results[0]['project'], 'test')
+        assert_in('ValueError: oops', cmd.results[0]['failure'])
+
+    def test_reindex_checkpoints(self):
+        checkpoints = show_models.ReindexCheckpoints(
+            M.main_doc_session.db['test_reindex_checkpoint'])
+        project_id = M.Project.query.get(shortname='test')._id
+        assert_equal(checkpoints.get(project_id, M.Artifact), None)
+        checkpoints.set(project_id, M.Artifact, datetime(2013, 1, 1), 'x')
+        assert_equal(checkpoints.get(project_id, M.Artifact),
+                     (datetime(2013, 1, 1), 'x'))
+        checkpoints.clear(project_id)
+        assert_equal(checkpoints.get(project_id, M.Artifact), None)
+        assert_equal(show_models.ReindexCheckpoints.after(None, 'x'), {'$or': [
+            {'mod_date': {'$ne': None}},
+            {'mod_date': None, '_id': {'$gt': 'x'}}]})
+
     @patch('allura.command.show_models.add_artifacts')
     def test_post_add_artifacts_other_error(self, add_artifacts):
         def on_post(chunk, **kw):
@@ -430,3 +530,128 @@ def on_post(chunk, **kw):
         cmd.options = Mock(ming_config=None)
         with td.raises(pymongo.errors.InvalidDocument):
             cmd._post_add_artifacts(range(5))
+
+
+class TestTaskdWorkerPool(object):
+
+    def test_from_option(self):
+        pool = taskd.WorkerPool.from_option('allura.tasks.repo_tasks.*,x.y:1:4')
+        assert_equal(pool.only, ['allura.tasks.repo_tasks.*', 'x.y'])
+        assert_equal((pool.min_workers, pool.max_workers), (1, 4))
+        pool = taskd.WorkerPool.from_option(':2:2')
+        assert_equal(pool.only, None)
+        with td.raises(ValueError):
+            taskd.WorkerPool.from_option('allura.tasks.repo_tasks.*')
+
+    @patch('allura.command.taskd.subprocess.Popen')
+    def test_scale(self, Popen):
+        Popen.side_effect = lambda args: Mock(pid=len(Popen.call_args_list))
+        worker_args = Mock(return_value=['paster', 'taskd', 'test.ini'])
+        pool = taskd.WorkerPool(['index_tasks.*'], 1, 3)
+        pool.scale(None, 10, worker_args)
+        assert_equal(len(pool.procs), 1)
+        pool.scale(25, 10, worker_args)
+        assert_equal(len(pool.procs), 3)
+        pool.scale(500, 10, worker_args)
+        assert_equal(len(pool.procs), 3)
+        stopped = pool.procs[1:]
+        pool.scale(0, 10, worker_args)
+        assert_equal(len(pool.procs), 1)
+        for proc in stopped:
+            proc.send_signal.assert_called_once_with(taskd.signal.SIGTERM)
+        worker_args.assert_called_with(['index_tasks.*'])
+
+    @patch('allura.command.taskd.time.time')
+    @patch('allura.command.taskd.subprocess.Popen')
+    def test_restart_backoff(self, Popen, time):
+        Popen.side_effect = lambda args: Mock(
+            pid=len(Popen.call_args_list), returncode=1,
+            poll=Mock(return_value=1))
+        worker_args = Mock(return_value=['paster', 'taskd', 'test.ini'])
+        pool = taskd.WorkerPool(None, 1, 1)
+        time.return_value = 1000
+        pool.scale(None, 10, worker_args)
+        # each crash on startup doubles the delay before the next restart
+        for delay in (1, 2, 4):
+            pool.reap()
+            assert_equal(pool.restart_after, time.return_value + delay)
+            pool.scale(None, 10, worker_args)
+            assert_equal(len(pool.procs), 0)
+            time.return_value += delay
+            pool.scale(None, 10, worker_args)
+            assert_equal(len(pool.procs), 1)
+        pool.crashes = 100
+        pool.reap()
+        assert_equal(pool.restart_after, time.return_value + pool.max_backoff)
+        # a worker that ran for a while before exiting resets the backoff
+        time.return_value += pool.max_backoff
+        pool.scale(None, 10, worker_args)
+        time.return_value += pool.min_uptime
+        pool.reap()
+        assert_equal(pool.crashes, 0)
+
+    def test_parse_batch_limits(self):
+        assert_equal(taskd.parse_batch_limits(None), {})
+        assert_equal(taskd.parse_batch_limits('a.*=1, b=3'), {'a.*': 1, 'b': 3})
+
+
+class TestMailServer(object):
+
+    def setUp(self):
+        setup_basic_test()
+        self.server = smtp_server.MailServer(
+            ('127.0.0.1', 0), None, queue_size=1, workers=0, max_connections=1)
+        self.port = self.server.socket.getsockname()[1]
+        self.running = True
+        self.thread = threading.Thread(target=self._loop)
+        self.thread.start()
+
+    def tearDown(self):
+        self.running = False
+        self.thread.join()
+        asyncore.close_all()
+
+    def _loop(self):
+        while self.running:
+            asyncore.loop(timeout=0.05, count=1)
+
+    def test_backpressure(self):
+        client = smtplib.SMTP('127.0.0.1', self.port)
+        client.sendmail('a@example.com', ['b@example.com'], 'Subject: 1\n\n1')
+        # the queue is full, so the next message has to wait
+        with td.raises(smtplib.SMTPDataError):
+            client.sendmail('a@example.com', ['b@example.com'], 'Subject: 2\n\n2')
+        # and so do connections beyond max_connections
+        with td.raises(smtplib.SMTPConnectError):
+            smtplib.SMTP('127.0.0.1', self.port)
+        client.quit()
+        assert_equal(self.server.queue.qsize(), 1)
+        peer, mailfrom, rcpttos, data = self.server.queue.get()
+        assert_equal((mailfrom, rcpttos, data), ('a@example.com', ['b@example.com'], 'Subject: 1\n\n1'))
+        assert_equal(self.server.stats['accepted'], 1)
+        assert_equal(self.server.stats['rejected'], 1)
+        assert_equal(self.server.stats['refused'], 1)
+
+    @patch('allura.tasks.mail_tasks.route_email')
+    def test_post(self, route_email):
+        route_email.post.side_effect = [Exception('mongo is down'), None]
+        self.server.post(('127.0.0.1', 1), 'a@example.com', ['b@example.com'], 'data')
+        assert_equal(route_email.post.call_count, 2)
+        assert_equal(route_email.post.call_args[1]['data'], 'data')
+        assert_equal(self.server.stats['posted'], 1)
+
+    @patch('allura.tasks.mail_tasks.route_email')
+    def test_shutdown_posts_queued(self, route_email):
+        client = smtplib.SMTP('127.0.0.1', self.port)
+        client.sendmail('a@example.com', ['b@example.com'], 'Subject: 1\n\n1')
+        client.quit()
+        self.running = False
+        self.thread.join()
+        self.server.workers = 1
+        self.server.stop()
+        self.server.serve_forever()
+        assert_equal(route_email.post.call_count, 1)
+        assert_equal(self.server.queue.qsize(), 0)
+        # no longer accepting
+        with td.raises(socket.error):
+            smtplib.SMTP('127.0.0.1', self.port)
@@ -0,0 +1,105 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+import os
+import unittest
+
+from testfixtures import TempDirectory
+
+from allura.lib.commit_graph import CommitGraph
+
+
+def _id(n):
+    return ('%02x' % n) * 20
+
+
+class TestCommitGraph(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = TempDirectory()
+        self.path = os.path.join(self.dir.path, 'git', 'graph')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_save_and_load(self):
+        graph = CommitGraph()
+        added = graph.add([
+                (_id(3), [_id(2)]),
+                (_id(2), [_id(1)]),
+                (_id(1), []),
+            ], [_id(3)])
+        self.assertEqual(added, [_id(3), _id(2), _id(1)])
+        graph.save(self.path)
+        graph = CommitGraph.load(self.path)
+        self.assertEqual(len(graph), 3)
+        self.assertEqual(graph.tips, [_id(3)])
+        self.assertEqual(list(graph.commit_ids()), [_id(3), _id(2), _id(1)])
+        self.assertEqual(graph.parent_ids(_id(3)), [_id(2)])
+        self.assertEqual(graph.parent_ids(_id(1)), [])
+
+    def test_incremental(self):
+        graph = CommitGraph()
+        graph.add([(_id(2), [_id(1)]), (_id(1), [])], [_id(2)])
+        graph.save(self.path)
+        graph = CommitGraph.load(self.path)
+        added = graph.add([
+                (_id(4), [_id(3), _id(1)]),
+                (_id(3), [_id(2)]),
+                (_id(2), [_id(1)]),  # already known
+            ], [_id(4)])
+        self.assertEqual(added, [_id(4), _id(3)])
+        graph.save(self.path)
+        graph = CommitGraph.load(self.path)
+        self.assertEqual(graph.tips, [_id(4)])
+        self.assertEqual(list(graph.commit_ids()),
+                         [_id(4), _id(3), _id(2), _id(1)])
+        self.assertEqual(graph.parent_ids(_id(4)), [_id(3), _id(1)])
+        self.assertEqual(graph.parent_ids(_id(2)), [_id(1)])
+        self.assertIn(_id(3), graph)
+        self.assertNotIn(_id(5), graph)
+
+    def test_lookup(self):
+        # ids out of order with how they're added, saved in several batches
+        ids = [_id(n * 37 % 251) for n in range(1, 61)]
+        graph = CommitGraph()
+        for batch in range(3):
+            graph.add([
+                    (ids[i], [ids[i - 1]] if i else [])
+                    for i in reversed(range(batch * 20, batch * 20 + 20))
+                ], [ids[batch * 20 + 19]])
+            graph.save(self.path)
+            graph.close()
+            graph = CommitGraph.load(self.path)
+        graph.add([(_id(0), [ids[-1]])], [_id(0)])
+        for n, commit_id in enumerate(ids + [_id(0)]):
+            self.assertEqual(graph.number(commit_id), n)
+            self.assertEqual(graph.commit_id(n), commit_id)
+            self.assertIn(commit_id, graph)
+        self.assertEqual(graph.parent_ids(ids[30]), [ids[29]])
+        self.assertEqual(graph.parent_ids(_id(0)), [ids[-1]])
+        self.assertNotIn(_id(1), graph)
+        self.assertRaises(KeyError, graph.number, _id(1))
+
+    def test_load_unusable(self):
+        self.assertIsNone(CommitGraph.load(self.path))
+        CommitGraph().save(self.path)
+        with open(self.path, 'ab') as fp:
+            fp.write('junk')
+        self.assertIsNone(CommitGraph.load(self.path))
+        open(self.path, 'w').close()
+        self.assertIsNone(CommitGraph.load(self.path))
@@ -16,8 +16,13 @@
 #       under the License.
 
 import unittest
+from datetime import datetime
 
-from allura.lib.diff import HtmlSideBySideDiff
+import mock
+
+from alluratest.controller import setup_basic_test
+from allura.lib.diff import HtmlSideBySideDiff, DiffCache, read_lines
+from allura.model.repo import DiffCacheDoc
 
 
 class TestHtmlSideBySideDiff(unittest.TestCase):
@@ -137,3 +142,116 @@ def test_make_table(self):
 '''.strip()
         html = self.diff.make_table(a, b, 'file a', 'file b')
         self.assertEquals(html, expected)
+
+    def test_iter_table(self):
+        a = ['line %d\n' % i for i in range(20)]
+        b = a[:]
+        b[1] = b[18] = 'changed\n'
+        rows = list(self.diff.iter_table(
+            a, b, 'file a', 'file b', context=1,
+            expand_url='/ci/tree/f?barediff=x&context=all',
+            truncated='Diff truncated'))
+        self.assertTrue(rows[0].startswith('<table class="side-by-side-diff">'))
+        self.assertEquals(rows[-1], '\n</table>')
+        gaps = [r for r in rows if 'diff-gap' in r]
+        self.assertEquals(len(gaps), 1)
+        self.assertIn('<a class="diff-expand" href="/ci/tree/f?barediff=x&amp;context=all"', gaps[0])
+        self.assertIn('<td colspan="4" class="diff-truncated">Diff truncated</td>', rows[-2])
+        # without context every line is shown
+        rows = list(self.diff.iter_table(a, b, context=None))
+        self.assertEquals(len(rows), 22)
+        self.assertEquals(''.join(rows), self.diff.make_table(a, b, context=None))
+
+    def test_read_lines(self):
+        lines = ['a\n', 'bb\n', 'ccc\n']
+        self.assertEquals(read_lines(lines, 10, 100), (lines, False))
+        self.assertEquals(read_lines(lines, 2, 100), (lines[:2], True))
+        self.assertEquals(read_lines(lines, 10, 6), (lines[:2], True))
+        self.assertEquals(read_lines([], 10, 100), ([], False))
+
+
+class TestDiffCache(unittest.TestCase):
+
+    def setUp(self):
+        setup_basic_test()
+        self.cache = DiffCache()
+
+    def _key(self, b_id, view='sidebyside'):
+        return self.cache.key('a1', b_id, 'aREADME', 'bREADME', view, 4)
+
+    def test_key(self):
+        self.assertEqual(self._key('b1'), self._key(u'b1'))
+        self.assertNotEqual(self._key('b1'), self._key('b2'))
+        self.assertNotEqual(self._key('b1'), self._key('b1', ''))
+
+    def test_render(self):
+        render = mock.Mock(return_value='<table>\xc3\xa9</table>')
+        key = self._key('b1')
+        self.assertEqual(self.cache.render(key, render), u'<table>\xe9</table>')
+        self.assertEqual(self.cache.render(key, render), u'<table>\xe9</table>')
+        self.assertEqual(render.call_count, 1)
+        self.assertEqual(self.cache.stats['misses'], 1)
+        self.assertEqual(self.cache.stats['hits'], 1)
+
+    def test_touch_interval(self):
+        key = self._key('b1')
+        self.cache.set(key, u'diff')
+        last_used = DiffCacheDoc.m.get(_id=key).last_used
+        # a recently used diff isn't written again on a hit
+        self.cache.get(key)
+        self.assertEqual(DiffCacheDoc.m.get(_id=key).last_used, last_used)
+        DiffCacheDoc.m.update_partial(
+            dict(_id=key), {'$set': dict(last_used=datetime(2000, 1, 1))})
+        self.cache.get(key)
+        self.assertGreater(DiffCacheDoc.m.get(_id=key).last_used, datetime(2000, 1, 1))
+
+    def test_stream(self):
+        key = self._key('b1')
+        chunks = self.cache.stream(key, iter(['<table>', u'\xe9', '</table>']))
+        self.assertEqual(chunks.next(), '<table>')
+        self.assertEqual(DiffCacheDoc.m.find().count(), 0)
+        self.assertEqual(list(chunks), ['\xc3\xa9', '</table>'])
+        self.assertEqual(self.cache.get(key), u'<table>\xe9</table>')
+
+    @mock.patch.dict('allura.lib.diff.config', {'scm.diff_cache.max_size': '10'})
+    def test_stream_too_large(self):
+        chunks = ['<tr>%d</tr>' % i for i in range(100)]
+        self.assertEqual(list(self.cache.stream(self._key('b1'), chunks)), chunks)
+        self.assertEqual(DiffCacheDoc.m.find().count(), 0)
+        self.assertEqual(self.cache.stats['too large'], 1)
+
+    @mock.patch.dict('allura.lib.diff.config', {'scm.diff_cache.max_entries': '2'})
+    def test_evict_least_recently_used(self):
+        for b_id in ('b1', 'b2'):
+            self.cache.set(self._key(b_id), u'diff')
+        DiffCacheDoc.m.update_partial(
+            dict(_id=self._key('b2')), {'$set': dict(last_used=datetime(2000, 1, 1))})
+        self.cache.get(self._key('b1'))
+        self.cache.set(self._key('b3'), u'diff')
+        self.assertEqual(
+            sorted(doc._id for doc in DiffCacheDoc.m.find()),
+            sorted([self._key('b1'), self._key('b3')]))
+        self.assertEqual(self.cache.stats['evictions'], 1)
+
+    @mock.patch.dict('allura.lib.diff.config', {'scm.diff_cache.max_entries': '100'})
+    @mock.patch('allura.model.repo.DiffCacheDoc')
+    def test_evict_check_interval(self, DiffCacheDoc):
+        DiffCacheDoc.m.count.return_value = 0
+        for i in range(25):
+            self.cache.set(self._key('b%d' % i), u'diff')
+        # counted every tenth of max_entries stores
+        self.assertEqual(DiffCacheDoc.m.count.call_count, 2)
+
+    @mock.patch.dict('allura.lib.diff.config', {'scm.diff_cache.max_size': '10'})
+    def test_too_large(self):
+        self.cache.set(self._key('b1'), u'diff' * 100)
+        self.assertEqual(DiffCacheDoc.m.find().count(), 0)
+        self.assertEqual(self.cache.stats['too large'], 1)
+
+    @mock.patch.dict('allura.lib.diff.config', {'scm.diff_cache.max_entries': '0'})
+    def test_disabled(self):
+        render = mock.Mock(return_value='diff')
+        self.cache.render(self._key('b1'), render)
+        self.cache.render(self._key('b1'), render)
+        self.assertEqual(render.call_count, 2)
+        self.assertEqual(DiffCacheDoc.m.find().count(), 0)
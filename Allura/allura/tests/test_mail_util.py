@@ -18,10 +18,15 @@
 #       under the License.
 
 import unittest
+import asyncore
+import smtpd
+import threading
 from email.MIMEMultipart import MIMEMultipart
 from email.MIMEText import MIMEText
 from email import header
 
+import mock
+import tg
 from nose.tools import raises, assert_equal
 from ming.orm import ThreadLocalORMSession
 
@@ -29,6 +34,8 @@
 from allura.lib.utils import ConfigProxy
 
 from allura.lib.mail_util import parse_address, parse_message, Header
+from allura.lib.mail_util import SMTPClient, RecipientResolver, encode_email_part
+from allura import model as M
 from allura.lib.exceptions import AddressException
 from allura.tests import decorators as td
 
@@ -108,6 +115,44 @@ def test_unicode_complex_message(self):
             assert isinstance(part['payload'], unicode)
 
 
+class TestRecipientResolver(unittest.TestCase):
+
+    def setUp(self):
+        setup_basic_test()
+        setup_global_objects()
+        self.users = [M.User.by_username(u) for u in
+                      ('test-admin', 'test-user', 'test-user-1', 'test-user-2')]
+        self.users[0].set_pref('email_format', 'plain')
+        self.users[1].set_pref('email_format', 'html')
+        self.users[1].set_pref('email_address', 'test-user@example.com')
+        self.users[2].set_pref('email_address', None)
+        self.users[2].email_addresses = ['other@example.com']
+        self.users[3].disabled = True
+        ThreadLocalORMSession.flush_all()
+        self.ids = [str(u._id) for u in self.users] + ['bogus']
+
+    def test_partition(self):
+        resolver = RecipientResolver()
+        plain, html, multi = resolver.partition(self.ids)
+        assert_equal(map(str, plain), ['"Test Admin" <%s>' % self.users[0].get_pref('email_address')])
+        assert_equal(map(str, html), ['"Test User" <test-user@example.com>'])
+        assert_equal(multi, ['other@example.com'])
+        recipients = resolver.resolve(self.ids)
+        assert_equal(recipients[self.ids[3]], None)
+        assert_equal(recipients['bogus'], None)
+
+    def test_cache(self):
+        resolver = RecipientResolver()
+        with mock.patch.dict(tg.config, {'mail.recipient_cache_ttl': '60'}), \
+             mock.patch.object(resolver, '_load', wraps=resolver._load) as load:
+            resolver.resolve(self.ids[:2])
+            resolver.resolve(self.ids)
+            assert_equal(load.call_args_list, [
+                mock.call(self.ids[:2]), mock.call(self.ids[2:])])
+            resolver.resolve(self.ids)
+            assert_equal(load.call_count, 2)
+
+
 class TestHeader(object):
 
     @raises(TypeError)
@@ -125,4 +170,80 @@ def test_utf8(self):
 
     def test_name_addr(self):
         our_header = Header(u'"теснятся"', u'<dave@b.com>')
-        assert_equal(str(our_header), '=?utf-8?b?ItGC0LXRgdC90Y/RgtGB0Y8i?= <dave@b.com>')
\ No newline at end of file
+        assert_equal(str(our_header), '=?utf-8?b?ItGC0LXRgdC90Y/RgtGB0Y8i?= <dave@b.com>')
+
+class _SMTPServer(smtpd.SMTPServer):
+    '''A local SMTP server recording the connections and messages it gets'''
+
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.connections = 0
+        self.messages = []
+        self.running = True
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve(self):
+        while self.running:
+            asyncore.loop(timeout=0.05, count=1)
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        asyncore.close_all()
+
+    def handle_accept(self):
+        self.connections += 1
+        smtpd.SMTPServer.handle_accept(self)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append((rcpttos, data))
+
+
+class TestSMTPClient(object):
+
+    def setUp(self):
+        setup_basic_test()
+        self.server = _SMTPServer()
+        self.config = mock.patch.dict(tg.config, {
+            'smtp_server': '127.0.0.1',
+            'smtp_port': str(self.server.port),
+            'smtp_pool_size': '1',
+            'smtp_max_messages': '3'})
+        self.config.start()
+        self.client = SMTPClient()
+
+    def tearDown(self):
+        self.client.close()
+        self.config.stop()
+        self.server.stop()
+
+    def _send(self, i, **kw):
+        self.client.sendmail(
+            ['user%s@example.com' % i], u'from@example.com', u'noreply@example.com',
+            u'Subject %s' % i, u'message%s@example.com' % i, None,
+            encode_email_part(u'Message %s' % i, 'plain'), **kw)
+
+    def test_reuses_connections(self):
+        for i in range(5):
+            self._send(i)
+        with self.client.connection() as conn:
+            self._send(5, connection=conn)
+            self._send(6, connection=conn)
+        self.client.close()
+        assert_equal(len(self.server.messages), 7)
+        assert_equal(self.server.messages[0][0], ['user0@example.com'])
+        assert 'Subject: Subject 0' in self.server.messages[0][1]
+        # a connection is closed once it has sent smtp_max_messages
+        assert_equal(self.server.connections, 2)
+        assert_equal(self.client.stats['messages'], 7)
+        assert_equal(self.client.stats['connections'], 2)
+
+    def test_reconnects(self):
+        self._send(0)
+        self.client._idle[0].client.close()
+        self._send(1)
+        assert_equal(len(self.server.messages), 2)
+        assert_equal(self.server.connections, 2)
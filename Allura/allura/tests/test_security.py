@@ -15,6 +15,10 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+from collections import OrderedDict
+
+import mock
+import tg
 from pylons import tmpl_context as c
 from nose.tools import assert_equal
 
@@ -22,7 +26,8 @@
 from allura.tests import decorators as td
 from allura.tests import TestController
 
-from allura.lib.security import Credentials, all_allowed, has_access
+from allura.lib import helpers as h
+from allura.lib.security import Credentials, all_allowed, has_access, filter_readable
 from allura import model as M
 from forgewiki import model as WM
 
@@ -172,3 +177,76 @@ def test_deny_access_for_single_user(self):
         wiki.acl.append(M.ACE.deny(user.project_role()._id, 'read', 'Spammer'))
         Credentials.get().clear()
         assert not has_access(wiki, 'read', user)()
+
+    @td.with_wiki
+    def test_has_access_memo(self):
+        wiki = c.project.app_instance('wiki')
+        page = WM.Page.query.get(app_config_id=wiki.config._id)
+        user = M.User.by_username('test-user')
+        cred = Credentials.get()
+        cred.clear()
+        assert has_access(page, 'read', user)()
+        assert_equal((cred.access_hits, cred.access_misses), (0, 1))
+        assert has_access(page, 'read', user)()
+        assert_equal((cred.access_hits, cred.access_misses), (1, 1))
+        # a different permission is a separate entry, and so are the
+        # neighborhood and project admin checks it falls back to
+        assert not has_access(page, 'delete', user)()
+        assert_equal((cred.access_hits, cred.access_misses), (1, 4))
+        assert not has_access(page, 'delete', user)()
+        assert_equal((cred.access_hits, cred.access_misses), (2, 4))
+        # changing an ACL is picked up without clearing the credentials
+        page.acl.append(M.ACE.deny(user.project_role()._id, 'read'))
+        assert not has_access(page, 'read', user)()
+        page.acl.pop()
+        assert has_access(page, 'read', user)()
+
+    @td.with_wiki
+    def test_has_access_memo_queries(self):
+        wiki = c.project.app_instance('wiki')
+        with h.push_config(c, app=wiki):
+            page = WM.Page.upsert('page')
+            other = WM.Page.upsert('other')
+        ThreadLocalODMSession.flush_all()
+        user = M.User.by_username('test-user')
+        cred = Credentials.get()
+        cred.clear()
+        assert has_access(page, 'read', user)()
+        # the app config, project and neighborhood were only looked up once
+        with mock.patch.object(M.AppConfig, 'query') as ac_query, \
+             mock.patch.object(M.Project, 'query') as p_query, \
+             mock.patch.object(M.Neighborhood, 'query') as n_query:
+            assert has_access(other, 'read', user)()
+        assert_equal((cred.access_hits, cred.access_misses), (1, 1))
+        assert not ac_query.mock_calls, ac_query.mock_calls
+        assert not p_query.mock_calls, p_query.mock_calls
+        assert not n_query.mock_calls, n_query.mock_calls
+
+    @td.with_wiki
+    def test_filter_readable(self):
+        wiki = c.project.app_instance('wiki')
+        page = WM.Page.query.get(app_config_id=wiki.config._id)
+        with h.push_config(c, app=wiki):
+            other = WM.Page.upsert('other')
+            denied = WM.Page.upsert('denied')
+        ThreadLocalODMSession.flush_all()
+        user = M.User.by_username('test-user')
+        _deny(denied, M.ProjectRole.by_name('*authenticated'), 'read')
+        pages = [page, denied, None, other]
+        assert_equal(filter_readable(pages, 'read', user), [page, other])
+        assert_equal(filter_readable(pages, 'delete', user), [])
+        assert_equal(filter_readable(pages, 'read', M.User.by_username('test-admin')),
+                     [page, denied, other])
+
+    @td.with_wiki
+    def test_has_access_shared_memo(self):
+        wiki = c.project.app_instance('wiki')
+        page = WM.Page.query.get(app_config_id=wiki.config._id)
+        user = M.User.by_username('test-user')
+        with mock.patch.dict(tg.config, {'security.access_cache_size': '10'}), \
+             mock.patch('allura.lib.security._shared_access', OrderedDict()):
+            Credentials.get().clear()
+            assert has_access(page, 'read', user)()
+            Credentials.get().clear()  # a new request
+            assert has_access(page, 'read', user)()
+            assert_equal(Credentials.get().access_hits, 1)
@@ -24,6 +24,7 @@
 import unittest
 from base64 import b64encode
 import logging
+from datetime import datetime
 
 import tg
 import mock
@@ -156,19 +157,84 @@ def test_del_artifacts(self, solr):
         solr_query = 'id:({0})'.format(' || '.join(ref_ids))
         solr.delete.assert_called_once_with(q=solr_query)
 
+    @td.with_wiki
+    @mock.patch('allura.tasks.index_tasks.g.solr')
+    def test_add_artifacts_in_batches(self, solr):
+        artifacts = [ _TestArtifact(_shorthand_id='tb_%s' % x) for x in range(5) ]
+        M.artifact_orm_session.flush()
+        ref_ids = [ M.ArtifactReference.from_artifact(a)._id for a in artifacts ]
+        M.artifact_orm_session.flush()
+        with mock.patch.dict(tg.config, {'index_tasks.batch_size': '2'}):
+            result = index_tasks.add_artifacts(ref_ids)
+        assert_equal(result, 'Indexed 5 of 5 artifacts in 3 solr updates')
+        assert_equal([len(args[0][0]) for args in solr.add.call_args_list], [2, 2, 1])
+        solr.reset_mock()
+        with mock.patch.dict(tg.config, {'index_tasks.batch_bytes': '1'}):
+            index_tasks.add_artifacts(ref_ids)
+        assert_equal(solr.add.call_count, 5)
+
+    def test_post_coalesces(self):
+        M.MonQTask.query.remove({})
+        index_tasks.add_artifacts.post(['a', 'b'])
+        index_tasks.add_artifacts.post(['b', 'c'])
+        index_tasks.add_artifacts.post(['d'], update_solr=False)
+        ThreadLocalORMSession.flush_all()
+        tasks = M.MonQTask.query.find(dict(
+            task_name='allura.tasks.index_tasks.add_artifacts')).sort('time_queue').all()
+        assert_equal(len(tasks), 2)
+        assert_equal(sorted(tasks[0].args[0]), ['a', 'b', 'c'])
+        assert_equal(tasks[1].args[0], ['d'])
+
+    def test_post_coalesce_max_size(self):
+        M.MonQTask.query.remove({})
+        with mock.patch.dict(tg.config, {'index_tasks.coalesce_max_size': '3'}):
+            index_tasks.add_artifacts.post(['a', 'b'])
+            index_tasks.add_artifacts.post(['c', 'd'])
+        assert_equal(M.MonQTask.query.find(dict(
+            task_name='allura.tasks.index_tasks.add_artifacts')).count(), 2)
+
+    def test_post_delete_supersedes_add(self):
+        M.MonQTask.query.remove({})
+        add = index_tasks.add_artifacts.post(['a', 'b'])
+        index_tasks.del_artifacts.post(['b'])
+        ThreadLocalORMSession.flush_all()
+        ThreadLocalORMSession.close_all()
+        add = M.MonQTask.query.get(_id=add._id)
+        assert_equal(add.args[0], ['a'])
+        index_tasks.del_artifacts.post(['a'])
+        assert_equal(M.MonQTask.query.find(dict(state='skipped')).count(), 1)
+        index_tasks.add_artifacts.post(['b'])
+        delete = M.MonQTask.query.get(
+            task_name='allura.tasks.index_tasks.del_artifacts')
+        assert_equal(delete.args[0], ['a'])
+
+    def test_post_mixed_kwargs_dont_supersede(self):
+        M.MonQTask.query.remove({})
+        refs = index_tasks.add_artifacts.post(['a'], update_solr=False)
+        hosts = index_tasks.add_artifacts.post(['a'], solr_hosts=['other'])
+        delete = index_tasks.del_artifacts.post(['a', 'b'])
+        index_tasks.add_artifacts.post(['b'], update_refs=False)
+        ThreadLocalORMSession.flush_all()
+        ThreadLocalORMSession.close_all()
+        for t in refs, hosts, delete:
+            assert_equal(M.MonQTask.query.get(_id=t._id).state, 'ready')
+        assert_equal(M.MonQTask.query.get(_id=delete._id).args[0], ['a', 'b'])
+
 
 class TestMailTasks(unittest.TestCase):
 
     def setUp(self):
         setup_basic_test()
         setup_global_objects()
+        mail_tasks.smtp_client.close()
 
     # these tests go down through the mail_util.SMTPClient.sendmail method
     # since usage is generally through the task, and not using mail_util directly
 
     def test_send_email_ascii_with_user_lookup(self):
         c.user = M.User.by_username('test-admin')
-        with mock.patch.object(mail_tasks.smtp_client, '_client') as _client:
+        with mock.patch.object(mail_tasks.smtp_client, '_connect') as _connect:
+            _client = _connect.return_value
             mail_tasks.sendmail(
                 fromaddr=str(c.user._id),
                 destinations=[ str(c.user._id) ],
@@ -189,8 +255,42 @@ def test_send_email_ascii_with_user_lookup(self):
             # html
             assert_in('<div class="markdown_content"><p>This is a test</p></div>', body)
 
+    def test_sendmail_renders_once(self):
+        users = [M.User.by_username(u) for u in ('test-admin', 'test-user', 'test-user-1')]
+        for u, fmt in zip(users, ('plain', 'html', 'both')):
+            u.set_pref('email_format', fmt)
+            u.set_pref('email_address', u.username + '@example.com')
+        ThreadLocalORMSession.flush_all()
+        text = u'Rendered *once* %s' % h.gen_message_id()
+        with mock.patch.object(mail_tasks.smtp_client, '_connect') as _connect, \
+             mock.patch.object(mail_tasks, 'g') as g:
+            _client = _connect.return_value
+            g.forge_markdown.return_value.convert.return_value = u'<p>Rendered</p>'
+            for i in range(2):
+                mail_tasks.sendmail(
+                    fromaddr=u'noreply@sf.net',
+                    destinations=[str(u._id) for u in users],
+                    text=text,
+                    reply_to=u'noreply@sf.net',
+                    subject=u'Test subject',
+                    message_id=h.gen_message_id())
+            assert_equal(g.forge_markdown.call_count, 1)
+            # all three formats are sent over one connection
+            assert_equal(_connect.call_count, 1)
+            assert_equal(_client.sendmail.call_count, 6)
+
+    def test_render_cache_per_project(self):
+        text = u'[link] %s' % h.gen_message_id()
+        with mock.patch.object(mail_tasks, 'g') as g:
+            for shortname in ('test', 'test2', 'test'):
+                project = M.Project.query.get(shortname=shortname)
+                with h.push_config(c, project=project, app=None):
+                    mail_tasks._render(text)
+            assert_equal(g.forge_markdown.call_count, 2)
+
     def test_send_email_nonascii(self):
-        with mock.patch.object(mail_tasks.smtp_client, '_client') as _client:
+        with mock.patch.object(mail_tasks.smtp_client, '_connect') as _connect:
+            _client = _connect.return_value
             mail_tasks.sendmail(
                 fromaddr=u'"По" <foo@bar.com>',
                 destinations=[ 'blah@blah.com' ],
@@ -220,7 +320,8 @@ def test_send_email_with_disabled_user(self):
         destination_user = M.User.by_username('test-user-1')
         destination_user.preferences['email_address'] = 'user1@mail.com'
         ThreadLocalORMSession.flush_all()
-        with mock.patch.object(mail_tasks.smtp_client, '_client') as _client:
+        with mock.patch.object(mail_tasks.smtp_client, '_connect') as _connect:
+            _client = _connect.return_value
             mail_tasks.sendmail(
                 fromaddr=str(c.user._id),
                 destinations=[ str(destination_user._id) ],
@@ -239,7 +340,8 @@ def test_send_email_with_disabled_destination_user(self):
         destination_user.preferences['email_address'] = 'user1@mail.com'
         destination_user.disabled = True
         ThreadLocalORMSession.flush_all()
-        with mock.patch.object(mail_tasks.smtp_client, '_client') as _client:
+        with mock.patch.object(mail_tasks.smtp_client, '_connect') as _connect:
+            _client = _connect.return_value
             mail_tasks.sendmail(
                 fromaddr=str(c.user._id),
                 destinations=[ str(destination_user._id) ],
@@ -251,7 +353,8 @@ def test_send_email_with_disabled_destination_user(self):
 
     def test_sendsimplemail_with_disabled_user(self):
         c.user = M.User.by_username('test-admin')
-        with mock.patch.object(mail_tasks.smtp_client, '_client') as _client:
+        with mock.patch.object(mail_tasks.smtp_client, '_connect') as _connect:
+            _client = _connect.return_value
             mail_tasks.sendsimplemail(
                 fromaddr=str(c.user._id),
                 toaddr='test@mail.com',
@@ -280,7 +383,8 @@ def test_sendsimplemail_with_disabled_user(self):
 
     def test_email_sender_header(self):
         c.user = M.User.by_username('test-admin')
-        with mock.patch.object(mail_tasks.smtp_client, '_client') as _client:
+        with mock.patch.object(mail_tasks.smtp_client, '_connect') as _connect:
+            _client = _connect.return_value
             mail_tasks.sendsimplemail(
                 fromaddr=str(c.user._id),
                 toaddr='test@mail.com',
@@ -330,11 +434,47 @@ def setUp(self):
         setup_global_objects()
 
     def test_delivers_messages(self):
+        M.MonQTask.query.remove({})
         with mock.patch.object(M.Mailbox, 'deliver') as deliver:
             with mock.patch.object(M.Mailbox, 'fire_ready') as fire_ready:
                 notification_tasks.notify('42', '52', 'none')
-                assert deliver.called_with('42', '52', 'none')
-                assert fire_ready.called_with()
+                notification_tasks.notify('43', '52', 'none')
+                deliver.assert_called_with('43', '52', 'none')
+                assert not fire_ready.called
+        # mailboxes are fired by one fire_ready task, not by each notify
+        tasks = M.MonQTask.query.find(dict(
+            task_name='allura.tasks.notification_tasks.fire_ready')).all()
+        assert_equal(len(tasks), 1)
+        assert_equal(tasks[0].context.project_id, None)
+        assert tasks[0].time_queue > datetime.utcnow()
+
+    def test_fire_ready(self):
+        M.MonQTask.query.remove({})
+        with mock.patch.object(M.Mailbox, 'fire_ready') as fire_ready:
+            fire_ready.return_value = True
+            notification_tasks.fire_ready()
+            fire_ready.assert_called_with(limit=1000)
+        # more mailboxes were ready, so it runs again straight away
+        task = M.MonQTask.query.get(
+            task_name='allura.tasks.notification_tasks.fire_ready')
+        assert task.time_queue <= datetime.utcnow()
+
+    def test_schedule_fire_ready_once(self):
+        M.MonQTask.query.remove({})
+        assert notification_tasks.schedule_fire_ready()
+        # already queued, whether or not the caller can see the task yet
+        assert not notification_tasks.schedule_fire_ready()
+        assert not notification_tasks.schedule_fire_ready(delay=0)
+        ThreadLocalORMSession.flush_all()
+        with mock.patch.object(M.Mailbox, 'fire_ready') as fire_ready:
+            fire_ready.return_value = False
+            M.MonQTask.run_ready()
+        # the run queued the next one, and only that
+        tasks = M.MonQTask.query.find(dict(
+            task_name='allura.tasks.notification_tasks.fire_ready',
+            state='ready')).all()
+        assert_equal(len(tasks), 1)
+        assert not notification_tasks.schedule_fire_ready()
 
 @event_handler('my_event')
 def _my_event(event_type, testcase, *args, **kwargs):
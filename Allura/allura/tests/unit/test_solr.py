@@ -15,7 +15,13 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+import os
+import time
+import shutil
+import tempfile
 import unittest
+from datetime import datetime
+from itertools import count
 
 import mock
 from nose.tools import assert_equal
@@ -24,8 +30,8 @@
 from allura.lib import helpers as h
 from allura.tests import decorators as td
 from alluratest.controller import setup_basic_test
-from allura.lib.solr import Solr
-from allura.lib.search import solarize, search_app
+from allura.lib.solr import Solr, MockSOLR, EmbeddedSOLR
+from allura.lib.search import solarize, search_app, markdown_to_text
 
 class TestSolr(unittest.TestCase):
 
@@ -43,6 +49,12 @@ def test_init(self, pysolr):
         pysolr.Solr.assert_has_calls(calls)
         assert_equal(len(solr.push_pool), 2)
 
+    @mock.patch('allura.lib.solr.pysolr')
+    def test_push_request_timeout(self, pysolr):
+        Solr(['server1'], 'server2', push_timeout=10, retries=1, timeout=60)
+        pysolr.Solr.assert_has_calls([
+            mock.call('server1', timeout=5.0), mock.call('server2', timeout=60)])
+
     @mock.patch('allura.lib.solr.pysolr')
     def test_add(self, pysolr):
         servers = ['server1', 'server2']
@@ -90,6 +102,256 @@ def test_search(self, pysolr):
         solr.query_server.search.assert_called_once_with('bar', kw='kw')
 
 
+
+class FlakySOLR(MockSOLR):
+    """MockSOLR replica that can be made slow or down"""
+
+    def __init__(self, delay=0, down=False):
+        super(FlakySOLR, self).__init__()
+        self.delay = delay
+        self.down = down
+        self.calls = 0
+
+    def add(self, objects, **kw):
+        self.calls += 1
+        time.sleep(self.delay)
+        if self.down:
+            raise IOError('replica is down')
+        super(FlakySOLR, self).add([dict(o) for o in objects])
+
+
+class MemoryJournal(object):
+
+    def __init__(self):
+        self.ids = count()
+        self.docs = []
+        self.claims = {}
+
+    def record(self, server, method, args, kw):
+        self.docs.append(dict(_id=next(self.ids), server=server,
+                              method=method, args=args, kw=kw))
+
+    def pending(self, server):
+        return len(list(self.entries(server)))
+
+    def entries(self, server):
+        return [d for d in self.docs if d['server'] == server]
+
+    def remove(self, entry):
+        self.docs.remove(entry)
+
+    def claim(self, server, owner=None):
+        if self.claims.get(server, owner) != owner:
+            return None
+        self.claims[server] = owner = owner or next(self.ids)
+        return owner
+
+    def release(self, server, owner):
+        if self.claims.get(server) == owner:
+            del self.claims[server]
+
+
+class TestSolrReplicas(unittest.TestCase):
+
+    def make_solr(self, *replicas, **kw):
+        with mock.patch('allura.lib.solr.pysolr'):
+            solr = Solr(['server%s' % i for i in range(len(replicas))], **kw)
+        solr.push_pool = list(replicas)
+        return solr
+
+    def test_push_is_concurrent(self):
+        replicas = [FlakySOLR(delay=0.3) for i in range(3)]
+        solr = self.make_solr(*replicas)
+        start = time.time()
+        solr.add([{'id': 'a', 'text': 'foo'}])
+        assert time.time() - start < 0.8
+        for r in replicas:
+            assert_equal(r.db.keys(), ['a'])
+
+    def test_retry(self):
+        replica = FlakySOLR(down=True)
+        solr = self.make_solr(FlakySOLR(), replica,
+                              retries=2, backoff=0, journal=MemoryJournal())
+        solr.add([{'id': 'a', 'text': 'foo'}])
+        assert_equal(replica.calls, 3)
+
+    def test_failed_replica_is_journaled_and_caught_up(self):
+        journal = MemoryJournal()
+        good, bad = FlakySOLR(), FlakySOLR(down=True)
+        solr = self.make_solr(good, bad, journal=journal)
+        responses = solr.add([{'id': 'a', 'text': 'foo'}])
+        assert_equal(responses, [None, None])
+        assert_equal(journal.pending('server1'), 1)
+        assert_equal(bad.db, {})
+        # still down, update queued behind the first one
+        solr.add([{'id': 'b', 'text': 'bar'}])
+        assert_equal(journal.pending('server1'), 2)
+        bad.down = False
+        solr._next_replay['server1'] = 0
+        solr.add([{'id': 'c', 'text': 'baz'}])
+        assert_equal(journal.pending('server1'), 0)
+        assert_equal(sorted(bad.db), ['a', 'b', 'c'])
+        assert_equal(sorted(good.db), ['a', 'b', 'c'])
+
+    def test_journaled_updates_are_not_overtaken(self):
+        journal = MemoryJournal()
+        good, bad = FlakySOLR(), FlakySOLR(down=True)
+        solr = self.make_solr(good, bad, journal=journal)
+        solr.add([{'id': 'a', 'text': 'old'}])
+        bad.down = False
+        # not due for a replay yet: the new version waits behind the old one
+        solr._next_replay['server1'] = time.time() + 60
+        solr.add([{'id': 'a', 'text': 'new'}])
+        assert_equal(bad.db, {})
+        assert_equal(journal.pending('server1'), 2)
+        assert solr.replay('server1')
+        assert_equal(bad.db['a']['text'], 'new')
+
+    def test_replay_is_claimed(self):
+        journal = MemoryJournal()
+        bad = FlakySOLR(down=True)
+        solr = self.make_solr(FlakySOLR(), bad, journal=journal)
+        solr.add([{'id': 'a', 'text': 'foo'}])
+        bad.down = False
+        # another process is replaying
+        claim = journal.claim('server1')
+        assert solr.replay('server1')
+        assert_equal(bad.db, {})
+        journal.release('server1', claim)
+        assert solr.replay('server1')
+        assert_equal(bad.db.keys(), ['a'])
+        assert_equal(journal.claims, {})
+
+    def test_slow_replica_times_out(self):
+        journal = MemoryJournal()
+        solr = self.make_solr(FlakySOLR(), FlakySOLR(delay=1),
+                              push_timeout=0.2, journal=journal)
+        start = time.time()
+        solr.add([{'id': 'a', 'text': 'foo'}])
+        assert time.time() - start < 0.8
+        assert_equal(journal.pending('server1'), 1)
+
+    def test_hung_push_does_not_block_next(self):
+        journal = MemoryJournal()
+        slow = FlakySOLR(delay=1)
+        solr = self.make_solr(FlakySOLR(), slow, push_timeout=0.2, journal=journal)
+        solr.add([{'id': 'a', 'text': 'foo'}])
+        slow.delay = 0
+        start = time.time()
+        solr.add([{'id': 'b', 'text': 'foo'}])
+        assert time.time() - start < 0.5
+        assert_equal(journal.pending('server1'), 0)
+        assert 'b' in slow.db
+
+    def test_all_replicas_failing_raises(self):
+        journal = MemoryJournal()
+        solr = self.make_solr(FlakySOLR(down=True), FlakySOLR(down=True),
+                              journal=journal)
+        with td.raises(IOError):
+            solr.add([{'id': 'a', 'text': 'foo'}])
+        assert_equal(journal.docs, [])
+
+
+
+class TestEmbeddedSOLR(unittest.TestCase):
+
+    def setUp(self):
+        self.solr = EmbeddedSOLR()
+        self.solr.add([
+            dict(id='1', title='Fix the Foo bar', text=['hello world ', 'foo'],
+                 type_s='Ticket', ticket_num_i=1, deleted_b=False,
+                 is_history_b=False, mod_date_dt=datetime(2013, 1, 1),
+                 status_s='open'),
+            dict(id='2', title='Another', text='the quick brown fox',
+                 type_s='Ticket', ticket_num_i=2, deleted_b=True,
+                 is_history_b=False, mod_date_dt=datetime(2013, 2, 1),
+                 status_s='closed'),
+            dict(id='3', title='Wiki page', text='foo foo foo page',
+                 type_s='WikiPage', is_history_b=False),
+            dict(id='4', title='Snap', text='foo bar',
+                 type_s='WikiPage Snapshot', is_history_b=True),
+        ])
+
+    def ids(self, *args, **kw):
+        return [d['id'] for d in self.solr.search(*args, **kw)]
+
+    def test_text(self):
+        assert_equal(sorted(self.ids('foo')), ['1', '3', '4'])
+        assert_equal(sorted(self.ids('fo*')), ['1', '2', '3', '4'])
+        assert_equal(self.ids('"quick brown"'), ['2'])
+        assert_equal(self.ids('"brown quick"'), [])
+        assert_equal(self.ids('NOT foo'), ['2'])
+
+    def test_typed_fields(self):
+        assert_equal(self.ids('foo', fq=['is_history_b:False'], sort='id asc'), ['1', '3'])
+        assert_equal(self.ids('ticket_num_i:[2 TO *]'), ['2'])
+        assert_equal(self.ids('ticket_num_i:{1 TO 2]'), ['2'])
+        assert_equal(self.ids('status_s:(open OR closed) && -deleted_b:true'), ['1'])
+        assert_equal(sorted(self.ids('type_s:("Ticket" OR "WikiPage Snapshot")')), ['1', '2', '4'])
+        assert_equal(self.ids('status_s:op*'), ['1'])
+        assert_equal(self.ids('mod_date_dt:[2013-01-15T00:00:00Z TO NOW]'), ['2'])
+
+    def test_sort_and_paging(self):
+        assert_equal(self.ids('*:*', sort='ticket_num_i desc'), ['2', '1', '3', '4'])
+        result = self.solr.search('*:*', sort='id asc', start=1, rows=2, fl='title')
+        assert_equal(result.hits, 4)
+        assert_equal([(d['id'], d['title']) for d in result],
+                     [('2', 'Another'), ('3', 'Wiki page')])
+        assert_equal(self.ids('foo', qt='dismax', qf='title^3 text'), ['1', '3', '4'])
+
+    def test_highlighting(self):
+        result = self.solr.search('foo', qt='dismax', qf='title text', hl='true',
+                                  **{'hl.simple.pre': '[', 'hl.simple.post': ']'})
+        assert_equal(result.highlighting['1'],
+                     {'title': [u'Fix the [Foo] bar'], 'text': [u'hello world [foo]']})
+
+    def test_delete(self):
+        self.solr.delete(id='2')
+        assert_equal(self.ids('quick'), [])
+        self.solr.delete(q='type_s:WikiPage')
+        assert_equal(sorted(self.ids('*:*')), ['1', '4'])
+        self.solr.delete(q='*:*')
+        assert_equal(self.ids('*:*'), [])
+
+    def test_persistence(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'search.idx')
+            solr = EmbeddedSOLR(path)
+            solr.add([dict(id='1', text='foo')])
+            other = EmbeddedSOLR(path)
+            assert_equal([d['id'] for d in other.search('foo')], ['1'])
+            solr.add([dict(id='2', text='foo')])
+            assert_equal(other.search('foo').hits, 2)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_shared_path(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'search.idx')
+            one, two = EmbeddedSOLR(path), EmbeddedSOLR(path)
+            one.compact_size = two.compact_size = 0
+            # neither instance overwrites the other's updates
+            one.add([dict(id='1', text='foo')])
+            two.add([dict(id='2', text='foo')])
+            one.add([dict(id='3', text='foo')])
+            two.delete(id='1')
+            one.delete(q='id:3')
+            for solr in one, two, EmbeddedSOLR(path):
+                assert_equal([d['id'] for d in solr.search('foo')], ['2'])
+            # partial record left by a crashed writer is dropped
+            one.compact_size = 1 << 20
+            one.add([dict(id='4', text='foo')])
+            with open(path + '.log', 'ab') as fp:
+                fp.write('\x80\x02(')
+            two.add([dict(id='5', text='foo')])
+            assert_equal(sorted(d['id'] for d in EmbeddedSOLR(path).search('foo')),
+                         ['2', '4', '5'])
+        finally:
+            shutil.rmtree(tmpdir)
+
+
 class TestSolarize(unittest.TestCase):
 
     def test_no_object(self):
@@ -119,6 +381,48 @@ def test_html_in_text(self):
         assert_equal(solarize(obj), {'text': '<script>alert(1)</script>'})
 
 
+class TestMarkdownToText(unittest.TestCase):
+
+    def test_markup(self):
+        assert_equal(markdown_to_text(
+            'Title\n=====\n\n## Sub ##\n\nSome **bold**, *em* and snake_case `code()`\n\n'
+            '* item one\n1. item two\n\n> quoted\n\n---\n'),
+            'Title Sub Some bold, em and snake_case code() item one item two quoted')
+
+    def test_links(self):
+        assert_equal(markdown_to_text(
+            'See [the docs](http://x.com "t"), ![logo](a.png), [ref][1] and '
+            '<http://y.com>\n\n[1]: http://z.com\n'),
+            'See the docs, logo, ref and http://y.com')
+
+    def test_code_macros_and_html(self):
+        assert_equal(markdown_to_text(
+            '~~~~\n:::python\nprint "hi"\n~~~~\n[[members limit=20]]\n'
+            '<div class="x">html <b>text</b></div><style>p {}</style>'),
+            'print "hi" html text')
+
+    def test_escapes(self):
+        assert_equal(markdown_to_text('\\*not em\\* a &lt; b'), '*not em* a < b')
+
+    def test_code_blocks(self):
+        assert_equal(markdown_to_text(
+            'Some *em*\n\n    int *p = **q;\n    a_b_c\n\n* item\n\n    more *em*\n\n'
+            '~~~~\n:::c\nint *x;\n~~~~\n'),
+            'Some em int *p = **q; a_b_c item more em int *x;')
+
+    def test_stray_markup(self):
+        text = ''.join('int *p%d; /* [a](b */\n' % i for i in range(16000))
+        text += ' '.join('a *b%d <c `d [e' % i for i in range(20000))
+        start = time.time()
+        markdown_to_text(text)
+        assert time.time() - start < 5
+
+    @mock.patch('allura.lib.search.g')
+    def test_no_rendering(self, g):
+        markdown_to_text('[[include ref=Foo]] [Bar] ~~~~\n:::python\nx = 1\n~~~~')
+        assert not g.markdown.convert.called
+
+
 class TestSearch_app(unittest.TestCase):
 
     def setUp(self):
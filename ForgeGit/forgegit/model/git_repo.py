@@ -26,15 +26,19 @@
 from datetime import datetime
 from glob import glob
 import gzip
+import tempfile
+import threading
 from time import time
+from binascii import hexlify
+from collections import OrderedDict
+from subprocess import Popen, PIPE
 
 import tg
 import git
 import gitdb
 from pylons import app_globals as g
 from pylons import tmpl_context as c
-from pymongo.errors import DuplicateKeyError
-from paste.deploy.converters import asbool
+from paste.deploy.converters import asbool, asint
 
 from ming.base import Object
 from ming.orm import Mapper, session, mapper
@@ -42,7 +46,7 @@
 
 from allura.lib import helpers as h
 from allura.lib import utils
-from allura.model.repository import topological_sort, prefix_paths_union
+from allura.model.repository import topological_sort
 from allura import model as M
 
 log = logging.getLogger(__name__)
@@ -207,6 +211,37 @@ def all_commit_ids(self):
             seen.add(ci.binsha)
             yield ci.hexsha
 
+    def commits_since(self, tips):
+        try:
+            refs = self._git.git.rev_list('--all', '--no-walk').split()
+            if tips:
+                # commits that only the old tips reach were dropped by a
+                # force-push or a deleted branch; don't keep them around
+                gone = int(self._rev_list(tips, refs, '--count'))
+                if gone:
+                    log.info('%d commits of %s are no longer reachable',
+                             gone, self._repo.full_fs_path)
+                    return None
+            out = self._rev_list(refs, tips, '--topo-order', '--parents')
+        except git.GitCommandError:
+            log.info('Unable to list commits since %d tips of %s',
+                     len(tips), self._repo.full_fs_path, exc_info=True)
+            return None
+        commits = []
+        for line in out.splitlines():
+            ids = line.split()
+            commits.append((ids[0], ids[1:]))
+        return refs, commits
+
+    def _rev_list(self, include, exclude, *args):
+        # pass the revisions on stdin; a repo can have more tags than fit
+        # on a command line
+        with tempfile.TemporaryFile() as revs:
+            revs.write(''.join('%s\n' % r for r in include))
+            revs.write(''.join('^%s\n' % r for r in exclude))
+            revs.seek(0)
+            return self._git.git.rev_list(*(args + ('--stdin',)), istream=revs)
+
     def new_commits(self, all_commits=False):
         graph = {}
 
@@ -223,9 +258,36 @@ def new_commits(self, all_commits=False):
             to_visit += obj.parents
         return list(topological_sort(graph))
 
+    def refresh_commits_info(self, commit_ids, seen, lazy=True):
+        from allura.model.repo import CommitDoc
+        from allura.model.repo_refresh import BulkWriter, QSIZE
+        writer = BulkWriter(self._repo.full_fs_path, replace=not lazy)
+        i = 0
+        for oids in utils.chunked_iter(commit_ids, QSIZE):
+            oids = list(oids)
+            ci_docs = dict(
+                (ci._id, ci)
+                for ci in CommitDoc.m.find(dict(_id={'$in': oids})))
+            for oid in oids:
+                self._refresh_commit_info(
+                    oid, ci_docs.get(oid), seen, lazy, writer)
+                i += 1
+                if i % 100 == 0:
+                    log.info('Refresh commit info %d: %s', i, oid)
+        writer.flush()
+        writer.log_stats()
+
     def refresh_commit_info(self, oid, seen, lazy=True):
         from allura.model.repo import CommitDoc
-        ci_doc = CommitDoc.m.get(_id=oid)
+        from allura.model.repo_refresh import BulkWriter
+        writer = BulkWriter(self._repo.full_fs_path, replace=not lazy)
+        result = self._refresh_commit_info(
+            oid, CommitDoc.m.get(_id=oid), seen, lazy, writer)
+        writer.flush()
+        return result
+
+    def _refresh_commit_info(self, oid, ci_doc, seen, lazy, writer):
+        from allura.model.repo import CommitDoc
         if ci_doc and lazy: return False
         ci = self._git.rev_parse(oid)
         args = dict(
@@ -241,42 +303,40 @@ def refresh_commit_info(self, oid, seen, lazy=True):
             message=h.really_unicode(ci.message or ''),
             child_ids=[],
             parent_ids = [ p.hexsha for p in ci.parents ])
+        # the trees go first, so that a commit is never there without them
+        self.refresh_tree_info(ci.tree.hexsha, seen, lazy, writer)
         if ci_doc:
             ci_doc.update(**args)
             ci_doc.m.save()
         else:
-            ci_doc = CommitDoc(dict(args, _id=ci.hexsha))
-            try:
-                ci_doc.m.insert(safe=True)
-            except DuplicateKeyError:
-                if lazy: return False
-        self.refresh_tree_info(ci.tree, seen, lazy)
+            writer.insert(CommitDoc(dict(args, _id=ci.hexsha)))
         return True
 
-    def refresh_tree_info(self, tree, seen, lazy=True):
+    def refresh_tree_info(self, tree_id, seen, lazy=True, writer=None):
         from allura.model.repo import TreeDoc
-        if lazy and tree.binsha in seen: return
-        seen.add(tree.binsha)
+        if lazy and tree_id in seen: return
+        seen.add(tree_id)
         doc = TreeDoc(dict(
-                _id=tree.hexsha,
+                _id=tree_id,
                 tree_ids=[],
                 blob_ids=[],
                 other_ids=[]))
-        for o in tree:
-            if o.type == 'submodule':
-                continue
+        type, data = cat_files.read(self._git.git_dir, tree_id)
+        for mode, name, oid in _tree_entries(data):
+            if mode == '160000':
+                continue # submodule
             obj = Object(
-                name=h.really_unicode(o.name),
-                id=o.hexsha)
-            if o.type == 'tree':
-                self.refresh_tree_info(o, seen, lazy)
+                name=h.really_unicode(name),
+                id=oid)
+            if mode == '40000':
+                self.refresh_tree_info(oid, seen, lazy, writer)
                 doc.tree_ids.append(obj)
-            elif o.type == 'blob':
-                doc.blob_ids.append(obj)
             else:
-                obj.type = o.type
-                doc.other_ids.append(obj)
-        doc.m.save(safe=False)
+                doc.blob_ids.append(obj)
+        if writer is None:
+            doc.m.save(safe=False)
+        else:
+            writer.insert(doc)
         return doc
 
     def log(self, revs=None, path=None, exclude=None, id_only=True, **kw):
@@ -409,10 +469,10 @@ def _iter_commits_with_refs(self, *args, **kwargs):
 
     def open_blob(self, blob):
         return _OpenedGitBlob(
-            self._object(blob._id).data_stream)
+            cat_files.stream(self._git.git_dir, blob._id))
 
     def blob_size(self, blob):
-        return self._object(blob._id).data_stream.size
+        return cat_files.info(self._git.git_dir, blob._id)[2]
 
     def _setup_hooks(self, source_path=None):
         'Set up the git post-commit hook'
@@ -425,12 +485,7 @@ def _setup_hooks(self, source_path=None):
         os.chmod(fn, 0755)
 
     def _object(self, oid):
-        evens = oid[::2]
-        odds = oid[1::2]
-        binsha = ''
-        for e,o in zip(evens, odds):
-            binsha += chr(int(e+o, 16))
-        return git.Object.new_from_sha(self._git, binsha)
+        return git.Object.new_from_sha(self._git, gitdb.util.hex_to_bin(oid))
 
     def rev_parse(self, rev):
         return self._git.rev_parse(rev)
@@ -444,8 +499,9 @@ def symbolics_for_commit(self, commit):
             return [], []
 
     def compute_tree_new(self, commit, tree_path='/'):
-        ci = self._git.rev_parse(commit._id)
-        tree = self.refresh_tree_info(ci.tree, set())
+        type, data = cat_files.read(self._git.git_dir, commit._id)
+        # a commit object starts with "tree <hexsha>"
+        tree = self.refresh_tree_info(data[5:45], set())
         return tree._id
 
     def tarball(self, commit, path=None):
@@ -501,28 +557,49 @@ def set_default_branch(self, name):
     def last_commit_ids(self, commit, paths):
         """
         Find the ID of the last commit to touch each path.
+
+        A single `git log` walks back over the history of all the paths at
+        once, and is stopped as soon as every path has been seen (or
+        `lcd_timeout` runs out).
         """
         result = {}
-        paths = set(paths)
-        orig_commit_id = commit_id = commit._id
+        remaining = dict(
+            (h.really_unicode(path).encode('utf-8'), path) for path in paths)
+        if not remaining:
+            return result
         timeout = float(tg.config.get('lcd_timeout', 60))
+        proc = Popen(
+            ['git', '-c', 'core.quotepath=off', 'log',
+             '--format=%x00%H', '--name-only', '--no-merges',
+             str(commit._id), '--'] + remaining.keys(),
+            cwd=self._git.git_dir, stdout=PIPE, close_fds=True)
         start_time = time()
-        while paths and commit_id:
-            if time() - start_time > timeout:
-                log.error('last_commit_ids timeout for %s on %s', orig_commit_id, ', '.join(paths))
-                return result
-            lines = self._git.git.log(
-                    orig_commit_id, '--', *paths,
-                    pretty='format:%H',
-                    name_only=True,
-                    max_count=1,
-                    no_merges=True).split('\n')
-            commit_id = lines[0]
-            changes = set(lines[1:])
-            changed = prefix_paths_union(paths, changes)
-            for path in changed:
-                result[path] = commit_id
-            paths -= changed
+        timer = threading.Timer(timeout, proc.kill)
+        timer.start()
+        try:
+            commit_id = None
+            for line in iter(proc.stdout.readline, ''):
+                line = line.rstrip('\n')
+                if line.startswith('\0'):
+                    commit_id = line[1:]
+                    continue
+                # the changed file resolves itself and its parent dirs
+                name = line
+                while name:
+                    if name in remaining:
+                        result[remaining.pop(name)] = commit_id
+                    name = name.rpartition('/')[0]
+                if not remaining:
+                    break
+        finally:
+            timer.cancel()
+            if proc.poll() is None:
+                proc.kill()
+            proc.wait()
+            proc.stdout.close()
+        if remaining and time() - start_time >= timeout:
+            log.error('last_commit_ids timeout for %s on %s',
+                      commit._id, ', '.join(remaining.values()))
         return result
 
 class _OpenedGitBlob(object):
@@ -555,6 +632,194 @@ def __iter__(self):
             buffer = buffer[eol+1:]
 
     def close(self):
-        pass
+        self._stream.close()
+
+
+def _tree_entries(data):
+    '''Yield the (mode, name, hexsha) of each entry of a raw tree object'''
+    pos = 0
+    while pos < len(data):
+        space = data.index(' ', pos)
+        nul = data.index('\0', space)
+        yield data[pos:space], data[space+1:nul], hexlify(data[nul+1:nul+21])
+        pos = nul + 21
+
+
+class _CatFile(object):
+    '''A long-lived `git cat-file --batch` (or `--batch-check`) process'''
+
+    def __init__(self, git_dir, check):
+        self.key = (git_dir, check)
+        self.last_used = time()
+        self._proc = Popen(
+            ['git', 'cat-file', '--batch-check' if check else '--batch'],
+            cwd=git_dir, stdin=PIPE, stdout=PIPE, close_fds=True)
+
+    def header(self, oid):
+        '''Ask for an object, and return its (hexsha, type, size)'''
+        self._proc.stdin.write(str(oid) + '\n')
+        self._proc.stdin.flush()
+        line = self._proc.stdout.readline()
+        if not line.endswith('\n'):
+            raise IOError('git cat-file exited in %s' % self.key[0])
+        parts = line.split()
+        if parts[-1] == 'missing':
+            raise gitdb.exc.BadObject(oid)
+        return parts[0], parts[1], int(parts[2])
+
+    def read(self, size):
+        data = self._proc.stdout.read(size)
+        if len(data) < size:
+            raise IOError('git cat-file exited in %s' % self.key[0])
+        return data
+
+    def close(self):
+        try:
+            self._proc.stdin.close()
+            self._proc.wait()
+        except (IOError, OSError):
+            pass
+
+
+class _CatFileStream(object):
+    '''The content of one object, read from a `git cat-file --batch`
+    process that goes back to the pool once all of it has been read'''
+
+    def __init__(self, pool, cat_file, size):
+        self._pool = pool
+        self._cat_file = cat_file
+        self.size = self._left = size
+        if not size:
+            self._finish()
+
+    def read(self, size=-1):
+        if self._cat_file is None:
+            return ''
+        if size < 0 or size > self._left:
+            size = self._left
+        try:
+            data = self._cat_file.read(size)
+        except IOError:
+            self.close()
+            raise
+        self._left -= len(data)
+        if not self._left:
+            self._finish()
+        return data
+
+    def _finish(self):
+        cat_file, self._cat_file = self._cat_file, None
+        cat_file.read(1) # the newline after the content
+        self._pool.checkin(cat_file)
+
+    def close(self):
+        # with content left unread, the process can't be reused
+        cat_file, self._cat_file = self._cat_file, None
+        if cat_file is not None:
+            cat_file.close()
+
+    __del__ = close
+
+
+class CatFilePool(object):
+    '''Idle `git cat-file --batch` and `--batch-check` processes, kept per
+    repository so that reading an object doesn't cost a process spawn.
+
+    A process is only used by one caller at a time; callers that find none
+    idle start their own, and up to scm.git.cat_file_pool_size per repo are
+    kept once they're done.  At most scm.git.cat_file_max_idle are kept in
+    all, dropping the least recently used repos first, and processes idle
+    for more than scm.git.cat_file_idle_timeout seconds are closed.'''
+
+    def __init__(self):
+        self._idle = OrderedDict() # by (git_dir, check), least recent first
+        self._lock = threading.Lock()
+
+    def info(self, git_dir, oid):
+        '''Return the (hexsha, type, size) of an object'''
+        cat_file, header = self._request(git_dir, True, oid)
+        self.checkin(cat_file)
+        return header
+
+    def read(self, git_dir, oid):
+        '''Return the (type, content) of an object'''
+        cat_file, (hexsha, type, size) = self._request(git_dir, False, oid)
+        stream = _CatFileStream(self, cat_file, size)
+        return type, stream.read()
+
+    def stream(self, git_dir, oid):
+        '''Return a file-like object with the content of an object'''
+        cat_file, (hexsha, type, size) = self._request(git_dir, False, oid)
+        return _CatFileStream(self, cat_file, size)
+
+    def _request(self, git_dir, check, oid):
+        cat_file = self._checkout(git_dir, check)
+        try:
+            return cat_file, cat_file.header(oid)
+        except gitdb.exc.BadObject:
+            self.checkin(cat_file)
+            raise
+        except IOError:
+            # the idle process died; a new one gets one more try
+            cat_file.close()
+            cat_file = _CatFile(git_dir, check)
+            try:
+                return cat_file, cat_file.header(oid)
+            except gitdb.exc.BadObject:
+                self.checkin(cat_file)
+                raise
+            except IOError:
+                cat_file.close()
+                raise
+
+    def _checkout(self, git_dir, check):
+        key = (git_dir, check)
+        timeout = asint(tg.config.get('scm.git.cat_file_idle_timeout', 300))
+        stale = []
+        cat_file = None
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle and cat_file is None:
+                cat_file = idle.pop()
+                if time() - cat_file.last_used > timeout:
+                    stale.append(cat_file)
+                    cat_file = None
+            if not idle:
+                self._idle.pop(key, None)
+        for f in stale:
+            f.close()
+        if cat_file is None:
+            cat_file = _CatFile(git_dir, check)
+        return cat_file
+
+    def checkin(self, cat_file):
+        pool_size = asint(tg.config.get('scm.git.cat_file_pool_size', 2))
+        max_idle = asint(tg.config.get('scm.git.cat_file_max_idle', 100))
+        cat_file.last_used = time()
+        closing = []
+        with self._lock:
+            idle = self._idle.pop(cat_file.key, [])
+            if len(idle) < pool_size:
+                idle.append(cat_file)
+            else:
+                closing.append(cat_file)
+            if idle:
+                self._idle[cat_file.key] = idle
+            total = sum(len(i) for i in self._idle.itervalues())
+            while total > max_idle:
+                key, idle = self._idle.popitem(last=False)
+                closing += idle
+                total -= len(idle)
+        for f in closing:
+            f.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, OrderedDict()
+        for cat_files in idle.itervalues():
+            for f in cat_files:
+                f.close()
+
+cat_files = CatFilePool()
 
 Mapper.compile_all()
@@ -21,6 +21,7 @@
 import shutil
 import tempfile
 
+import mock
 from nose.tools import assert_equal, assert_in, assert_not_in
 import tg
 import pkg_resources
@@ -245,6 +246,29 @@ def test_diff_view_mode(self):
         assert fn + '&amp;diformat=regular">Switch to unified view</a>' in r
         assert '<table class="side-by-side-diff">' in r
 
+    def test_barediff_stream(self):
+        ci = self._get_ci()
+        fn = 'tree/README?barediff=df30427c488aeab84b2352bdf88a3b19223f9d7a'
+        # streamed the first time, and served from the cache afterwards
+        for i in range(2):
+            r = self.app.get(ci + fn + '&diformat=sidebyside')
+            assert_in('<table class="side-by-side-diff">', r)
+            assert_in('</table>', r)
+            assert_equal(M.repo.DiffCacheDoc.m.find().count(), 1)
+        r = self.app.get(ci + fn + '&diformat=sidebyside&context=all')
+        assert_in('<table class="side-by-side-diff">', r)
+        assert_not_in('diff-expand', r)
+        assert_equal(M.repo.DiffCacheDoc.m.find().count(), 2)
+
+    def test_diff_truncated(self):
+        ci = self._get_ci()
+        fn = 'tree/README?barediff=df30427c488aeab84b2352bdf88a3b19223f9d7a'
+        with mock.patch.dict(tg.config, {'scm.diff.max_lines': '0'}):
+            r = self.app.get(ci + fn + '&diformat=sidebyside')
+            assert_in('class="diff-truncated"', r)
+            r = self.app.get(ci + fn + '&diformat=regular')
+            assert_in('Diff truncated', r)
+
     def test_refresh(self):
         notification = M.Notification.query.find(
             dict(subject='[test:src-git] 5 new commits to Test Project Git')).first()
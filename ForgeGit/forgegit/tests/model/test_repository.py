@@ -23,6 +23,7 @@
 import datetime
 
 import mock
+import gitdb
 from pylons import tmpl_context as c, app_globals as g
 import tg
 from ming.base import Object
@@ -32,10 +33,12 @@
 
 from alluratest.controller import setup_basic_test, setup_global_objects
 from allura.lib import helpers as h
+from allura.lib.commit_graph import CommitGraph
 from allura.tests import decorators as td
 from allura.tests.model.test_repo import RepoImplTestBase
 from allura import model as M
-from allura.model.repo_refresh import send_notifications
+from allura.model.repo_refresh import send_notifications, refresh_repo
+from allura.model.repo_refresh import refresh_lcds, cancel_lcds, lcd_job_cancelled
 from forgegit import model as GM
 from forgegit.tests import with_git
 from forgewiki import model as WM
@@ -107,6 +110,41 @@ def test_commit(self):
                 '/p/test/src-git/ci/'
                 '1e146e67985dcd71c74de79613719bef7bddca4a/')
 
+    def _post_lcd_units(self):
+        M.repo.LastCommitDoc.m.remove({})
+        commit_ids = list(c.app.repo.all_commit_ids())
+        with mock.patch.dict(tg.config, {
+                'scm.refresh.lcd_task_threshold': '1',
+                'scm.refresh.lcd_unit_size': '2'}):
+            job = refresh_lcds(c.app.repo, commit_ids)
+        ThreadLocalORMSession.flush_all()
+        tasks = M.MonQTask.query.find(dict(
+            task_name='allura.tasks.repo_tasks.compute_lcds')).all()
+        return job, tasks
+
+    def test_refresh_lcds_in_tasks(self):
+        job, tasks = self._post_lcd_units()
+        # 5 commits in units of 2; only the first 2 change anything below
+        # the root, in 'a'
+        self.assertEqual(sorted(t.args[1] for t in tasks), ['', '', '', 'a'])
+        self.assertEqual(set(t.kwargs['job'] for t in tasks), set([job]))
+        M.MonQTask.run_ready()
+        lcd = M.repo.LastCommitDoc.m.get(
+            commit_id='1e146e67985dcd71c74de79613719bef7bddca4a', path='')
+        self.assertEqual(lcd.entries, [
+                dict(name='README', commit_id='1e146e67985dcd71c74de79613719bef7bddca4a')])
+        assert M.repo.LastCommitDoc.m.get(
+            commit_id='9a7df788cf800241e3bb5a849c8870f2f8259d98', path='a/b/c')
+
+    def test_cancel_lcds(self):
+        job, tasks = self._post_lcd_units()
+        assert not lcd_job_cancelled(job)
+        cancel_lcds(c.app.repo)
+        assert lcd_job_cancelled(job)
+        self.assertEqual(M.MonQTask.query.find(dict(
+            task_name='allura.tasks.repo_tasks.compute_lcds',
+            state='ready')).count(), 0)
+
 class TestGitRepo(unittest.TestCase, RepoImplTestBase):
 
     def setUp(self):
@@ -364,6 +402,23 @@ def test_all_commit_ids(self):
             self.assertIn(head, cids)  # all branches included
         self.assertEqual(cids[-1], '9a7df788cf800241e3bb5a849c8870f2f8259d98')  # repo root comes last
 
+    def test_refresh_commit_graph(self):
+        graph = CommitGraph.load(self.repo.commit_graph_path)
+        self.assertEqual(len(graph), 5)
+        self.assertEqual(sorted(graph.tips), [
+                '1e146e67985dcd71c74de79613719bef7bddca4a',
+                '5c47243c8e424136fd5cdd18cd94d34c66d1955c',
+            ])
+        self.assertEqual(sorted(graph.commit_ids()),
+                         sorted(self.repo.all_commit_ids()))
+        # nothing has been pushed, so there's nothing to look up
+        with mock.patch('allura.model.repo_refresh.unknown_commit_ids') as unknown, \
+             mock.patch.object(self.repo._impl, 'all_commit_ids') as all_commit_ids:
+            unknown.return_value = []
+            refresh_repo(self.repo, notify=False)
+        unknown.assert_called_once_with([])
+        assert not all_commit_ids.called
+
     def test_ls(self):
         lcd_map = self.repo.commit('HEAD').tree.ls()
         self.assertEqual(lcd_map, [{
@@ -432,6 +487,70 @@ def test_tags(self):
                 Object(name='foo', object_id='1e146e67985dcd71c74de79613719bef7bddca4a'),
             ])
 
+    def test_commits_since(self):
+        repo_dir = pkg_resources.resource_filename(
+            'forgegit', 'tests/data/testgit.git')
+        repo = mock.Mock(full_fs_path=repo_dir)
+        impl = GM.git_repo.GitImplementation(repo)
+        tips, commits = impl.commits_since([])
+        self.assertEqual(sorted(tips), [
+                '1e146e67985dcd71c74de79613719bef7bddca4a',
+                '5c47243c8e424136fd5cdd18cd94d34c66d1955c',
+            ])
+        self.assertEqual(len(commits), 5)
+        self.assertEqual(commits[-1], ('9a7df788cf800241e3bb5a849c8870f2f8259d98', []))
+        tips, commits = impl.commits_since(['1e146e67985dcd71c74de79613719bef7bddca4a'])
+        self.assertEqual(commits, [
+                ('5c47243c8e424136fd5cdd18cd94d34c66d1955c',
+                 ['1e146e67985dcd71c74de79613719bef7bddca4a']),
+            ])
+        self.assertEqual(impl.commits_since(['0' * 40]), None)
+
+    def test_commits_since_unreachable(self):
+        repo_dir = pkg_resources.resource_filename(
+            'forgegit', 'tests/data/testgit.git')
+        with TempDirectory() as d:
+            copy_dir = os.path.join(d.path, 'testgit.git')
+            shutil.copytree(repo_dir, copy_dir)
+            impl = GM.git_repo.GitImplementation(mock.Mock(full_fs_path=copy_dir))
+            tips, commits = impl.commits_since([])
+            # only the deleted branch reached its head
+            impl._git.git.branch('-D', 'zz')
+            self.assertEqual(impl.commits_since(tips), None)
+            self.assertEqual(
+                impl.commits_since(['1e146e67985dcd71c74de79613719bef7bddca4a']),
+                (['1e146e67985dcd71c74de79613719bef7bddca4a'], []))
+
+    def test_cat_files(self):
+        repo_dir = pkg_resources.resource_filename(
+            'forgegit', 'tests/data/testgit.git')
+        pool = GM.git_repo.CatFilePool()
+        readme = 'be00c63250248c284b842deee5d8fb0b8132acab'
+        self.assertEqual(pool.info(repo_dir, readme), (readme, 'blob', 28))
+        self.assertEqual(pool.read(repo_dir, readme),
+                         ('blob', 'This is readme\nAnother Line\n'))
+        stream = pool.stream(repo_dir, readme)
+        self.assertEqual(stream.read(4), 'This')
+        stream.close()  # abandoned half way, so not reused
+        self.assertEqual(list(GM.git_repo._OpenedGitBlob(pool.stream(repo_dir, readme))),
+                         ['This is readme\n', 'Another Line\n'])
+        with self.assertRaises(gitdb.exc.BadObject):
+            pool.info(repo_dir, '0' * 40)
+        # one process of each kind, reused throughout
+        self.assertEqual(dict((k, len(v)) for k, v in pool._idle.items()), {
+                (repo_dir, True): 1,
+                (repo_dir, False): 1,
+            })
+        pool.close()
+
+    def test_tree_entries(self):
+        data = ('100644 README\0' + '\x01' * 20 +
+                '40000 dir\0' + '\x02' * 20)
+        self.assertEqual(list(GM.git_repo._tree_entries(data)), [
+                ('100644', 'README', '01' * 20),
+                ('40000', 'dir', '02' * 20),
+            ])
+
     def test_last_commit_ids(self):
         repo_dir = pkg_resources.resource_filename(
             'forgegit', 'tests/data/testrename.git')
@@ -446,6 +565,19 @@ def test_last_commit_ids(self):
                 'f2.txt': '259c77dd6ee0e6091d11e429b56c44ccbf1e64a3',
             })
 
+    def test_last_commit_ids_dirs(self):
+        repo_dir = pkg_resources.resource_filename(
+            'forgegit', 'tests/data/testgit.git')
+        repo = mock.Mock(full_fs_path=repo_dir)
+        impl = GM.git_repo.GitImplementation(repo)
+        commit = mock.Mock(_id='1e146e67985dcd71c74de79613719bef7bddca4a')
+        self.assertEqual(impl.last_commit_ids(commit, [u'README', u'a', u'a/b/c', u'missing']), {
+                'README': '1e146e67985dcd71c74de79613719bef7bddca4a',
+                'a': '6a45885ae7347f1cac5103b0050cc1be6a1496c8',
+                'a/b/c': '6a45885ae7347f1cac5103b0050cc1be6a1496c8',
+            })
+        self.assertEqual(impl.last_commit_ids(commit, []), {})
+
 
 class TestGitCommit(unittest.TestCase):
 
@@ -1021,6 +1021,20 @@ def open_blob(blob):
         assert ci.diffs.copied[1]['ratio'] < 1, ci.diffs.copied[1]['ratio']
         assert '+++' in ci.diffs.copied[1]['diff'], ci.diffs.copied[1]['diff']
 
+        # renames are kept with the diff info, so later views and pages
+        # don't look for them again
+        di = M.repo.DiffInfoDoc.m.get(_id=ci._id)
+        assert_equal([(r.old, r.new) for r in di.copied],
+                     [('b/a/b', 'b/c'), ('b/b', 'b/a/z')])
+        with mock.patch.object(M.repo.Commit, '_find_renames') as find:
+            pages = [ci.paged_diffs(start=i, end=i + 1)
+                     for i in range(len(di.differences))]
+        assert not find.called
+        assert_equal([d['new'] for p in pages for d in p.copied],
+                     ['b/c', 'b/a/z'])
+        assert_equal([f for p in pages for f in p.added], [])
+        assert_equal([f for p in pages for f in p.removed], ['b/a/a'])
+
     def test_context(self):
         self.ci.context()
 
@@ -19,6 +19,7 @@
 import urllib
 import json
 import difflib
+from collections import defaultdict
 from datetime import datetime, timedelta
 from bson import ObjectId
 
@@ -71,6 +72,9 @@
 
 log = logging.getLogger(__name__)
 
+# solr's default maxBooleanClauses is 1024
+SOLR_MAX_CLAUSES = 1000
+
 CUSTOM_FIELD_SOLR_TYPES = dict(boolean='_b', number='_i')
 SOLR_TYPE_DEFAULTS = dict(_b=False, _i=0)
 
@@ -206,12 +210,11 @@ def milestone_count(self, name):
         if not (fld_name and m_name):
             return d
         mongo_query = {'custom_fields.%s' % fld_name: m_name}
-        r = Ticket.query.find(dict(
+        mongo_query = Ticket.readable_query(self.app_config, c.user, dict(
             mongo_query, app_config_id=self.app_config_id, deleted=False))
-        tickets = [t for t in r if security.has_access(t, 'read')]
-        d['hits'] = len(tickets)
-        d['closed'] = sum(1 for t in tickets
-                          if t.status in self.set_of_closed_status_names)
+        d['hits'] = Ticket.query.find(mongo_query).count()
+        d['closed'] = Ticket.query.find(dict(mongo_query, status={
+            '$in': list(self.set_of_closed_status_names)})).count()
         return d
 
     def invalidate_bin_counts(self):
@@ -572,6 +575,7 @@ class __mongometa__:
             'ticket_num',
             ('app_config_id', 'custom_fields._milestone'),
             'import_id',
+            ('app_config_id', 'acl.access'),  # for read_access()
             ]
         unique_indexes = [
             ('app_config_id', 'ticket_num'),
@@ -1019,6 +1023,58 @@ def __json__(self):
                               url=h.absurl(attach.url())) for attach in self.attachments],
             custom_fields=dict(self.custom_fields))
 
+    @classmethod
+    def read_access(cls, app_config, user, query=None):
+        """Work out which of the tickets matching a mongo query the user can read.
+
+        Tickets without an ACL of their own (all but private tickets) inherit
+        the tracker's, so a single check covers all of them.  The others are
+        grouped by ACL, without loading them, and one ticket of each group is
+        checked.
+
+        Returns a tuple of whether tickets without an ACL are readable, and
+        the ticket_nums of the tickets with an ACL that are and aren't.
+        """
+        project = app_config.project.root_project
+        tracker_readable = security.has_access(app_config, 'read', user, project)()
+        groups = defaultdict(list)
+        # only tickets with an ACE have acl.access keys in the index, so this
+        # doesn't scan the public ones
+        docs = cls.query.mapper.collection.m.find(
+            dict(query or {}, app_config_id=app_config._id,
+                 **{'acl.access': {'$in': [ACE.ALLOW, ACE.DENY]}}),
+            fields=['ticket_num', 'acl'], validate=False)
+        for doc in docs:
+            acl = tuple((ace['access'], ace['role_id'], ace['permission'])
+                        for ace in doc['acl'])
+            groups[acl].append(doc['ticket_num'])
+        samples = cls.query.find(dict(
+            app_config_id=app_config._id,
+            ticket_num={'$in': [nums[0] for nums in groups.itervalues()]}))
+        readable_samples = set(
+            t.ticket_num
+            for t in security.filter_readable(samples, 'read', user, project))
+        readable, unreadable = [], []
+        for nums in groups.itervalues():
+            if nums[0] in readable_samples:
+                readable.extend(nums)
+            else:
+                unreadable.extend(nums)
+        return tracker_readable, readable, unreadable
+
+    @classmethod
+    def readable_query(cls, app_config, user, query):
+        """Restrict a mongo query to the tickets the user can read."""
+        tracker_readable, readable, unreadable = cls.read_access(
+            app_config, user, query)
+        if not tracker_readable:
+            restriction = {'ticket_num': {'$in': readable}}
+        elif unreadable:
+            restriction = {'ticket_num': {'$nin': unreadable}}
+        else:
+            return query
+        return {'$and': [query, restriction]}
+
     @classmethod
     def paged_query(cls, app_config, user, query, limit=None, page=0, sort=None, deleted=False, **kw):
         """
@@ -1027,7 +1083,8 @@ def paged_query(cls, app_config, user, query, limit=None, page=0, sort=None, del
         See also paged_search which does a solr search
         """
         limit, page, start = g.handle_paging(limit, page, default=25)
-        q = cls.query.find(dict(query, app_config_id=app_config._id, deleted=deleted))
+        q = cls.query.find(cls.readable_query(app_config, user, dict(
+            query, app_config_id=app_config._id, deleted=deleted)))
         q = q.sort('ticket_num', pymongo.DESCENDING)
         if sort:
             field, direction = sort.split()
@@ -1039,14 +1096,8 @@ def paged_query(cls, app_config, user, query, limit=None, page=0, sort=None, del
             q = q.sort(field, direction)
         q = q.skip(start)
         q = q.limit(limit)
-        tickets = []
         count = q.count()
-        for t in q:
-            if security.has_access(t, 'read', user, app_config.project.root_project):
-                tickets.append(t)
-            else:
-                count = count -1
-
+        tickets = q.all()
         return dict(
             tickets=tickets,
             count=count, q=json.dumps(query), limit=limit, page=page, sort=sort,
@@ -1080,10 +1131,23 @@ def paged_search(cls, app_config, user, q, limit=None, page=0, sort=None, show_d
         refined_sort = sort if sort else 'ticket_num_i desc'
         if  'ticket_num_i' not in refined_sort:
             refined_sort += ',ticket_num_i asc'
+        project = app_config.project.root_project
+        show_deleted = show_deleted and security.has_access(
+            app_config, 'delete', user, project)()
+        # filter in solr as well as below, so that hits only counts tickets
+        # that will be shown (as long as solr takes that many clauses)
+        fq = [] if show_deleted else ['deleted_b:False']
+        tracker_readable, readable, unreadable = (
+            cls.read_access(app_config, user) if q else (False, [], []))
+        nums = unreadable if tracker_readable else readable
+        if nums and len(nums) <= SOLR_MAX_CLAUSES:
+            fq.append('%sticket_num_i:(%s)' % (
+                '-' if tracker_readable else '',
+                ' OR '.join(str(n) for n in nums)))
         try:
-            if q:
+            if tracker_readable or readable:
                 matches = search_artifact(
-                    cls, q, short_timeout=True,
+                    cls, q, short_timeout=True, fq=fq,
                     rows=limit, sort=refined_sort, start=start, fl='ticket_num_i', **kw)
             else:
                 matches = None
@@ -1102,15 +1166,13 @@ def paged_search(cls, app_config, user, q, limit=None, page=0, sort=None, show_d
             for t in query:
                 ticket_for_num[t.ticket_num] = t
             # and pull them out in the order given by ticket_numbers
-            tickets = []
-            for tn in ticket_numbers:
-                if tn in ticket_for_num:
-                    show_deleted = show_deleted and security.has_access(ticket_for_num[tn], 'delete', user, app_config.project.root_project)
-                    if (security.has_access(ticket_for_num[tn], 'read', user, app_config.project.root_project) and
-                        (show_deleted or ticket_for_num[tn].deleted==False)):
-                        tickets.append(ticket_for_num[tn])
-                    else:
-                        count = count -1
+            found = [ticket_for_num[tn] for tn in ticket_numbers
+                     if tn in ticket_for_num]
+            tickets = [t for t in security.filter_readable(found, 'read', user, project)
+                       if show_deleted or t.deleted == False]
+            hidden = len(found) - len(tickets)
+            if hidden:
+                count -= hidden
         return dict(tickets=tickets,
                     count=count, q=q, limit=limit, page=page, sort=sort,
                     solr_error=solr_error, **kw)
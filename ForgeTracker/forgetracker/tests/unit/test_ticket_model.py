@@ -77,6 +77,35 @@ def test_ticket_num_required2(self):
         else:
             raise AssertionError('Expected schema.Invalid to be thrown')
 
+    def test_paged_query_counts_readable(self):
+        from allura.lib.security import Credentials
+        from allura.websetup import bootstrap
+        observer = bootstrap.create_user('Random Non-Project User')
+        for n in range(1, 6):
+            Ticket(summary='ticket %s' % n, ticket_num=n, reported_by_id=c.user._id)
+        ThreadLocalORMSession.flush_all()
+        for n in (2, 4):
+            Ticket.query.get(ticket_num=n).private = True
+        ThreadLocalORMSession.flush_all()
+        Credentials.get().clear()
+        result = Ticket.paged_query(c.app.config, observer, {}, limit=2)
+        assert_equal(result['count'], 3)
+        assert_equal([t.ticket_num for t in result['tickets']], [5, 3])
+        result = Ticket.paged_query(c.app.config, observer, {}, limit=2, page=1)
+        assert_equal([t.ticket_num for t in result['tickets']], [1])
+        result = Ticket.paged_query(c.app.config, c.user, {}, limit=2)
+        assert_equal(result['count'], 5)
+        assert_equal([t.ticket_num for t in result['tickets']], [5, 4])
+
+    def test_read_access_without_acl_field(self):
+        Ticket(summary='ticket 1', ticket_num=1, reported_by_id=c.user._id)
+        Ticket(summary='ticket 2', ticket_num=2, reported_by_id=c.user._id)
+        ThreadLocalORMSession.flush_all()
+        Ticket.query.mapper.collection.m.update_partial(
+            dict(app_config_id=c.app.config._id, ticket_num=1),
+            {'$unset': {'acl': 1}})
+        assert_equal(Ticket.read_access(c.app.config, c.user), (True, [], []))
+
     def test_private_ticket(self):
         from pylons import tmpl_context as c
         from allura.model import ProjectRole, User
@@ -0,0 +1,119 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+"""
+Compare the throughput of extracting search text from markdown with the
+full g.markdown render + striptags (what solarize() used to do) and with
+allura.lib.search.markdown_to_text, on a synthetic corpus of wiki pages and
+tickets.
+
+Example usage:
+
+(env-allura)root@h1v1024:/var/local/allura/Allura(master)$ paster script development.ini ../scripts/perf/solarize_perf.py -- --docs 1000
+
+The "(memo)" line re-runs the same corpus, so it shows the md5 cache at
+work as long as --docs doesn't exceed the cache size (1000).
+"""
+
+import argparse
+import random
+import time
+
+import jinja2
+from pylons import app_globals as g
+
+from allura.lib import search
+
+WORDS = '''lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod
+tempor incididunt ut labore et dolore magna aliqua enim ad minim veniam quis
+nostrud exercitation ullamco laboris nisi aliquip ex ea commodo consequat
+repository ticket milestone release branch merge commit build deploy'''.split()
+
+CODE = '''~~~~
+:::python
+def %(name)s(x):
+    return [i * 2 for i in range(x)]
+~~~~
+'''
+
+
+def sentence(rnd, n=12):
+    return ' '.join(rnd.choice(WORDS) for i in range(n)).capitalize() + '.'
+
+
+def wiki_page(rnd):
+    parts = ['# %s' % sentence(rnd, 4)]
+    for i in range(rnd.randint(3, 10)):
+        parts.append('## %s' % sentence(rnd, 3))
+        parts.append(' '.join(sentence(rnd) for j in range(rnd.randint(2, 8))))
+        parts.append('* **%s** see [%s](http://example.com/%d)\n* _%s_ [WikiPage%d]' % (
+            rnd.choice(WORDS), rnd.choice(WORDS), i, rnd.choice(WORDS), i))
+        if rnd.random() < 0.3:
+            parts.append(CODE % dict(name=rnd.choice(WORDS)))
+        if rnd.random() < 0.1:
+            parts.append('[[members limit=20]]')
+    return '\n\n'.join(parts)
+
+
+def ticket(rnd):
+    parts = [sentence(rnd) for i in range(rnd.randint(1, 4))]
+    parts.append('Steps to reproduce:\n\n1. %s\n2. %s\n3. %s' % (
+        sentence(rnd, 5), sentence(rnd, 5), sentence(rnd, 5)))
+    if rnd.random() < 0.5:
+        parts.append('    Traceback (most recent call last):\n      File "x.py", line 1\n    ValueError: %s' % rnd.choice(WORDS))
+    parts.append('Related to #%d and [r%d]' % (rnd.randint(1, 999), rnd.randint(1, 999)))
+    return '\n\n'.join(parts)
+
+
+def corpus(n, seed=0):
+    rnd = random.Random(seed)
+    return [wiki_page(rnd) if rnd.random() < 0.4 else ticket(rnd) for i in range(n)]
+
+
+def render_striptags(text):
+    return jinja2.Markup.escape(g.markdown.convert(text)).striptags()
+
+
+def bench(name, func, docs):
+    start = time.time()
+    for text in docs:
+        func(text)
+    elapsed = time.time() - start
+    print '%-23s %5d docs in %7.2fs %8.1f docs/s' % (
+        name, len(docs), elapsed, len(docs) / max(elapsed, 1e-6))
+
+
+def main(opts):
+    docs = corpus(opts.docs)
+    print 'Corpus: %d documents, %.1f MB of markdown' % (
+        len(docs), sum(len(d) for d in docs) / 1024.0 / 1024)
+    if not opts.skip_render:
+        bench('render+striptags', render_striptags, docs)
+    search._md_text_cache.clear()
+    bench('markdown_to_text', search.markdown_to_text, docs)
+    bench('markdown_to_text (memo)', search.markdown_to_text, docs)
+
+
+def parse_options():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--docs', type=int, default=1000, help='Number of documents in the corpus')
+    parser.add_argument('--skip-render', action='store_true', help="Don't time the full markdown render")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main(parse_options())
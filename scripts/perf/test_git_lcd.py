@@ -17,9 +17,32 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
-import sys
+"""
+Times GitImplementation.last_commit_ids.
+
+With a repo_dir, times the entries of sub_dir in an existing repo:
+
+    python test_git_lcd.py /path/to/repo.git [sub_dir [commit]]
+
+With --wide and/or --deep, builds throwaway repos instead:
+
+    python test_git_lcd.py --wide 500 --deep 30 --commits 2000
+
+--wide: that many files in the root, each last touched in its own commit,
+followed by --commits commits to a single other file, so every file has to be
+found far back in history.
+
+--deep: a directory chain that many levels deep, with a file on each level
+last touched before --commits commits to the top level; times the entries of
+the deepest directory and of the one halfway down.
+"""
+
 import os
-from glob import glob
+import sys
+import shutil
+import argparse
+import tempfile
+from subprocess import Popen, PIPE, check_call
 from time import time
 from contextlib import contextmanager
 from pprint import pprint
@@ -36,17 +59,112 @@ def benchmark():
     timer['result'] = timer['end'] - timer['start']
 
 
-def main(repo_dir, sub_dir='', commit=None):
-    repo_dir = repo_dir.rstrip('/')
+def time_lcds(repo_dir, paths, commit=None, verbose=False):
     git = GitImplementation(Mock(full_fs_path=repo_dir))
     commit = Mock(_id=commit or git.head)
-    paths = glob(os.path.join(repo_dir, sub_dir, '*'))
-    paths = [path.replace(repo_dir+'/', '', 1) for path in paths]
-    print "Timing LCDs for %s at %s" % (paths, commit._id)
     with benchmark() as timer:
         result = git.last_commit_ids(commit, paths)
-    pprint(result)
-    print "Took %f seconds" % timer['result']
+    if verbose:
+        pprint(result)
+    missing = set(paths) - set(result)
+    if missing:
+        print '  unresolved: %s' % ', '.join(sorted(missing))
+    return timer['result']
+
+
+def fast_import(repo_dir, commits):
+    """Create a bare repo from (message, {path: content}) commits"""
+    check_call(['git', 'init', '--quiet', '--bare', repo_dir])
+    proc = Popen(['git', 'fast-import', '--quiet'], cwd=repo_dir, stdin=PIPE)
+    for i, (message, files) in enumerate(commits):
+        out = ['commit refs/heads/master',
+               'mark :%d' % (i + 1),
+               'committer Perf <perf@example.com> %d +0000' % (1000000000 + i),
+               'data %d' % len(message), message]
+        if i:
+            out.append('from :%d' % i)
+        for path, content in sorted(files.items()):
+            out += ['M 100644 inline %s' % path,
+                    'data %d' % len(content), content]
+        proc.stdin.write('\n'.join(out) + '\n\n')
+    proc.stdin.close()
+    if proc.wait():
+        raise RuntimeError('git fast-import failed')
+
+
+def noise(count):
+    for i in xrange(count):
+        yield 'noise %d' % i, {'hot.txt': 'rev %d\n' % i}
+
+
+def wide_repo(repo_dir, width, count):
+    files = ['file%05d.txt' % i for i in xrange(width)]
+    commits = [('add %s' % f, {f: '%s\n' % f}) for f in files]
+    fast_import(repo_dir, commits + list(noise(count)))
+    return files
+
+
+def deep_repo(repo_dir, depth, count):
+    dirs = ['/'.join('d%d' % j for j in xrange(i + 1)) for i in xrange(depth)]
+    commits = [('add %s' % d, {d + '/file.txt': '%s\n' % d}) for d in dirs]
+    fast_import(repo_dir, commits + list(noise(count)))
+    return dirs
+
+
+def entries(repo_dir, sub_dir):
+    out = Popen(['git', 'ls-tree', '--name-only', 'HEAD', sub_dir + '/'],
+                cwd=repo_dir, stdout=PIPE).communicate()[0]
+    return out.split()
+
+
+def main(opts):
+    if opts.repo_dir:
+        repo_dir = opts.repo_dir.rstrip('/')
+        if opts.sub_dir:
+            paths = entries(repo_dir, opts.sub_dir.strip('/'))
+        else:
+            paths = entries(repo_dir, '.')
+        print "Timing LCDs for %s at %s" % (paths, opts.commit or 'HEAD')
+        print "Took %f seconds" % time_lcds(
+            repo_dir, paths, opts.commit, verbose=True)
+        return
+    tmp = tempfile.mkdtemp(prefix='lcd-perf-')
+    try:
+        if opts.wide:
+            repo_dir = os.path.join(tmp, 'wide.git')
+            files = wide_repo(repo_dir, opts.wide, opts.commits)
+            print 'Wide: %d files under %d newer commits' % (
+                opts.wide, opts.commits)
+            print '  root: %f seconds' % time_lcds(
+                repo_dir, files + ['hot.txt'])
+        if opts.deep:
+            repo_dir = os.path.join(tmp, 'deep.git')
+            dirs = deep_repo(repo_dir, opts.deep, opts.commits)
+            print 'Deep: %d levels under %d newer commits' % (
+                opts.deep, opts.commits)
+            for d in (dirs[-1], dirs[len(dirs) // 2]):
+                print '  %s: %f seconds' % (d, time_lcds(
+                    repo_dir, entries(repo_dir, d)))
+    finally:
+        shutil.rmtree(tmp)
+
+
+def parse_options():
+    parser = argparse.ArgumentParser(
+        description='Time last commit lookups on wide and deep git trees')
+    parser.add_argument('repo_dir', nargs='?')
+    parser.add_argument('sub_dir', nargs='?', default='')
+    parser.add_argument('commit', nargs='?')
+    parser.add_argument('--wide', type=int, default=0,
+                        help='files in the generated wide tree')
+    parser.add_argument('--deep', type=int, default=0,
+                        help='levels in the generated deep tree')
+    parser.add_argument('--commits', type=int, default=1000,
+                        help='unrelated commits on top of the generated trees')
+    opts = parser.parse_args()
+    if not (opts.repo_dir or opts.wide or opts.deep):
+        parser.error('give a repo_dir, --wide or --deep')
+    return opts
 
 if __name__ == '__main__':
-    main(*sys.argv[1:])
+    main(parse_options())